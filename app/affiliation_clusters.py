@@ -0,0 +1,211 @@
+import threading
+import zlib
+import numpy as np
+from sqlalchemy import select, func
+from app import db
+from app.models import AffiliationCluster, AffiliationClusterLabel, AffiliationLshBucket, lock_for_writing
+from app.gazetteer import gazetteer
+from config import Config
+
+
+### Words most affiliations share, they say little about which lab an affiliation is
+GENERIC_WORDS = set("""department departments division section unit units laboratory laboratories lab labs program programme 
+    group university universities school schools college faculty institute institutes hospital hospitals center centers 
+    clinic clinics medical medicine health healthcare sciences science research national graduate affiliated clinical 
+    state new""".split())
+### States, provinces and countries GeoText doesn't know. Words of one or two letters (state codes, postcode 
+### fragments) are generic too.
+REGION_WORDS = set("""usa prc alabama alaska arizona arkansas california colorado connecticut delaware florida georgia hawaii 
+    idaho illinois indiana iowa kansas kentucky louisiana maine maryland massachusetts michigan minnesota mississippi 
+    missouri montana nebraska nevada ohio oklahoma oregon pennsylvania tennessee texas utah vermont virginia washington 
+    wisconsin wyoming ontario quebec alberta manitoba saskatchewan""".split())
+ABBREVIATIONS = {'dept' : 'department', 'univ' : 'university', 'inst' : 'institute', 'hosp' : 'hospital', 
+                 'ctr' : 'center', 'centre' : 'center', 'centres' : 'centers', 'div' : 'division', 'med' : 'medical'}
+IGNORED_WORDS = {'the', 'and', 'for'}
+### "university toronto" is the University of Toronto, "columbia university" is Columbia, not the city
+NAMED_AFTER = {'university', 'college', 'institute'}
+NAMED_BEFORE = {'university', 'college', 'institute', 'hospital', 'clinic'}
+
+clusters_table = AffiliationCluster.__table__
+labels_table = AffiliationClusterLabel.__table__
+lsh_table = AffiliationLshBucket.__table__
+
+
+class AffiliationClusters(object):
+    """
+    Groups near-duplicate (preprocessed) affiliations into institutions with MinHash + LSH, so 
+    "dept neurology harvard medical school boston ma" and its close variants count as one lab.
+
+    - Each affiliation's words are MinHashed into `num_perm` values, split into `bands` bands.
+        Affiliations sharing any band's bucket are candidates.
+    - A candidate's cluster is only joined if the affiliation's weighted word similarity (see `similarity`) 
+        to that cluster's label is at least `threshold`. Comparing against the label rather than the 
+        closest member keeps clusters from chaining, eg. Toronto neurology -> Toronto psychiatry -> 
+        Ottawa psychiatry.
+    - Assignments, signatures and buckets are kept in the app's database, which every web and worker 
+        process shares. Affiliations seen before keep their cluster and new ones are assigned against 
+        what is stored, so nothing is ever re-clustered and results and refreshes made in different 
+        processes, or before a restart, group under the same labels. Changing how affiliations are 
+        assigned needs a migration that empties the tables.
+    - A cluster's label is its first member, so labels are stable across queries.
+    - Buckets hold at most `bucket_size` affiliations. A full bucket is a dense region that already has
+        enough members to match against, and capping them keeps assignment linear in the number of 
+        new affiliations.
+    """
+    num_perm = 128
+    bands = 32
+    bucket_size = 25
+    batch_size = 500
+    ### Random but fixed so signatures stay comparable with the stored ones
+    seed = 1203
+    generic_weight = 0.25
+
+    def __init__(self, engine=None, threshold=None):
+        self.engine = engine or db.engine
+        self.threshold = float(threshold or Config.AFFIL_CLUSTER_THRESHOLD)
+        self.rows = self.num_perm // self.bands
+        rand = np.random.RandomState(self.seed)
+        self.perm_a = rand.randint(1, 2 ** 62, size=self.num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        self.perm_b = rand.randint(0, 2 ** 62, size=self.num_perm, dtype=np.int64).astype(np.uint64)
+        self.lock = threading.Lock()
+
+    def signature(self, proc_affiliation):
+        """
+        MinHash of the affiliation's words, or None if it has none.
+        """
+        words = set(proc_affiliation.split())
+        if not words:
+            return None
+        hashes = np.array([zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.uint64)
+        ### Multiply-shift hashing, uint64 arithmetic wraps
+        permuted = (hashes[:, None] * self.perm_a[None, :] + self.perm_b[None, :]) >> np.uint64(32)
+        return permuted.min(axis=0)
+
+    @classmethod
+    def word_weights(cls, proc_affiliation):
+        """
+        {word : weight} for the affiliation's words. Institution names and fields ("harvard", "neurology") 
+        weigh 1, generic words ("department", "hospital") and places ("boston", "ma", "canada") weigh 
+        `generic_weight`, unless the place names the institution ("university toronto").
+        """
+        words = [ABBREVIATIONS.get(word, word) for word in proc_affiliation.split() if word not in IGNORED_WORDS]
+        weights = {}
+        for i, word in enumerate(words):
+            if len(word) <= 2 or word in GENERIC_WORDS or word in REGION_WORDS:
+                weight = cls.generic_weight
+            elif gazetteer.kinds.get(word) and not ((i > 0 and words[i - 1] in NAMED_AFTER) or 
+                                                    (i + 1 < len(words) and words[i + 1] in NAMED_BEFORE)):
+                weight = cls.generic_weight
+            else:
+                weight = 1.0
+            weights[word] = max(weight, weights.get(word, 0))
+        return weights
+
+    @staticmethod
+    def similarity(weights, other_weights):
+        """
+        Weighted Jaccard similarity of two `word_weights` : sum of the smaller weight over sum of the larger.
+        """
+        words = set(weights) | set(other_weights)
+        larger = sum(max(weights.get(word, 0), other_weights.get(word, 0)) for word in words)
+        smaller = sum(min(weights.get(word, 0), other_weights.get(word, 0)) for word in words)
+        return smaller / larger if larger else 0.0
+
+    def bucket_keys(self, signature):
+        return [band * 2 ** 32 + zlib.crc32(signature[band * self.rows:(band + 1) * self.rows].tobytes()) 
+                for band in range(self.bands)]
+
+    def select_batched(self, connection, query, column, values):
+        """
+        Rows of `query` where `column` is in `values`, selected `batch_size` values at a time.
+        """
+        values = list(values)
+        rows = []
+        for i in range(0, len(values), self.batch_size):
+            rows += connection.execute(query.where(column.in_(values[i:i + self.batch_size]))).fetchall()
+        return rows
+
+    def known_labels(self, connection, proc_affiliations):
+        return dict(self.select_batched(connection, select([clusters_table.c.proc_affiliation, labels_table.c.label])\
+                                        .select_from(clusters_table.join(labels_table, clusters_table.c.cluster_id == labels_table.c.cluster_id)),
+                                        clusters_table.c.proc_affiliation, proc_affiliations))
+
+    def assign(self, proc_affiliations):
+        """
+        Return {proc_affiliation : cluster label} for every affiliation in `proc_affiliations`, 
+        clustering and storing the ones not seen before. Empty affiliations are their own label.
+        """
+        proc_affiliations = set(proc for proc in proc_affiliations if isinstance(proc, str))
+        labels = {proc : proc for proc in proc_affiliations if not proc.split()}
+        to_assign = proc_affiliations - set(labels)
+
+        with self.lock:
+            with self.engine.connect() as connection:
+                labels.update(self.known_labels(connection, to_assign))
+            new_procs = sorted(to_assign - set(labels))
+            if not new_procs:
+                return labels
+
+            with self.engine.begin() as connection:
+                ### Serialize writers so concurrent queries don't create duplicate clusters
+                lock_for_writing(connection, 'affiliation_clusters')
+                ### Another process may have assigned some of these while we waited for the lock
+                labels.update(self.known_labels(connection, new_procs))
+                new_procs = [proc for proc in new_procs if proc not in labels]
+                labels.update(self.cluster_new(connection, new_procs))
+        print(f'Clustered {len(new_procs)} new affiliations.')
+        return labels
+
+    def cluster_new(self, connection, new_procs):
+        signatures = {proc : self.signature(proc) for proc in new_procs}
+        proc_buckets = {proc : self.bucket_keys(signatures[proc]) for proc in new_procs}
+
+        ### Stored affiliations sharing a bucket with any new one, with their clusters
+        bucket_members = {}
+        for bucket_key, proc in self.select_batched(connection, select([lsh_table.c.bucket_key, lsh_table.c.proc_affiliation]),
+                                                    lsh_table.c.bucket_key, set(key for keys in proc_buckets.values() for key in keys)):
+            bucket_members.setdefault(bucket_key, []).append(proc)
+        member_clusters = dict(self.select_batched(connection, select([clusters_table.c.proc_affiliation, clusters_table.c.cluster_id]),
+                                                    clusters_table.c.proc_affiliation, set(proc for procs in bucket_members.values() for proc in procs)))
+        cluster_labels = dict(self.select_batched(connection, select([labels_table.c.cluster_id, labels_table.c.label]),
+                                                    labels_table.c.cluster_id, set(member_clusters.values())))
+        label_weights = {cluster_id : self.word_weights(label) for cluster_id, label in cluster_labels.items()}
+        next_cluster_id = (connection.execute(select([func.max(labels_table.c.cluster_id)])).scalar() or 0) + 1
+
+        labels = {}
+        cluster_rows = []
+        label_rows = []
+        lsh_rows = []
+        for proc in new_procs:
+            signature = signatures[proc]
+            weights = self.word_weights(proc)
+            best_cluster_id = None
+            best_similarity = self.threshold
+            ### Ties go to the lowest (oldest) cluster
+            candidate_clusters = sorted(set(member_clusters[member] for key in proc_buckets[proc] 
+                                            for member in bucket_members.get(key, ())))
+            for cluster_id in candidate_clusters:
+                similarity = self.similarity(weights, label_weights[cluster_id])
+                if similarity >= best_similarity and (best_cluster_id is None or similarity > best_similarity):
+                    best_cluster_id, best_similarity = cluster_id, similarity
+            if best_cluster_id is None:
+                best_cluster_id = next_cluster_id
+                next_cluster_id += 1
+                cluster_labels[best_cluster_id] = proc
+                label_weights[best_cluster_id] = weights
+                label_rows.append({'cluster_id' : best_cluster_id, 'label' : proc})
+
+            labels[proc] = cluster_labels[best_cluster_id]
+            cluster_rows.append({'proc_affiliation' : proc, 'cluster_id' : best_cluster_id, 'signature' : signature.tobytes()})
+            ### Later affiliations in this batch can join this one's cluster
+            member_clusters[proc] = best_cluster_id
+            for key in proc_buckets[proc]:
+                members = bucket_members.setdefault(key, [])
+                if len(members) < self.bucket_size:
+                    members.append(proc)
+                    lsh_rows.append({'bucket_key' : key, 'proc_affiliation' : proc})
+
+        for table, rows in [(clusters_table, cluster_rows), (labels_table, label_rows), (lsh_table, lsh_rows)]:
+            if rows:
+                connection.execute(table.insert(), rows)
+        return labels
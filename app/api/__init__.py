@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('api', __name__)
 
-from app.api import errors
\ No newline at end of file
+from app.api import errors, results
\ No newline at end of file
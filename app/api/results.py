@@ -0,0 +1,125 @@
+import csv
+import io
+import json
+import re
+from flask import jsonify, request, current_app, Response, stream_with_context
+from app import db
+from app.api import bp
+from app.api.errors import error_response, bad_request
+from app.models import Result
+from app.result_store import read_entity_rows, find_entity_id, read_entity_papers, read_result_entities
+
+
+def tabulator_params(args, default_sort):
+    """
+    Paging, sorting and filtering from the query string Tabulator's remote pagination sends :
+    `page`, `size`, `sorters[0][field]`/`sorters[0][dir]` and `filters[n][field]`/`filters[n][value]`.
+    `sort`, `dir` and `filter` work too for calling the endpoints by hand.
+
+    Returns (page, size, sort field, descending, {filter field : value})
+    """
+    page = max(args.get('page', 1, type=int), 1)
+    size = min(max(args.get('size', int(current_app.config['RESULTS_PER_PAGE']), type=int), 1),
+                int(current_app.config['RESULTS_MAX_PAGE_SIZE']))
+
+    sort = args.get('sorters[0][field]') or args.get('sort') or default_sort
+    descending = (args.get('sorters[0][dir]') or args.get('dir') or 'asc').lower() == 'desc'
+
+    filters = {}
+    for arg, field in args.items():
+        match = re.match(r'filters\[(\d+)\]\[field\]$', arg)
+        if match and args.get(f'filters[{match.group(1)}][value]'):
+            filters[field] = args.get(f'filters[{match.group(1)}][value]')
+    return page, size, sort, descending, filters
+
+
+def page_response(n_rows, rows, page, size):
+    return jsonify({'last_page' : max((n_rows + size - 1) // size, 1), 'total' : n_rows, 'data' : rows})
+
+
+@bp.route('/results/<int:result_id>/entities', methods=['GET'])
+def result_entities(result_id):
+    """
+    One page of a stored result's authors/affiliations, without their papers.
+    Sort on `rank`, `key` or `total_count`, filter on `key` (case-insensitive substring).
+    """
+    Result.query.get_or_404(result_id)
+    page, size, sort, descending, filters = tabulator_params(request.args, 'rank')
+    n_entities, rows = read_entity_rows(db.session, result_id, offset = (page - 1) * size, limit = size,
+                                        sort = sort, descending = descending,
+                                        key_filter = filters.get('key') or request.args.get('filter'),
+                                        count_limit = int(current_app.config['RESULTS_TOP_COUNTS']))
+    return page_response(n_entities, rows, page, size)
+
+
+@bp.route('/results/<int:result_id>/entities/<path:entity_key>/papers', methods=['GET'])
+def result_entity_papers(result_id, entity_key):
+    """
+    One page of the papers of author/affiliation `entity_key` in a stored result.
+    Sort on `position`, `pmid`, `title` or `pubdate`, filter on `title` (case-insensitive substring).
+    """
+    entity_id = find_entity_id(db.session, result_id, entity_key)
+    if entity_id is None:
+        return error_response(404, f'No entity {entity_key!r} in result {result_id}')
+    page, size, sort, descending, filters = tabulator_params(request.args, 'position')
+    n_papers, papers = read_entity_papers(db.session, entity_id, offset = (page - 1) * size, limit = size,
+                                            sort = sort, descending = descending,
+                                            title_filter = filters.get('title') or request.args.get('filter'))
+    return page_response(n_papers, papers, page, size)
+
+
+def iter_result_entities(result_id, batch_size):
+    """
+    (entity key, output dictionary) for every entity of `result_id` in rank order, read `batch_size` at a time.
+    """
+    offset = 0
+    while True:
+        out_dict = read_result_entities(db.session, result_id, offset = offset, limit = batch_size, with_papers = False)
+        if not out_dict:
+            return
+        yield from out_dict.items()
+        offset += batch_size
+
+
+def export_value(value):
+    return value if isinstance(value, (str, int, float)) or value is None else json.dumps(value)
+
+
+@bp.route('/results/<int:result_id>/export.<export_format>', methods=['GET'])
+def export_result(result_id, export_format):
+    """
+    Every author/affiliation of a stored result as a `csv` or `json` download, in the shape the query returned 
+    them minus the full paper records (`papers_links` has each paper's PMID, title and link).
+
+    Entities are read and sent `RESULTS_MAX_PAGE_SIZE` at a time so large results aren't held in memory.
+    """
+    if export_format not in ('csv', 'json'):
+        return bad_request(f'Unknown export format {export_format!r}, use csv or json')
+    result = Result.query.get_or_404(result_id)
+    entities = iter_result_entities(result_id, int(current_app.config['RESULTS_MAX_PAGE_SIZE']))
+
+    def json_chunks():
+        yield '['
+        for i, (entity_key, obj_dict) in enumerate(entities):
+            yield (',\n' if i else '\n') + json.dumps(dict(key = entity_key, **obj_dict))
+        yield '\n]\n'
+
+    def csv_chunks():
+        buffer = io.StringIO()
+        writer = None
+        for entity_key, obj_dict in entities:
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames = ['key'] + list(obj_dict), extrasaction = 'ignore')
+                writer.writeheader()
+            writer.writerow(dict(key = entity_key, **{field : export_value(value) for field, value in obj_dict.items()}))
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    chunks = json_chunks() if export_format == 'json' else csv_chunks()
+    mimetype = 'application/json' if export_format == 'json' else 'text/csv'
+    filename = f'{result.query_type}_{result_id}.{export_format}'
+    return Response(stream_with_context(chunks), mimetype = mimetype,
+                    headers = {'Content-Disposition' : f'attachment; filename={filename}'})
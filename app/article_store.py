@@ -0,0 +1,254 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from config import Config
+
+
+class ArticleStore(object):
+    """
+    Local SQLite store of parsed PubMed articles keyed by PMID.
+
+    Records are the unfiltered rows produced by `parse_pubmed_article` (as dicts keyed by
+    `PAPERS_COLUMNS`) so any query's location/affiliation filters can be applied on top of them.
+
+    - Records older than `max_age_days` are treated as missing so they get re-fetched and overwritten,
+        which is how revisions to PubMed records are picked up. `refresh()` forces this for given PMIDs.
+    - Once the stored records pass `max_bytes`, the least recently read ones are evicted. The size of 
+        the evictable records is kept as a running total in `store_meta` by triggers, so checking it 
+        after each `put_many` doesn't scan the table.
+
+    Records written with `source='baseline'` come from ingesting PubMed's baseline/update files 
+    (see `app.pubmed_ingest`). Those are kept current by the update files, so they never go stale 
+    and are never evicted.
+
+    Every record is also indexed in the `articles_fts` FTS5 table (title, abstract, MeSH headings, 
+    authors, affiliations) so queries can be answered locally, see `app.local_search`.
+    """
+    batch_size = 500
+    fts_insert_sql = 'INSERT INTO articles_fts (rowid, title, abstract, mesh, authors, affiliations, pubyear) VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+    def __init__(self, path=None, max_bytes=None, max_age_days=None):
+        self.path = path or Config.ARTICLE_STORE_PATH
+        self.max_bytes = int(max_bytes or Config.ARTICLE_STORE_MAX_MB) * 1024 * 1024
+        self.max_age = float(max_age_days or Config.ARTICLE_STORE_MAX_AGE_DAYS) * 24 * 60 * 60
+        self.lock = threading.Lock()
+
+        if os.path.dirname(self.path) and not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        ### So rows replaced by INSERT OR REPLACE go through the delete trigger
+        self.conn.execute('PRAGMA recursive_triggers=ON')
+        self.create_tables()
+
+    def create_tables(self):
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS articles (
+                                    pmid INTEGER PRIMARY KEY,
+                                    record TEXT NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    fetched_at REAL NOT NULL,
+                                    last_accessed REAL NOT NULL,
+                                    source TEXT NOT NULL DEFAULT 'eutils')""")
+            ### Stores created before `source` existed
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(articles)')]
+            if 'source' not in columns:
+                self.conn.execute("ALTER TABLE articles ADD COLUMN source TEXT NOT NULL DEFAULT 'eutils'")
+            self.conn.execute('CREATE INDEX IF NOT EXISTS ix_articles_last_accessed ON articles (last_accessed)')
+            ### Running total of `size` over the evictable (`source = 'eutils'`) records
+            self.conn.execute('CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            has_total = self.conn.execute("SELECT 1 FROM store_meta WHERE key = 'eutils_bytes'").fetchone()
+            if not has_total:
+                self.conn.execute("""INSERT INTO store_meta (key, value) 
+                                    SELECT 'eutils_bytes', COALESCE(SUM(size), 0) FROM articles WHERE source = 'eutils'""")
+            self.conn.execute("""CREATE TRIGGER IF NOT EXISTS articles_size_insert AFTER INSERT ON articles 
+                                    WHEN new.source = 'eutils' BEGIN
+                                    UPDATE store_meta SET value = value + new.size WHERE key = 'eutils_bytes'; END""")
+            self.conn.execute("""CREATE TRIGGER IF NOT EXISTS articles_size_delete AFTER DELETE ON articles 
+                                    WHEN old.source = 'eutils' BEGIN
+                                    UPDATE store_meta SET value = value - old.size WHERE key = 'eutils_bytes'; END""")
+            self.conn.execute("""CREATE TRIGGER IF NOT EXISTS articles_size_update AFTER UPDATE OF size, source ON articles BEGIN
+                                    UPDATE store_meta SET value = value 
+                                        - CASE WHEN old.source = 'eutils' THEN old.size ELSE 0 END 
+                                        + CASE WHEN new.source = 'eutils' THEN new.size ELSE 0 END 
+                                    WHERE key = 'eutils_bytes'; END""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS ingested_files (
+                                    file_name TEXT PRIMARY KEY,
+                                    n_articles INTEGER NOT NULL,
+                                    n_deleted INTEGER NOT NULL,
+                                    ingested_at REAL NOT NULL)""")
+
+            has_fts = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'articles_fts'").fetchone()
+            if not has_fts:
+                self.conn.execute("""CREATE VIRTUAL TABLE articles_fts USING fts5(
+                                        title, abstract, mesh, authors, affiliations, pubyear UNINDEXED,
+                                        tokenize = 'porter unicode61')""")
+                ### Index whatever was stored before the index existed
+                for pmid, record in self.conn.execute('SELECT pmid, record FROM articles').fetchall():
+                    self.conn.execute(self.fts_insert_sql, fts_row(int(pmid), json.loads(record)))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def get_many(self, pmids):
+        """
+        Return {pmid : record} for the PMIDs in `pmids` that are stored and not stale.
+        PMIDs are returned as strings, the way the parser reports them.
+        """
+        now = time.time()
+        found = {}
+        pmids = [int(pmid) for pmid in pmids]
+        with self.lock, self.conn:
+            for i in range(0, len(pmids), self.batch_size):
+                batch = pmids[i:i + self.batch_size]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(f"""SELECT pmid, record FROM articles 
+                                            WHERE (fetched_at > ? OR source = 'baseline') AND pmid IN ({placeholders})""",
+                                        [now - self.max_age] + batch).fetchall()
+                for pmid, record in rows:
+                    found[str(pmid)] = json.loads(record)
+                self.conn.execute(f'UPDATE articles SET last_accessed = ? WHERE pmid IN ({placeholders})', [now] + batch)
+        return found
+
+    def put_many(self, records, source='eutils'):
+        """
+        Insert or overwrite parsed records, then evict if the store has grown past `max_bytes`.
+        """
+        now = time.time()
+        rows = []
+        fts_rows = []
+        for record in records:
+            record_json = json.dumps(record)
+            rows.append((int(record['pmid']), record_json, len(record_json), now, now, source))
+            fts_rows.append(fts_row(int(record['pmid']), record))
+        with self.lock, self.conn:
+            self.conn.executemany("""INSERT OR REPLACE INTO articles (pmid, record, size, fetched_at, last_accessed, source) 
+                                    VALUES (?, ?, ?, ?, ?, ?)""", rows)
+            self.delete_fts([row[0] for row in rows])
+            self.conn.executemany(self.fts_insert_sql, fts_rows)
+        self.evict()
+
+    def delete_many(self, pmids):
+        pmids = [int(pmid) for pmid in pmids]
+        with self.lock, self.conn:
+            for i in range(0, len(pmids), self.batch_size):
+                batch = pmids[i:i + self.batch_size]
+                self.conn.execute(f'DELETE FROM articles WHERE pmid IN ({",".join("?" * len(batch))})', batch)
+            self.delete_fts(pmids)
+
+    def delete_fts(self, pmids):
+        for i in range(0, len(pmids), self.batch_size):
+            batch = pmids[i:i + self.batch_size]
+            self.conn.execute(f'DELETE FROM articles_fts WHERE rowid IN ({",".join("?" * len(batch))})', batch)
+
+    def search(self, fts_query, from_year="", limit=None):
+        """
+        PMIDs (as strings) of stored articles matching the FTS5 expression `fts_query`, best match first.
+
+        `from_year` keeps articles whose `pubdate` (the year they entered PubMed) is `from_year` or later, 
+        the same range `esearch_date_params` gives esearch.
+        """
+        sql = 'SELECT rowid FROM articles_fts WHERE articles_fts MATCH ?'
+        params = [fts_query]
+        if from_year:
+            sql += " AND pubyear != '' AND CAST(pubyear AS INTEGER) >= ?"
+            params.append(int(from_year))
+        sql += ' ORDER BY rank'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        with self.lock:
+            return [str(row[0]) for row in self.conn.execute(sql, params)]
+
+    def has_baseline(self):
+        """
+        True once any baseline/update file has been ingested, ie. the local index covers PubMed 
+        rather than just the articles earlier queries happened to fetch.
+        """
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM ingested_files LIMIT 1').fetchone() is not None
+
+    def ingested_file_names(self):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute('SELECT file_name FROM ingested_files'))
+
+    def mark_file_ingested(self, file_name, n_articles, n_deleted):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO ingested_files (file_name, n_articles, n_deleted, ingested_at) VALUES (?, ?, ?, ?)',
+                            (file_name, n_articles, n_deleted, time.time()))
+
+    def refresh(self, pmids=None):
+        """
+        Mark `pmids` (or every record, if None) stale so the next query that needs them re-fetches them.
+        This includes ingested baseline records.
+        """
+        with self.lock, self.conn:
+            if pmids is None:
+                self.conn.execute("UPDATE articles SET fetched_at = 0, source = 'eutils'")
+                return
+            pmids = [int(pmid) for pmid in pmids]
+            for i in range(0, len(pmids), self.batch_size):
+                batch = pmids[i:i + self.batch_size]
+                self.conn.execute(f"""UPDATE articles SET fetched_at = 0, source = 'eutils' 
+                                    WHERE pmid IN ({",".join("?" * len(batch))})""", batch)
+
+    def evictable_bytes(self):
+        """
+        Size of the records eviction can drop, from the running total.
+        """
+        return self.conn.execute("SELECT value FROM store_meta WHERE key = 'eutils_bytes'").fetchone()[0]
+
+    def evict(self):
+        """
+        Drop least recently read records until the store is back under 90% of `max_bytes`.
+        """
+        with self.lock, self.conn:
+            total_size = self.evictable_bytes()
+            if total_size <= self.max_bytes:
+                return
+            to_free = total_size - int(self.max_bytes * .9)
+            freed = 0
+            evict_pmids = []
+            for pmid, size in self.conn.execute("SELECT pmid, size FROM articles WHERE source = 'eutils' ORDER BY last_accessed"):
+                evict_pmids.append(pmid)
+                freed += size
+                if freed >= to_free:
+                    break
+            for i in range(0, len(evict_pmids), self.batch_size):
+                batch = evict_pmids[i:i + self.batch_size]
+                self.conn.execute(f'DELETE FROM articles WHERE pmid IN ({",".join("?" * len(batch))})', batch)
+            self.delete_fts(evict_pmids)
+        print(f'Article store evicted {len(evict_pmids)} articles ({freed} bytes).')
+
+
+def fts_row(pmid, record):
+    """
+    Flatten a parsed record into the `articles_fts` columns.
+    """
+    authors = []
+    affiliations = []
+    for author_text, aff_list in record['author_list']:
+        if isinstance(author_text, list):
+            fore_name, initials, last_name = author_text
+            ### Both "Thiele EA" and "Thiele Elizabeth" so either form of an [Author] search matches
+            authors.append(f'{last_name} {initials or ""}')
+            authors.append(f'{last_name} {fore_name or ""}')
+        elif author_text and author_text != 'error':
+            authors.append(author_text)
+        affiliations += [affil for affil in aff_list if affil]
+    abstract = ' '.join(text for text in record['abstract'].values() if text)
+    mesh = ' ; '.join(record['mesh_keywords'].keys())
+    return (pmid, record['title'], abstract, mesh, ' ; '.join(authors), ' ; '.join(affiliations), record['pubdate'] or '')
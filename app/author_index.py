@@ -0,0 +1,218 @@
+import threading
+from collections import Counter
+from sqlalchemy import select, func
+from app import db
+from app.models import Author, AuthorMention, lock_for_writing
+from config import Config
+
+authors_table = Author.__table__
+mentions_table = AuthorMention.__table__
+
+
+def name_tokens(fore_name):
+    return fore_name.replace('.', ' ').replace('-', ' ').lower().split()
+
+
+def names_compatible(fore_name, other_fore_name):
+    """
+    "Elizabeth", "E" and "Elizabeth A" are compatible, "Elizabeth" and "Emma" aren't.
+    """
+    tokens = name_tokens(fore_name)
+    other_tokens = name_tokens(other_fore_name)
+    if not tokens or not other_tokens:
+        return True
+    first, other_first = tokens[0], other_tokens[0]
+    if len(first) == 1 or len(other_first) == 1:
+        return first[0] == other_first[0]
+    return first == other_first
+
+
+class AuthorIndex(object):
+    """
+    Persistent author-id index that splits "Last, Forename" strings into people. It is kept in the 
+    app's database, so every web and worker process and every restart attaches mentions to the same 
+    authors under the same labels.
+
+    - Mentions are blocked by last name + first initial, so "Smith, John" and "Smith, J" are only 
+        ever compared with each other and never with "Smyth" or "Smith, Anne".
+    - Within a block a new mention joins the name-compatible author whose profile it scores best 
+        against, if the score reaches `threshold`:
+            0.5 * share of its co-authors (as block keys) already in the author's co-authors
+            + 0.3 if one of its affiliation groups is already the author's
+            + 0.2 * share of the paper's MeSH headings already in the author's
+        and it shares at least one co-author or MeSH heading with the author. A shared affiliation 
+        alone isn't enough, big departments have many people with the same surname and initial.
+        A mention with no co-authors, affiliations or MeSH to go on joins the block's most frequent 
+        compatible author. Anything else starts a new author.
+    - Mentions are stored by (pmid, name) so re-seen articles keep their author even if a revision 
+        reordered the author list, and only new mentions are scored. Work is linear in the number of 
+        mentions times the (small) number of authors per block.
+
+    Each author keeps the label it was created with, "Last, Forename", suffixed with " (2)", " (3)", ...
+    when other people in the block already have it.
+    """
+    coauthor_weight = 0.5
+    affiliation_weight = 0.3
+    mesh_weight = 0.2
+    ### Profile entries kept per author and field
+    profile_size = 200
+    batch_size = 500
+
+    def __init__(self, engine=None, threshold=None):
+        self.engine = engine or db.engine
+        self.threshold = float(threshold or Config.AUTHOR_MATCH_THRESHOLD)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def block_key(fore_name, last_name):
+        tokens = name_tokens(fore_name)
+        return f'{last_name.lower()}_{tokens[0][0] if tokens else ""}'
+
+    def select_batched(self, connection, query, column, values):
+        """
+        Rows of `query` where `column` is in `values`, selected `batch_size` values at a time.
+        """
+        values = list(values)
+        rows = []
+        for i in range(0, len(values), self.batch_size):
+            rows += connection.execute(query.where(column.in_(values[i:i + self.batch_size]))).fetchall()
+        return rows
+
+    def paper_mentions(self, papers_data, affil_groups):
+        """
+        One entry per named author of every paper, with what they are scored on.
+        """
+        mentions = []
+        for paper in papers_data:
+            named = [(position, author) for position, author in enumerate(paper['author_list']) \
+                        if isinstance(author[0], list) and isinstance(author[0][0], str) and isinstance(author[0][2], str)]
+            block_keys = {position : self.block_key(author[0][0], author[0][2]) for position, author in named}
+            mesh = set(paper.get('mesh_keywords') or {})
+            name_counts = Counter()
+            for position, author in named:
+                author_name = f'{author[0][2]}, {author[0][0]}'
+                name_counts[author_name] += 1
+                if name_counts[author_name] > 1:
+                    author_name += f' #{name_counts[author_name]}'
+                mentions.append({'pmid' : int(paper['pmid']), 'position' : position, 'author_name' : author_name, 
+                                'fore_name' : author[0][0], 'last_name' : author[0][2],
+                                'block_key' : block_keys[position],
+                                'coauthors' : set(key for other, key in block_keys.items() if other != position),
+                                'affiliations' : set(affil_groups[affil] for affil in author[1] if affil in affil_groups),
+                                'mesh' : mesh})
+        return mentions
+
+    def assign(self, papers_data, affil_groups):
+        """
+        Return {(pmid, position) : author label} for every named author in `papers_data`, 
+        attaching new mentions to the index. `affil_groups` maps raw affiliations to their group.
+        """
+        mentions = self.paper_mentions(papers_data, affil_groups)
+        with self.lock:
+            with self.engine.connect() as connection:
+                names = self.known_labels(connection, mentions)
+            new_mentions = [mention for mention in mentions if (mention['pmid'], mention['author_name']) not in names]
+            if new_mentions:
+                with self.engine.begin() as connection:
+                    ### Serialize writers so concurrent queries don't create the same author twice
+                    lock_for_writing(connection, 'author_index')
+                    names.update(self.known_labels(connection, new_mentions))
+                    new_mentions = [mention for mention in new_mentions if (mention['pmid'], mention['author_name']) not in names]
+                    names.update(self.attach(connection, new_mentions))
+                print(f'Attached {len(new_mentions)} new author mentions.')
+        return {(mention['pmid'], mention['position']) : names[(mention['pmid'], mention['author_name'])] for mention in mentions}
+
+    def known_labels(self, connection, mentions):
+        """
+        {(pmid, author_name) : author label} for the `mentions` already in the index.
+        """
+        keys = set((mention['pmid'], mention['author_name']) for mention in mentions)
+        rows = self.select_batched(connection, select([mentions_table.c.pmid, mentions_table.c.author_name, authors_table.c.label])\
+                                    .select_from(mentions_table.join(authors_table, mentions_table.c.author_id == authors_table.c.author_id)),
+                                    mentions_table.c.pmid, set(pmid for pmid, _ in keys))
+        return {(pmid, author_name) : label for pmid, author_name, label in rows if (pmid, author_name) in keys}
+
+    @staticmethod
+    def has_evidence(mention, profile):
+        """
+        Whether the mention shares a co-author or a MeSH heading with the author, see `AuthorIndex`.
+        """
+        return any(key in profile['coauthors'] for key in mention['coauthors']) or \
+            any(term in profile['mesh'] for term in mention['mesh'])
+
+    def score(self, mention, profile):
+        score = 0.0
+        if mention['coauthors']:
+            score += self.coauthor_weight * len([key for key in mention['coauthors'] if key in profile['coauthors']]) / len(mention['coauthors'])
+        if any(affil in profile['affiliations'] for affil in mention['affiliations']):
+            score += self.affiliation_weight
+        if mention['mesh']:
+            score += self.mesh_weight * len([term for term in mention['mesh'] if term in profile['mesh']]) / len(mention['mesh'])
+        return score
+
+    def attach(self, connection, new_mentions):
+        ### Every author in the blocks being added to
+        authors = {}
+        block_authors = {}
+        for author_id, block_key, label, n_mentions, profile in self.select_batched(connection, 
+                select([authors_table.c.author_id, authors_table.c.block_key, authors_table.c.label, authors_table.c.n_mentions, authors_table.c.profile]),
+                authors_table.c.block_key, set(mention['block_key'] for mention in new_mentions)):
+            profile = {field : Counter(counts) for field, counts in profile.items()}
+            authors[author_id] = {'block_key' : block_key, 'label' : label, 'n_mentions' : n_mentions, 'profile' : profile}
+            block_authors.setdefault(block_key, []).append(author_id)
+        stored_ids = set(authors)
+        next_author_id = (connection.execute(select([func.max(authors_table.c.author_id)])).scalar() or 0) + 1
+
+        labels = {}
+        changed = set()
+        mention_rows = []
+        for mention in sorted(new_mentions, key=lambda mention: (mention['pmid'], mention['position'])):
+            compatible = [author_id for author_id in block_authors.get(mention['block_key'], []) \
+                            if names_compatible(mention['fore_name'], authors[author_id]['profile']['fore_names'].most_common(1)[0][0])]
+            best_author_id = None
+            if compatible and not (mention['coauthors'] or mention['affiliations'] or mention['mesh']):
+                best_author_id = max(compatible, key=lambda author_id: (authors[author_id]['n_mentions'], -author_id))
+            elif compatible:
+                scores = [(self.score(mention, authors[author_id]['profile']), -author_id) for author_id in compatible \
+                            if self.has_evidence(mention, authors[author_id]['profile'])]
+                if scores:
+                    best_score, best_negative_id = max(scores)
+                    if best_score >= self.threshold:
+                        best_author_id = -best_negative_id
+
+            if best_author_id is None:
+                best_author_id = next_author_id
+                next_author_id += 1
+                label = f"{mention['last_name']}, {mention['fore_name']}"
+                same_label = [author_id for author_id in block_authors.get(mention['block_key'], []) \
+                                if authors[author_id]['label'].split(' (')[0] == label]
+                if same_label:
+                    label = f'{label} ({len(same_label) + 1})'
+                authors[best_author_id] = {'block_key' : mention['block_key'], 'label' : label, 'n_mentions' : 0,
+                                            'profile' : {'fore_names' : Counter(), 'coauthors' : Counter(), 
+                                                        'affiliations' : Counter(), 'mesh' : Counter()}}
+                block_authors.setdefault(mention['block_key'], []).append(best_author_id)
+
+            author = authors[best_author_id]
+            author['n_mentions'] += 1
+            author['profile']['fore_names'][mention['fore_name']] += 1
+            for field in ['coauthors', 'affiliations', 'mesh']:
+                author['profile'][field].update(mention[field])
+            changed.add(best_author_id)
+            labels[(mention['pmid'], mention['author_name'])] = author['label']
+            mention_rows.append({'pmid' : mention['pmid'], 'author_name' : mention['author_name'], 'author_id' : best_author_id})
+
+        new_rows = []
+        for author_id in changed:
+            author = authors[author_id]
+            profile = {field : dict(counts.most_common(self.profile_size)) for field, counts in author['profile'].items()}
+            if author_id in stored_ids:
+                connection.execute(authors_table.update().where(authors_table.c.author_id == author_id)\
+                                    .values(n_mentions=author['n_mentions'], profile=profile))
+            else:
+                new_rows.append({'author_id' : author_id, 'block_key' : author['block_key'], 'label' : author['label'],
+                                'n_mentions' : author['n_mentions'], 'profile' : profile})
+        if new_rows:
+            connection.execute(authors_table.insert(), new_rows)
+        connection.execute(mentions_table.insert(), mention_rows)
+        return labels
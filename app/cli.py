@@ -0,0 +1,18 @@
+import click
+
+
+def register(app):
+    @app.cli.command('ingest-pubmed')
+    @click.argument('directory')
+    @click.option('--processes', '-p', default=None, type=int, 
+                  help='Files parsed in parallel. Defaults to INGEST_PROCESSES.')
+    def ingest_pubmed(directory, processes):
+        """Ingest PubMed baseline/update .xml.gz files from DIRECTORY into the article store."""
+        from app.pubmed_ingest import ingest_directory
+        ingest_directory(directory, processes=processes)
+
+    @app.cli.command('query-stats')
+    def query_stats():
+        """Print how many queued queries were run and how many submissions waited on an identical one."""
+        from app.singleflight import flight_stats
+        print(flight_stats())
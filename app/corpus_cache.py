@@ -0,0 +1,67 @@
+import hashlib
+import json
+import pickle
+import zlib
+from config import Config
+from worker import conn
+
+
+def normalize_query_params(query, from_year, locations, affils, min_date=""):
+    """
+    Canonical form of a query's parameters so trivially different submissions
+    (case, spacing, filter order) share one corpus.
+    """
+    def normalize_terms(terms):
+        if isinstance(terms, str):
+            terms = terms.split(',')
+        return sorted(set(term.strip().lower() for term in (terms or []) if term.strip()))
+
+    return {'query' : ' '.join(str(query).lower().split()),
+            'from_year' : str(from_year or '').strip(),
+            'locations' : normalize_terms(locations),
+            'affils' : normalize_terms(affils),
+            'min_date' : str(min_date or '').strip()}
+
+
+def corpus_key(query, from_year, locations, affils, min_date=""):
+    params = normalize_query_params(query, from_year, locations, affils, min_date)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+    ### v4 : mapping entries carry `proc_affiliation`, `affiliation_group` and `author_group`
+    ### v5 : mapping is a columnar `PaperAuthorAffilIndex`
+    return f'corpus:v5:{digest}'
+
+
+def load_corpus(key):
+    """
+    Return (papers_data, paper_author_affil_mapping) stored under `key`, or None.
+    """
+    try:
+        blob = conn.get(key)
+    except Exception as err:
+        print(f'Corpus cache unavailable, skipping lookup : {err}')
+        return None
+    if blob is None:
+        return None
+    return pickle.loads(zlib.decompress(blob))
+
+
+def save_corpus(key, papers_data, paper_author_affil_mapping):
+    """
+    Store a query's parsed papers and its paper-author-affiliation mapping for `CORPUS_TTL` seconds
+    so every view of the same query can be built from it without going back to NCBI.
+
+    Corpora over `CORPUS_MAX_MB` compressed aren't cached : Redis also holds the job queue, and a few 
+    large corpora could fill it or, under an eviction policy, push out job keys. Their articles are 
+    still in the article store, so a later view only re-runs the search and the indexing.
+    """
+    blob = zlib.compress(pickle.dumps((papers_data, paper_author_affil_mapping), protocol=pickle.HIGHEST_PROTOCOL), 1)
+    max_bytes = float(Config.CORPUS_MAX_MB) * 1024 * 1024
+    if len(blob) > max_bytes:
+        print(f'Corpus {key} is {len(blob)} bytes, over CORPUS_MAX_MB ({Config.CORPUS_MAX_MB}), not caching it.')
+        return
+    try:
+        conn.set(key, blob, ex=int(Config.CORPUS_TTL))
+    except Exception as err:
+        print(f'Corpus cache unavailable, not saving {key} : {err}')
+        return
+    print(f'Saved corpus {key} ({len(blob)} bytes).')
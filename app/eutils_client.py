@@ -0,0 +1,257 @@
+import hashlib
+import http.client
+import random
+import socket
+import threading
+import time
+import requests
+import urllib3
+from redis.exceptions import WatchError
+from requests.adapters import HTTPAdapter
+from config import Config
+from worker import conn
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls so that no more than `rate` requests start per second.
+
+    Shared between the threads of the efetch pool. With a `shared_key` the next free slot is kept 
+    in Redis, so every worker process limiting the same key stays under NCBI's limit together 
+    rather than each on its own. If Redis is unreachable only this process's calls are spaced out 
+    until Redis is tried again after `NCBI_RATE_SHARED_RETRY_SECONDS`.
+    """
+    def __init__(self, rate, shared_key=None):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.shared_key = shared_key
+        self.retry_seconds = float(Config.NCBI_RATE_SHARED_RETRY_SECONDS)
+        self.shared_retry_at = 0
+
+    def local_delay(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        return slot - time.monotonic()
+
+    def shared_delay(self):
+        """
+        Seconds to wait for the next free slot in Redis, or None if there's no shared slot to take.
+        Wall-clock time, since the slot is compared across processes and machines.
+        """
+        if self.shared_key is None or time.time() < self.shared_retry_at:
+            return None
+        try:
+            with conn.pipeline() as pipe:
+                while True:
+                    try:
+                        pipe.watch(self.shared_key)
+                        now = time.time()
+                        slot = max(now, float(pipe.get(self.shared_key) or 0))
+                        pipe.multi()
+                        ### Expires a second after the slot it leaves free, an old slot is the same as none
+                        pipe.set(self.shared_key, repr(slot + self.interval), px=int((slot + self.interval - now + 1) * 1000))
+                        pipe.execute()
+                        return slot - time.time()
+                    except WatchError:
+                        continue
+        except Exception as err:
+            print(f'Shared NCBI rate limit unavailable, limiting this process only for {self.retry_seconds}s : {err}')
+            self.shared_retry_at = time.time() + self.retry_seconds
+            return None
+
+    def wait(self):
+        delay = self.shared_delay()
+        if delay is None:
+            delay = self.local_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(api_key):
+    """
+    Return the process-wide limiter for `api_key`.
+
+    NCBI allows 10 req/s with a key and 3 req/s without one, and the limit applies per key,
+    so jobs running under the same key share one limiter, and through Redis one slot across processes.
+    The key is hashed for the Redis key name.
+    """
+    with _rate_limiters_lock:
+        if api_key not in _rate_limiters:
+            if api_key:
+                rate = int(Config.NCBI_RATE_LIMIT_KEY)
+            else:
+                rate = int(Config.NCBI_RATE_LIMIT_NO_KEY)
+            shared_key = f"eutils:rate:{hashlib.sha1(api_key.encode('utf-8')).hexdigest()}"
+            _rate_limiters[api_key] = RateLimiter(rate, shared_key=shared_key)
+        return _rate_limiters[api_key]
+
+
+class EutilsClient(object):
+    """
+    Client for NCBI's E-utilities that every esearch/efetch call should go through.
+
+    Owns one pooled `requests.Session` (keep-alive, gzip), adds `api_key`/`tool`/`email` to every
+    request, waits on the per-key rate limiter and retries 429/5xx responses, timeouts and dropped
+    connections with jittered exponential backoff.
+
+    Per-request latency and byte counts are kept in `self.requests_log` and summarised by `stats()`.
+    """
+    base_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+    retry_statuses = {429, 500, 502, 503, 504}
+    ### What a dropped connection looks like while reading a body, through `requests` or straight off `resp.raw`
+    body_errors = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, http.client.IncompleteRead, 
+                    ConnectionError, socket.timeout)
+
+    def __init__(self, api_key="", tool=None, email=None, timeout=None, max_retries=None, pool_size=None):
+        self.api_key = api_key or ""
+        self.tool = tool or Config.EUTILS_TOOL
+        self.email = email or Config.EUTILS_EMAIL
+        self.timeout = float(timeout or Config.EUTILS_TIMEOUT)
+        self.max_retries = int(max_retries if max_retries is not None else Config.EUTILS_MAX_RETRIES)
+        self.backoff = float(Config.EUTILS_BACKOFF)
+        self.rate_limiter = get_rate_limiter(self.api_key)
+
+        pool_size = int(pool_size or Config.EFETCH_WORKERS)
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding' : 'gzip, deflate', 'Connection' : 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.stats_lock = threading.Lock()
+        self.requests_log = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def default_params(self):
+        params = {'tool' : self.tool}
+        if self.api_key:
+            params['api_key'] = self.api_key
+        if self.email:
+            params['email'] = self.email
+        return params
+
+    def backoff_delay(self, attempt, resp=None):
+        """
+        Full-jitter exponential backoff. A `Retry-After` header from NCBI wins if it is longer.
+        """
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        if resp is not None and resp.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, int(resp.headers['Retry-After']))
+        return delay
+
+    def request(self, utility, params, method='GET', stream=False):
+        """
+        Call `utility` (eg. 'esearch.fcgi') and return the `requests.Response`.
+
+        Large id lists should be sent with method='POST' so they go in the body rather than the URL.
+        With `stream=True` the body is left unread so it can be parsed as it arrives; pass the response
+        to `close_stream` once it has been consumed so its byte count is recorded.
+
+        Raises the last `requests` exception if every retry fails.
+        """
+        url = self.base_url + utility
+        all_params = {**self.default_params(), **params}
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            start = time.monotonic()
+            try:
+                if method == 'POST':
+                    resp = self.session.post(url, data=all_params, timeout=self.timeout, stream=stream)
+                else:
+                    resp = self.session.get(url, params=all_params, timeout=self.timeout, stream=stream)
+                ### Read the body here so a connection dropped halfway through it is retried too
+                if not stream and resp.status_code not in self.retry_statuses:
+                    resp.content
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, 
+                    requests.exceptions.ChunkedEncodingError) as err:
+                if attempt == self.max_retries:
+                    raise
+                print(f"E-utilities {utility} failed with {err!r}, retrying (attempt {attempt + 1} of {self.max_retries}).")
+                time.sleep(self.backoff_delay(attempt))
+                continue
+
+            if resp.status_code in self.retry_statuses and attempt < self.max_retries:
+                print(f"E-utilities {utility} returned {resp.status_code}, retrying (attempt {attempt + 1} of {self.max_retries}).")
+                resp.close()
+                time.sleep(self.backoff_delay(attempt, resp))
+                continue
+
+            resp.raise_for_status()
+            if stream:
+                n_bytes = 0
+            else:
+                n_bytes = len(resp.content)
+            resp.eutils_log_entry = self.record(utility, time.monotonic() - start, n_bytes, attempt)
+            return resp
+
+    def esearch(self, **params):
+        return self.request('esearch.fcgi', {'db' : 'pubmed', **params})
+
+    def efetch(self, method='GET', stream=False, **params):
+        return self.request('efetch.fcgi', {'db' : 'pubmed', **params}, method=method, stream=stream)
+
+    def efetch_parsed(self, parse, method='GET', **params):
+        """
+        efetch with the body handed to `parse` (a function of a file-like object) as it arrives.
+
+        The request and the parse are retried together : if the connection drops, times out or 
+        ends early while the body is being read, the whole request is sent again and parsed from 
+        the start, with the same backoff as `request`.
+
+        Returns whatever `parse` returns.
+        """
+        for attempt in range(self.max_retries + 1):
+            resp = self.efetch(method=method, stream=True, **params)
+            resp.raw.decode_content = True
+            try:
+                return parse(resp.raw)
+            except self.body_errors as err:
+                if attempt == self.max_retries:
+                    raise
+                print(f"E-utilities efetch.fcgi body failed with {err!r}, retrying (attempt {attempt + 1} of {self.max_retries}).")
+                time.sleep(self.backoff_delay(attempt))
+            finally:
+                self.close_stream(resp)
+
+    def close_stream(self, resp):
+        """
+        Close a `stream=True` response and record how many bytes came over the wire.
+        """
+        with self.stats_lock:
+            resp.eutils_log_entry['bytes'] = resp.raw.tell()
+        resp.close()
+
+    def record(self, utility, latency, n_bytes, retries):
+        entry = {'utility' : utility, 'latency' : latency, 'bytes' : n_bytes, 'retries' : retries}
+        with self.stats_lock:
+            self.requests_log.append(entry)
+        return entry
+
+    def stats(self):
+        """
+        Summary of every request made through this client.
+        """
+        with self.stats_lock:
+            latencies = sorted(entry['latency'] for entry in self.requests_log)
+            n_requests = len(latencies)
+            return {'requests' : n_requests,
+                    'retries' : sum(entry['retries'] for entry in self.requests_log),
+                    'bytes' : sum(entry['bytes'] for entry in self.requests_log),
+                    'total_latency' : round(sum(latencies), 4),
+                    'mean_latency' : round(sum(latencies) / n_requests, 4) if n_requests else 0,
+                    'max_latency' : round(latencies[-1], 4) if n_requests else 0}
@@ -0,0 +1,84 @@
+import math
+import numpy as np
+from config import Config
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    from fuzzywuzzy import fuzz
+    process = None
+
+
+def ngrams(text, n):
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+class AffiliationMatcher(object):
+    """
+    Fuzzy matches (preprocessed) affiliations against a fixed set of choices with `fuzz.partial_ratio`.
+
+    Choices are blocked on character trigrams so a query is only scored against choices that share 
+    enough trigrams for a score of `threshold` (0-100) to be possible: at most `2 * (1 - threshold / 100)` 
+    of the shorter string's length can be unmatched and each unmatched character breaks at most 3 of 
+    its trigrams. Shared trigrams are counted for every choice at once with numpy, and the remaining 
+    candidates are scored in one batched `rapidfuzz` call (pair by pair with `fuzzywuzzy` if rapidfuzz 
+    isn't installed).
+    """
+    n = 3
+
+    def __init__(self, choices, threshold=None):
+        self.threshold = float(threshold or Config.AFFIL_MATCH_THRESHOLD)
+        self.choices = list(dict.fromkeys(choice for choice in choices if isinstance(choice, str) and choice))
+        self.choice_lengths = np.array([len(choice) for choice in self.choices], dtype=np.int32)
+
+        ngram_index = {}
+        choice_min_shared = []
+        for i, choice in enumerate(self.choices):
+            choice_ngrams = ngrams(choice, self.n)
+            choice_min_shared.append(self.min_shared(choice, choice_ngrams))
+            for gram in choice_ngrams:
+                ngram_index.setdefault(gram, []).append(i)
+        self.ngram_index = {gram : np.array(choice_ids, dtype=np.int32) for gram, choice_ids in ngram_index.items()}
+        ### Choices too short to be blocked (min shared <= 0) are scored against every query
+        self.choice_min_shared = np.array(choice_min_shared, dtype=np.int32)
+
+    def min_shared(self, shorter, shorter_ngrams):
+        """
+        Fewest trigrams `shorter` can share with a string it scores `threshold` against.
+        """
+        max_unmatched = math.floor(2 * (1 - self.threshold / 100) * len(shorter))
+        return len(shorter_ngrams) - self.n * max_unmatched
+
+    def candidates(self, query):
+        """
+        Indexes of the choices that could score `threshold` against `query`.
+        """
+        query_ngrams = ngrams(query, self.n)
+        query_min_shared = self.min_shared(query, query_ngrams)
+        if query_min_shared <= 0:
+            return np.arange(len(self.choices))
+
+        postings = [self.ngram_index[gram] for gram in query_ngrams if gram in self.ngram_index]
+        if postings:
+            shared = np.bincount(np.concatenate(postings), minlength=len(self.choices))
+        else:
+            shared = np.zeros(len(self.choices), dtype=np.int64)
+        ### The bound comes from whichever string is shorter
+        min_shared = np.where(self.choice_lengths < len(query), self.choice_min_shared, query_min_shared)
+        return np.flatnonzero(shared >= min_shared)
+
+    def match(self, query):
+        """
+        Choices scoring at least `threshold` against `query`, in the order they were given.
+        """
+        if not isinstance(query, str) or not query:
+            return []
+        candidate_choices = [self.choices[i] for i in self.candidates(query)]
+        if not candidate_choices:
+            return []
+        if process is not None and hasattr(process, 'cdist'):
+            scores = process.cdist([query], candidate_choices, scorer=fuzz.partial_ratio, processor=None, 
+                                    score_cutoff=self.threshold, workers=-1)[0]
+        else:
+            scores = [fuzz.partial_ratio(query, choice) for choice in candidate_choices]
+        return [choice for choice, score in zip(candidate_choices, scores) if score >= self.threshold]
@@ -0,0 +1,74 @@
+import re
+from geotext import GeoText
+
+
+class Gazetteer(object):
+    """
+    GeoText's city/country gazetteer compiled once into a single lookup table, for geocoding 
+    affiliations in batches.
+
+    Output is exactly what `GeoText` gave `get_location` one affiliation at a time: the same 
+    candidate regex, but run once over the whole batch, and one dict lookup per candidate instead 
+    of GeoText's separate country, city and nationality passes.
+    """
+    ### GeoText's candidate pattern, eg. "Boston", "New York", "Rio de Janeiro"
+    candidate_regex = re.compile(r"[A-ZÀ-Ú]+[a-zà-ú]+[ \-]?(?:d[a-u].)?(?:[A-ZÀ-Ú]+[a-zà-ú]+)*")
+    separator = '\n\x00\n'
+    batch_regex = re.compile('\n\x00\n|' + candidate_regex.pattern)
+    COUNTRY = 1
+    CITY = 2
+
+    def __init__(self, index=None):
+        index = index or GeoText.index
+        ### Country names are never counted as cities, so countries overwrite cities
+        self.kinds = dict.fromkeys(index.cities, self.CITY)
+        self.kinds.update(dict.fromkeys(index.countries, self.COUNTRY))
+
+    def locations(self, affiliations):
+        """
+        `City, Country` string for each affiliation in `affiliations`, in order. 
+
+        If multiple cities are found, all are included. If no country is found it is left blank.
+        """
+        affiliations = list(affiliations)
+        if not affiliations:
+            return []
+
+        ### Candidates can't contain a newline, so one pass over the joined batch finds the same ones as 
+        ### a pass over each affiliation. The separator token marks where each affiliation ends; it can't 
+        ### occur inside one because XML doesn't allow NUL characters.
+        text = self.separator.join(affiliations) + self.separator
+        if text.count('\x00') != len(affiliations):
+            tokens = []
+            for affiliation in affiliations:
+                tokens += self.candidate_regex.findall(affiliation) + [self.separator]
+        else:
+            tokens = self.batch_regex.findall(text)
+
+        ### Most candidates ("Department", "University", ...) repeat across a batch, look each up once
+        token_kinds = {self.separator : (None, None)}
+        kinds = self.kinds
+        locations = []
+        cities = []
+        country_str = None
+        for token in tokens:
+            kind, candidate = token_kinds.get(token) or (False, None)
+            if kind is False:
+                candidate = token.strip()
+                kind = kinds.get(candidate.lower())
+                token_kinds[token] = (kind, candidate)
+
+            if kind == self.CITY:
+                if candidate != 'University':
+                    cities.append(candidate)
+            elif kind == self.COUNTRY:
+                if country_str is None:
+                    country_str = candidate
+            elif token == self.separator:
+                city_str = ' '.join(set(cities)).strip()
+                locations.append(f"{city_str}, {country_str or ''}")
+                cities = []
+                country_str = None
+        return locations
+
+gazetteer = Gazetteer()
@@ -0,0 +1,156 @@
+import re
+import time
+from config import Config
+
+
+### PubMed field tags the local index can answer, mapped to `articles_fts` columns
+FIELD_TAG_COLUMNS = {
+    'ti' : ['title'], 'title' : ['title'],
+    'ab' : ['abstract'], 'abstract' : ['abstract'],
+    'tiab' : ['title', 'abstract'], 'title/abstract' : ['title', 'abstract'],
+    'ad' : ['affiliations'], 'affiliation' : ['affiliations'], 'affl' : ['affiliations'],
+    'tw' : ['title', 'abstract', 'mesh'], 'text word' : ['title', 'abstract', 'mesh'],
+    'all fields' : ['title', 'abstract', 'mesh', 'authors', 'affiliations'], 'all' : ['title', 'abstract', 'mesh', 'authors', 'affiliations'],
+}
+
+### Field tags PubMed expands in ways a match on the stored text can't reproduce
+AUTHOR_PREFIX = 'PubMed matches author names by prefix'
+MESH_EXPANSION = 'PubMed includes MeSH entry terms and narrower headings'
+EXPANDED_FIELD_TAGS = {
+    'au' : AUTHOR_PREFIX, 'author' : AUTHOR_PREFIX, 'auth' : AUTHOR_PREFIX,
+    'mh' : MESH_EXPANSION, 'mesh' : MESH_EXPANSION, 'mesh terms' : MESH_EXPANSION, 'majr' : MESH_EXPANSION,
+}
+
+QUERY_TOKEN_REGEX = re.compile(r'"[^"]*"|\(|\)|\[[^\]]*\]|[^\s()"\[\]]+')
+
+
+class UnsupportedQuery(Exception):
+    """
+    The query uses PubMed syntax the local index can't evaluate (eg. a [dp] or [pt] tag).
+    """
+    pass
+
+
+def phrase_expression(words, tag=None, phrase=False):
+    """
+    FTS5 expression for consecutive `words`, restricted to the columns for PubMed field `tag`.
+    Tagged terms and quoted (`phrase`) terms have to match as a phrase.
+    """
+    if tag is not None and tag.lower() in EXPANDED_FIELD_TAGS:
+        raise UnsupportedQuery(f'Field tag [{tag}] can\'t be matched locally, {EXPANDED_FIELD_TAGS[tag.lower()]}')
+    if tag is not None and tag.lower() not in FIELD_TAG_COLUMNS:
+        raise UnsupportedQuery(f'Field tag [{tag}] is not in the local index')
+
+    prefix = words[-1].endswith('*')
+    words = [re.sub(r'[^\w\-\']', ' ', word).replace('"', '') for word in words]
+    text = ' '.join(' '.join(words).split())
+    if not text:
+        return ''
+    if tag is None and not phrase:
+        ### Untagged words are ANDed wherever they appear, like PubMed's default
+        terms = [f'"{word}"' for word in text.split()]
+        if prefix:
+            terms[-1] += ' *'
+        if len(terms) == 1:
+            return terms[0]
+        return '(' + ' AND '.join(terms) + ')'
+    expression = f'"{text}"' + (' *' if prefix else '')
+    if tag is None:
+        return expression
+    columns = FIELD_TAG_COLUMNS[tag.lower()]
+    return '{' + ' '.join(columns) + '} : ' + f'({expression})'
+
+
+def pubmed_query_to_fts(query):
+    """
+    Translate a PubMed query into an FTS5 MATCH expression for `articles_fts`.
+
+    Supports AND/OR/NOT, parentheses, quoted phrases, trailing `*` wildcards and the field tags in 
+    `FIELD_TAG_COLUMNS`. Raises `UnsupportedQuery` for anything else so the caller can fall back to esearch, 
+    including the tags in `EXPANDED_FIELD_TAGS` and lowercase operators, which PubMed searches as terms.
+    """
+    tokens = QUERY_TOKEN_REGEX.findall(query)
+    parts = []
+    words = []
+    quoted = []
+
+    def flush(tag=None):
+        if words:
+            expression = phrase_expression(words, tag, phrase=bool(quoted))
+            if expression:
+                if parts and parts[-1] not in ('AND', 'OR', 'NOT', '('):
+                    parts.append('AND')
+                parts.append(expression)
+            del words[:]
+        del quoted[:]
+
+    for token in tokens:
+        ### A quoted phrase is one term unless a field tag follows it
+        if quoted and not token.startswith('['):
+            flush()
+        if token.lower() in ('and', 'or', 'not') and token not in ('AND', 'OR', 'NOT'):
+            raise UnsupportedQuery(f'"{token}" is a search term to PubMed, not an operator')
+        if token in ('AND', 'OR', 'NOT'):
+            flush()
+            parts.append(token)
+        elif token in ('(', ')'):
+            flush()
+            if token == '(' and parts and parts[-1] not in ('AND', 'OR', 'NOT', '('):
+                parts.append('AND')
+            parts.append(token)
+        elif token.startswith('['):
+            if not words:
+                raise UnsupportedQuery(f'Field tag {token} has no term')
+            flush(token[1:-1].strip())
+        elif token.startswith('"'):
+            flush()
+            if token[1:-1].strip():
+                words.append(token[1:-1])
+                quoted.append(token)
+        else:
+            words.append(token)
+    flush()
+
+    fts_query = ' '.join(parts).replace('( ', '(').replace(' )', ')')
+    if not fts_query:
+        raise UnsupportedQuery('Empty query')
+    return fts_query
+
+
+def use_local_index(store, min_date=""):
+    """
+    Whether `get_article_ids` should answer from the local index, per `QUERY_BACKEND`:
+    - 'remote' (default) : always esearch
+    - 'local' : always the local index
+    - 'auto' : the local index once a baseline has been ingested, esearch otherwise
+    Searches restricted by entry date (`min_date`) always go to esearch; the local index has no entry dates.
+    """
+    backend = Config.QUERY_BACKEND
+    if min_date or backend == 'remote':
+        return False
+    if backend == 'local':
+        return True
+    return store.has_baseline()
+
+
+def search_local(store, query, from_year=""):
+    """
+    Matching PMIDs from the local index, or None if the query can't be evaluated locally 
+    or matches nothing, so the caller should fall back to esearch.
+    """
+    start = time.time()
+    try:
+        fts_query = pubmed_query_to_fts(query)
+        pmids = store.search(fts_query, from_year = from_year)
+    except UnsupportedQuery as err:
+        print(f'Query for "{query}" can\'t be answered locally ({err}). Falling back to esearch.')
+        return None
+    except Exception as err:
+        ### sqlite raises OperationalError for FTS5 syntax the translation didn't anticipate
+        print(f'Local search for "{query}" failed ({err}). Falling back to esearch.')
+        return None
+    print(f'Local search for "{query}" as `{fts_query}` found {len(pmids)} articles in {round(time.time() - start, 4)} seconds.')
+    if not pmids:
+        print(f'Nothing local matched "{query}". Falling back to esearch.')
+        return None
+    return pmids
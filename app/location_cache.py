@@ -0,0 +1,177 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+from worker import conn
+
+
+class LocationCache(object):
+    """
+    Two-tier cache of `get_location` results keyed by a hash of the affiliation text.
+
+    - An in-process LRU of up to `max_size` affiliations.
+    - Redis hashes shared by every worker and web process, so institutions geocoded by one query 
+        are free for the next. Entries are written to the current generation's hash (a new one every 
+        `LOCATION_SHARED_DAYS`), and entries read from the previous generation are copied forward. 
+        Each hash expires two generations after it was last written and stops taking new entries 
+        past `LOCATION_SHARED_MAX`, so what Redis holds stays bounded.
+    - If Redis is unreachable the cache carries on with the LRU alone and tries Redis again 
+        after `LOCATION_SHARED_RETRY_SECONDS`.
+
+    `stats()` reports hits per tier and misses (affiliations that had to go through GeoText).
+    """
+    ### Bump the version if `get_location`'s output changes so stale locations aren't served
+    redis_key = 'geo:v1'
+
+    def __init__(self, max_size=None):
+        self.max_size = int(max_size or Config.LOCATION_CACHE_SIZE)
+        self.generation_seconds = float(Config.LOCATION_SHARED_DAYS) * 24 * 60 * 60
+        self.shared_max = int(Config.LOCATION_SHARED_MAX)
+        self.retry_seconds = float(Config.LOCATION_SHARED_RETRY_SECONDS)
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.shared_retry_at = 0
+        self.counts = {'local_hits' : 0, 'shared_hits' : 0, 'misses' : 0}
+
+    @staticmethod
+    def affiliation_key(affiliation):
+        return hashlib.sha1(affiliation.encode('utf-8')).hexdigest()
+
+    def generation_keys(self):
+        """
+        (current, previous) generation hash keys.
+        """
+        generation = int(time.time() // self.generation_seconds)
+        return f'{self.redis_key}:{generation}', f'{self.redis_key}:{generation - 1}'
+
+    def get_local(self, key):
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                self.counts['local_hits'] += 1
+                return self.lru[key]
+        return None
+
+    def set_local(self, key, location):
+        with self.lock:
+            self.lru[key] = location
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.max_size:
+                self.lru.popitem(last=False)
+
+    def shared_call(self, func, *args):
+        if time.time() < self.shared_retry_at:
+            return None
+        try:
+            return func(*args)
+        except Exception as err:
+            print(f'Shared location cache unavailable, using the in-process cache only for {self.retry_seconds}s : {err}')
+            self.shared_retry_at = time.time() + self.retry_seconds
+            return None
+
+    def shared_get_many(self, keys):
+        """
+        {key : location} for the `keys` found in the current or previous generation.
+        """
+        current_key, previous_key = self.generation_keys()
+        locations = self.shared_call(conn.hmget, current_key, keys) or [None] * len(keys)
+        found = {key : location.decode('utf-8') for key, location in zip(keys, locations) if location is not None}
+        missing = [key for key in keys if key not in found]
+        if missing:
+            locations = self.shared_call(conn.hmget, previous_key, missing) or [None] * len(missing)
+            carried = {key : location.decode('utf-8') for key, location in zip(missing, locations) if location is not None}
+            if carried:
+                ### Still in use, keep it past the previous generation's expiry
+                self.shared_set_many(carried)
+                found.update(carried)
+        return found
+
+    def shared_set_many(self, locations):
+        """
+        Write {key : location} to the current generation, unless it's full.
+        """
+        current_key, _ = self.generation_keys()
+        def write():
+            if conn.hlen(current_key) >= self.shared_max:
+                return
+            with conn.pipeline() as pipe:
+                pipe.hset(current_key, None, None, locations)
+                pipe.expire(current_key, int(2 * self.generation_seconds))
+                pipe.execute()
+        self.shared_call(write)
+
+    def get(self, affiliation, geocode):
+        """
+        Location for `affiliation`, calling `geocode(affiliation)` only if neither tier has it.
+        """
+        key = self.affiliation_key(affiliation)
+        location = self.get_local(key)
+        if location is not None:
+            return location
+
+        location = self.shared_get_many([key]).get(key)
+        if location is not None:
+            with self.lock:
+                self.counts['shared_hits'] += 1
+        else:
+            location = geocode(affiliation)
+            with self.lock:
+                self.counts['misses'] += 1
+            self.shared_set_many({key : location})
+        self.set_local(key, location)
+        return location
+
+    def get_many(self, affiliations, geocode_many):
+        """
+        Locations for every affiliation in `affiliations`, in order. 
+        
+        Everything missing from the local tier is looked up in Redis with one round trip, whatever 
+        is still missing goes through `geocode_many(list_of_affiliations)` in one batch and is 
+        written back with one more round trip.
+        """
+        affiliations = list(affiliations)
+        keys = [self.affiliation_key(affiliation) for affiliation in affiliations]
+        found = {}
+        missing = {}
+        for affiliation, key in zip(affiliations, keys):
+            if key in found or key in missing:
+                continue
+            location = self.get_local(key)
+            if location is not None:
+                found[key] = location
+            else:
+                missing[key] = affiliation
+
+        if missing:
+            missing_keys = list(missing)
+            shared_locations = self.shared_get_many(missing_keys)
+            to_geocode = []
+            for key in missing_keys:
+                if key in shared_locations:
+                    found[key] = shared_locations[key]
+                    self.set_local(key, found[key])
+                else:
+                    to_geocode.append(key)
+            with self.lock:
+                self.counts['shared_hits'] += len(missing_keys) - len(to_geocode)
+                self.counts['misses'] += len(to_geocode)
+
+            if to_geocode:
+                new_locations = dict(zip(to_geocode, geocode_many([missing[key] for key in to_geocode])))
+                for key, location in new_locations.items():
+                    found[key] = location
+                    self.set_local(key, location)
+                self.shared_set_many(new_locations)
+        return [found[key] for key in keys]
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.counts.values())
+            return {**self.counts, 
+                    'lookups' : lookups,
+                    'hit_rate' : round((self.counts['local_hits'] + self.counts['shared_hits']) / lookups, 4) if lookups else 0,
+                    'local_size' : len(self.lru)}
+
+
+location_cache = LocationCache()
@@ -68,3 +68,8 @@ class authorIndexQueryForm(FlaskForm):
     locations = StringField('Relevant Locations')
     api_key = StringField('PubMed API Key', validators=[DataRequired()])
     submit = SubmitField('Query')
+
+
+class RefreshResultForm(FlaskForm):
+    api_key = StringField('PubMed API Key', validators=[DataRequired()])
+    submit = SubmitField('Refresh')
@@ -1,15 +1,21 @@
 from app import db
 from app.main.forms import LoginForm, RegistrationForm, EditProfileForm, \
-    ResetPasswordRequestForm, ResetPasswordForm, authorIndexQueryForm
+    ResetPasswordRequestForm, ResetPasswordForm, authorIndexQueryForm, RefreshResultForm
 from app.models import User, Result
+from app.result_store import save_result_output, load_result_output, result_totals
 from app.email import send_password_reset_email
+from app.progress import report_progress, job_progress
+from app.singleflight import flight_key, enqueue_once, release_flight
 from app.main import bp
 from config import Config
 
 from app.main_api_functions import *
 from rq.job import Job
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
 from datetime import datetime, timezone
-from flask import render_template, flash, redirect, url_for, request, jsonify,current_app
+from flask import render_template, flash, redirect, url_for, request, jsonify,current_app, \
+    Response, stream_with_context, has_request_context, json
 from flask_login import login_user, logout_user, current_user, login_required
 from config import Config
 from werkzeug.urls import url_parse
@@ -65,6 +71,9 @@ def run_query(query_type, query_text, \
     querying_user):
     """
     Query data is returned in a nested dictionary and assigned to `obj_dicts` which is stored in the db.
+
+    Identical submissions made while this runs wait on this job (see `app.singleflight`), 
+    its claim is released once the `Result` is stored or the query fails.
     """
     ### Import create_app because this function is run by the worker
     from app import create_app
@@ -73,6 +82,15 @@ def run_query(query_type, query_text, \
     app = create_app()
     app.app_context().push()
 
+    job = get_current_job()
+    try:
+        return run_query_job(query_type, query_text, from_year, locations, affils, api_key, querying_user)
+    finally:
+        if job is not None:
+            release_flight(flight_key(query_type, query_text, from_year, locations, affils), job.get_id())
+
+
+def run_query_job(query_type, query_text, from_year, locations, affils, api_key, querying_user):
     if query_type == 'author_papers':
         obj_dicts = query_author_papers(query = query_text, 
                                         from_year = from_year,
@@ -90,17 +108,71 @@ def run_query(query_type, query_text, \
                                         api_key = api_key,
                                         api_out = False)
 
+    report_progress('storing')
+    result_id = store_result(query_type, query_text, from_year, locations, affils, querying_user, obj_dicts).id
+    report_progress('finished', result_id=result_id)
+    return result_id
+
+
+def store_result(query_type, query_text, from_year, locations, affils, querying_user, obj_dicts):
+    """
+    Save a query's output as a new `Result`.
+    """
     result = Result(
         query_type = query_type,
         query_text = query_text, 
         query_from = from_year,
         query_affiliations = affils, 
         query_locations= locations,
-        user_querying = querying_user,
-        length_of_results = len(obj_dicts.keys()),
-        result_all=obj_dicts
+        user_querying = querying_user
     )
-    db.session.add(result)
+    save_result_output(db.session, result, obj_dicts)
+    db.session.commit()
+    return result
+
+
+def refresh_result(result_id, api_key):
+    """
+    Fetch only the papers added to PubMed since `result_id` was created or last refreshed 
+    and merge them into its stored output.
+    """
+    ### Import create_app because this function is run by the worker
+    from app import create_app
+    from app.models import Result
+
+    app = create_app()
+    app.app_context().push()
+
+    result = Result.query.get(result_id)
+    since = result.refreshed_at or result.timestamp
+    if since is None:
+        raise ValueError(f'Result {result_id} has no timestamp to refresh from.')
+    refreshed_at = datetime.datetime.utcnow()
+    min_date = since.strftime('%Y/%m/%d')
+
+    if result.query_type == 'author_papers':
+        query_func = query_author_papers
+    elif result.query_type == 'affil_papers':
+        query_func = query_affil_papers
+    query_args = {'query' : result.query_text, 
+                'from_year' : result.query_from,
+                'locations' : result.query_locations, 
+                'n_authors' : 25, 
+                'affils' : result.query_affiliations, 
+                'api_key' : api_key,
+                'api_out' : False}
+    new_obj_dicts = query_func(**query_args, min_date = min_date)
+
+    old_obj_dicts = load_result_output(db.session, result)
+    full_obj_dicts = None
+    if not new_obj_dicts.get('error') and not old_obj_dicts.get('error') and set(new_obj_dicts) - set(old_obj_dicts):
+        ### Authors/affiliations new to the result need their papers from before `min_date` too.
+        ### The articles fetched for the stored result are usually still in the article store, so this is mostly esearch
+        full_obj_dicts = query_func(**query_args)
+
+    obj_dicts = merge_out_dicts(old_obj_dicts, new_obj_dicts, result.query_type, full_obj_dicts)
+    save_result_output(db.session, result, obj_dicts)
+    result.refreshed_at = refreshed_at
     db.session.commit()
     return result.id
 
@@ -123,55 +195,114 @@ def make_a_query(query_type):
         if current_app.config['ASYNC_FUNC']:
             from app.main.routes import run_query
 
-            ### If async == True, queue a task with the args from the form
-            job = current_app.task_queue.enqueue_call(
-                func=run_query, 
-                args=(query_type, 
-                    form.query_text.data, form.query_from.data, 
-                    form.locations.data, form.affiliations.data, 
-                    form.api_key.data, current_user.username), 
-                result_ttl=current_app.config['RESULT_TTL'],
-                timeout=current_app.config['WORKER_TIMEOUT'])
-            flash(f'Your query is running! Your ID is : {job.get_id()}')
+            ### If async == True, queue a task with the args from the form.
+            ### The same query already queued or running is waited on instead of being run twice
+            def enqueue(job_id):
+                return current_app.task_queue.enqueue_call(
+                    func=run_query, 
+                    args=(query_type, 
+                        form.query_text.data, form.query_from.data, 
+                        form.locations.data, form.affiliations.data, 
+                        form.api_key.data, current_user.username), 
+                    result_ttl=current_app.config['RESULT_TTL'],
+                    timeout=current_app.config['WORKER_TIMEOUT'],
+                    job_id=job_id)
+            job, coalesced = enqueue_once(flight_key(query_type, form.query_text.data, form.query_from.data, 
+                                                    form.locations.data, form.affiliations.data), enqueue)
+            if coalesced:
+                flash(f'The same query is already running, you\'ll get its results! Your ID is : {job.get_id()}')
+            else:
+                flash(f'Your query is running! Your ID is : {job.get_id()}')
             return get_results(job.get_id())
 
 
 
         elif not current_app.config['ASYNC_FUNC']:
-            ### Run the query without task queue if async == False
+            ### Run the query without task queue if async == False, 
+            ### the output is stored like a queued query's so the results tables can page through it
             if query_type == 'affil_papers':
-                affil_dicts = query_affil_papers(query = form.query_text.data, 
-                                        from_year = form.query_from.data,
-                                        locations = form.locations.data, 
-                                        n_authors = 25, 
-                                        affils = form.affiliations.data, 
-                                        api_key = form.api_key.data,
-                                        api_out = False)
-                n_results = sum([affil_dict['total_count'] for affil_dict in \
-                            affil_dicts.values()])
-                length_of_results = len(affil_dicts.keys())
-
-                return render_template('query_results/affil_papers.html', \
-                    data = affil_dicts, n_results = n_results, unique_results = length_of_results), 200
-            
+                query_func = query_affil_papers
             elif query_type == 'author_papers':
-                author_dicts = query_author_papers(query = form.query_text.data, 
-                                        from_year = form.query_from.data,
-                                        locations = form.locations.data, 
-                                        n_authors = 25, 
-                                        affils = form.affiliations.data, 
-                                        api_key = form.api_key.data,
-                                        api_out = False)
-                n_results = sum([author_dict.get('total_count', 0) for author_dict in \
-                            author_dicts.values()])
+                query_func = query_author_papers
+            obj_dicts = query_func(query = form.query_text.data, 
+                                    from_year = form.query_from.data,
+                                    locations = form.locations.data, 
+                                    n_authors = 25, 
+                                    affils = form.affiliations.data, 
+                                    api_key = form.api_key.data,
+                                    api_out = False)
+            result = store_result(query_type, form.query_text.data, form.query_from.data, 
+                                form.locations.data, form.affiliations.data, current_user.username, obj_dicts)
+            return render_result(result)
+    return render_template('make_a_query.html', form=form)
 
-                length_of_results = len(author_dicts.keys())
 
 
-                return render_template('query_results/author_papers.html', \
-                    data = author_dicts, n_results = n_results, unique_results = length_of_results), 200 
-    return render_template('make_a_query.html', form=form)
+@bp.route('/results/<int:result_id>/refresh', methods=['GET', 'POST'])
+@login_required
+def refresh_a_result(result_id):
+    """
+    Re-run a stored result's query for papers added since it was created and merge them in.
+    """
+    result = Result.query.get_or_404(result_id)
+    if result.user_querying != current_user.username:
+        flash('Only the user who made a result can refresh it.')
+        return redirect(url_for('main.view_result', result_id = result.id))
+    ### Results stored before timestamps were recorded don't know what "new" is, refreshing 
+    ### them would download the whole query again
+    if not (result.refreshed_at or result.timestamp):
+        flash('This result was made before refreshing was possible, run its query again instead.')
+        return redirect(url_for('main.view_result', result_id = result.id))
+    form = RefreshResultForm()
 
+    if form.validate_on_submit():
+        if current_app.config['ASYNC_FUNC']:
+            job = current_app.task_queue.enqueue_call(
+                func=refresh_result, 
+                args=(result.id, form.api_key.data), 
+                result_ttl=current_app.config['RESULT_TTL'],
+                timeout=current_app.config['WORKER_TIMEOUT'])
+            flash(f'Your result is refreshing! Your ID is : {job.get_id()}')
+            return get_results(job.get_id())
+
+        refresh_result(result.id, form.api_key.data)
+        return render_result(Result.query.get(result.id))
+    return render_template('refresh_result.html', form=form, result=result)
+
+
+def render_result(result):
+    """
+    Render a stored result's page. Its tables load their rows from the `/api/results/<id>/entities` 
+    endpoints one page at a time, so only the totals are read here.
+    """
+    n_entities, n_results = result_totals(db.session, result.id)
+    if not n_entities:
+        error = (result.result_all or {}).get('error', 'no results for this query')
+        return render_template('errors/data_error.html', data = error, 
+                query_text = result.query_text, query_from = result.query_from , 
+                query_location =  result.query_locations, query_affiliations = result.query_affiliations)
+
+    can_refresh = current_user.is_authenticated and current_user.username == result.user_querying \
+        and bool(result.refreshed_at or result.timestamp)
+
+    ### Return different pages for different queries
+    if result.query_type == 'affil_papers':
+        return render_template('query_results/affil_papers.html', \
+            n_results = n_results, unique_results = n_entities, result_id = result.id, can_refresh = can_refresh, 
+            per_page = current_app.config['RESULTS_PER_PAGE']), 200
+    
+    elif result.query_type == 'author_papers':
+        return render_template('query_results/author_papers.html', \
+            n_results = n_results, unique_results = n_entities, result_id = result.id, can_refresh = can_refresh, 
+            per_page = current_app.config['RESULTS_PER_PAGE']), 200 
+
+
+@bp.route("/results/id/<int:result_id>", methods=['GET'])
+def view_result(result_id):
+    """
+    A stored result's page.
+    """
+    return render_result(Result.query.get_or_404(result_id))
 
 
 @bp.route("/results/<job_key>", methods=['GET'])
@@ -187,26 +318,30 @@ def get_results(job_key):
     ### Return results 
     if job.is_finished and job.result:
         result = Result.query.filter_by(id=job.result).first()
-        if result.result_all.get('error'):
-
-            return render_template('errors/data_error.html', data = result.result_all.get('error'), 
-                    query_text = result.query_text, query_from = result.query_from , 
-                    query_location =  result.query_locations, query_affiliations = result.query_affiliations)
-
-        n_results = sum([author_dict.get('total_count', 0) for author_dict in \
-            result.result_all.values()])
-
-        ### Return different pages for different queries
-        if result.query_type == 'affil_papers':
-            return render_template('query_results/affil_papers.html', \
-                data = result.result_all, n_results = n_results, unique_results = result.length_of_results), 200
-        
-        elif result.query_type == 'author_papers':
-            return render_template('query_results/author_papers.html', \
-                data = result.result_all, n_results = n_results, unique_results = result.length_of_results), 200 
+        return render_result(result)
     ### Refresh if job is still processing
     else:
-        return render_template('query_results/processing.html', job_key = job_key), 202
+        return render_template('query_results/processing.html', job_key = job_key, 
+                                poll_seconds = float(current_app.config['PROGRESS_POLL_SECONDS'])), 202
+
+
+@bp.route("/results/<job_key>/progress", methods=['GET'])
+def job_progress_snapshot(job_key):
+    """
+    JSON snapshot of a queued query's progress, polled by the processing page : the stage, count and 
+    chunks `run_query` last reported (see `app.progress`), plus `url` once it's finished or `error` if it stopped.
+
+    It's one read of the job's hash, so polling doesn't hold a web worker the way a stream would.
+    """
+    try:
+        progress = job_progress(Job.fetch(job_key, connection=current_app.redis))
+    except NoSuchJobError:
+        return jsonify({'status' : 'missing', 'error' : f'No query {job_key}, it may have expired.'}), 404
+    if progress['status'] == 'finished':
+        progress['url'] = url_for('main.get_results', job_key = job_key)
+    elif progress['status'] in ('failed', 'stopped', 'canceled'):
+        progress['error'] = f'Query stopped while {progress.get("stage", "queued")}.'
+    return jsonify(progress)
 
 
 
@@ -219,15 +354,52 @@ def help():
     return {'endpoints' : {'/api/query/author_affils/' : {'parameters' : 
                                                 {'query' : '', 'from' : '', 'locations' : '', 'n' : ''}, 'info' : ''},
                             '/api/query/author_papers/' : {'parameters' : 
-                                                {'query' : '', 'from' : '', 'locations' : '', 'n' : ''}, 'info' : ''}
+                                                {'query' : '', 'from' : '', 'locations' : '', 'n' : '', 'format' : 'json or ndjson'}, 
+                                                'info' : 'format=ndjson streams a header line, a line per finished stage, a summary line, one line per author and a footer line'},
+                            '/api/query/affil_papers/' : {'parameters' : 
+                                                {'query' : '', 'from' : '', 'locations' : '', 'n' : '', 'format' : 'json or ndjson'}, 
+                                                'info' : 'format=ndjson streams a header line, a line per finished stage, a summary line, one line per affiliation and a footer line'}
                         },
             'general_notes' : 'chris smells'}
 
 
+def api_query_args(endpoint, **defaults):
+    """
+    Query arguments of a GET to `endpoint` : `query`, `from`, `locations`, `n`, `affiliations`, `api_key`, 
+    `min_date` and `format=ndjson` (or an `Accept: application/x-ndjson` header) to stream the output.
+    Arguments missing from the request, or every argument when the view is called directly 
+    (by `run_query`, `refresh_result` or `make_a_query`), keep their `defaults`.
+    """
+    if not has_request_context() or request.endpoint != endpoint:
+        return defaults
+    args = request.args
+    stream = args.get('format') == 'ndjson' or \
+                request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+    return {'query' : args.get('query', defaults['query']), 
+            'from_year' : args.get('from', defaults['from_year']), 
+            'locations' : args.get('locations', defaults['locations']), 
+            'n_authors' : args.get('n', defaults['n_authors']), 
+            'affils' : args.get('affiliations', defaults['affils']), 
+            'api_key' : args.get('api_key', defaults['api_key']), 
+            'min_date' : args.get('min_date', defaults['min_date']), 
+            'stream' : stream or defaults['stream']}
+
+
+def ndjson_response(records):
+    """
+    Stream `records` (a generator of dicts, or a single error dict) as newline-delimited JSON,
+    serializing each one only when the client is ready for it.
+    """
+    if isinstance(records, dict):
+        records = [records]
+    return Response(stream_with_context(json.dumps(record) + '\n' for record in records), 
+                    mimetype='application/x-ndjson')
+
+
 @bp.route('/api/query/author_papers/', methods = ['GET'])
 def query_author_papers(query = "", from_year = "", 
                     locations = "", n_authors = "", 
-                    affils = "", api_key = "", api_out = True):
+                    affils = "", api_key = "", api_out = True, min_date = "", stream = False):
 
     timeit_start = time.time()
     """if request.args.get('query'): 
@@ -244,6 +416,9 @@ def query_author_papers(query = "", from_year = "",
                     api_key = request.args.get('api_key')
                 if request.args.get('api_out'):
                     api_out = request.args.get('api_out')"""
+    args = api_query_args('main.query_author_papers', query = query, from_year = from_year, locations = locations, 
+                        n_authors = n_authors, affils = affils, api_key = api_key, min_date = min_date, stream = stream)
+    query, from_year, locations, n_authors, affils, api_key, min_date, stream = args.values()
 
     if locations:
         locations = [location.strip().lower() for location in locations.split(',')]
@@ -253,12 +428,17 @@ def query_author_papers(query = "", from_year = "",
 
     if not api_key:
         no_key_dict = {'error' : 'Please supply an API key to run your query under!'}
-        if api_out == True:
+        if stream:
+            return ndjson_response(no_key_dict)
+        elif api_out == True:
             return jsonify(no_key_dict)
         else:
             return no_key_dict 
 
-    out_dict = query_author_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key)
+    if stream:
+        return ndjson_response(query_author_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key, min_date, stream = True))
+
+    out_dict = query_author_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key, min_date)
 
     timeit_end = time.time()
     print(f'`query_author_papers` for "{query}" from {from_year} onward ran in {round(timeit_end - timeit_start,4)} seconds. Returning results.')
@@ -275,7 +455,8 @@ def query_affil_papers(query = "",
                     n_authors = "",
                     affils = "", 
                     api_key = "",
-                    api_out = True):
+                    api_out = True,
+                    min_date = "", stream = False):
     timeit_start = time.time()
     #if request.args.get('query'): 
     #    query = request.args.get('query')
@@ -289,6 +470,9 @@ def query_affil_papers(query = "",
     #    affils = request.args.get('affiliations', [])
     #if request.args.get('api_key'):
     #    api_key = request.args.get('api_key')
+    args = api_query_args('main.query_affil_papers', query = query, from_year = from_year, locations = locations, 
+                        n_authors = n_authors, affils = affils, api_key = api_key, min_date = min_date, stream = stream)
+    query, from_year, locations, n_authors, affils, api_key, min_date, stream = args.values()
 
     if locations:
         locations = [location.strip().lower() for location in locations.split(',')]
@@ -298,12 +482,17 @@ def query_affil_papers(query = "",
 
     if not api_key:
         no_key_dict = {'error' : 'Please supply an API key to run your query under!'}
-        if api_out == True:
+        if stream:
+            return ndjson_response(no_key_dict)
+        elif api_out == True:
             return jsonify(no_key_dict)
         else:
             return no_key_dict 
 
-    out_dict = query_affil_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key)
+    if stream:
+        return ndjson_response(query_affil_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key, min_date, stream = True))
+
+    out_dict = query_affil_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key, min_date)
 
     timeit_end = time.time()
     #print(f'`author_papers_w_location` for "{query}" from {from_year} onward ran in {round(timeit_end - timeit_start,4)} seconds. Returning results.')
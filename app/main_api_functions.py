@@ -1,64 +1,136 @@
 from app.util_functions import *
 from app.pubmed_scraper_parser import get_article_ids, query_to_paa_index
+from app.progress import report_progress
 from config import Config
 from flask import jsonify
 import itertools
 
 
-def query_author_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key):
+def stage_record(stage, timings, timeit_start):
+    """
+    Note that `stage` finished in `timings` and return its stream record.
+    """
+    timings[stage] = time.time() - timeit_start
+    return {'record' : 'stage', 'stage' : stage, 'seconds' : round(timings[stage], 4)}
+
+
+def run_stages(stages):
+    """
+    Run a `*_papers_stages` generator to the end and return what it returns, dropping its stage records.
+    """
+    while True:
+        try:
+            next(stages)
+        except StopIteration as done:
+            return done.value
+
+
+def stream_records(query_type, query, stages, obj_key, timeit_start):
+    """
+    Records of a streamed query, each sent as its own NDJSON line as soon as it's ready :
     
+    {'record' : 'header', 'query_type', 'query'} straight away
+    {'record' : 'stage', 'stage', 'seconds'} as each stage of `stages` finishes
+    {'record' : 'error', 'error'} if the query failed, and nothing after it
+    then the records of `query_records`
+    """
+    yield {'record' : 'header', 'query_type' : query_type, 'query' : query}
+    output = yield from stages
+    if isinstance(output, dict):
+        yield {'record' : 'error', **output}
+        return
+    papers_data, top_obj_dicts, big_df, timings = output
+    if not top_obj_dicts:
+        yield {'record' : 'error', **create_out_dict_obj_index(top_obj_dicts, big_df, obj_key)}
+        return
+    yield from query_records(query_type, query, papers_data, top_obj_dicts, big_df, obj_key, timeit_start, timings)
+
+
+def author_papers_stages(query, from_year, locations, affils, timeit_start, api_key, min_date = ""):
+    """
+    Generator running the author view's stages, yielding a `stage_record` as each one finishes.
+
+    Returns an error dictionary, or (papers_data, top authors, big_df, timings) for `create_out_dict_obj_index`.
+    """
     papers_data, paper_author_affil_mapping = query_to_paa_index(query = query, from_year = from_year, 
-                                                    locations = locations, affils = affils,
+                                                    locations = locations, affils = affils, min_date = min_date,
                                                     api_key = api_key, timeit_start=timeit_start)
 
     if papers_data[0].get('error'):
         return papers_data[0]
+    timings = {}
+    yield stage_record('papers_fetched', timings, timeit_start)
+    report_progress('grouping')
 
     affiliations_by_author, top_authors = group_papers_by_top_obj(paa_cross_mapping=paper_author_affil_mapping, 
                                                                 n_affiliations = 5, obj_key = 'author_string')
+    yield stage_record('top_objects_found', timings, timeit_start)
+    report_progress('matching')
     """
     Get papers for top 25 authors
-    Each element of contained in `paper_top_author_dict` looks like :
-    {author_of_interest : {
-        'author' : author_of_interest, 
+    Each row of the returned DataFrame looks like :
+    {
+        'join_obj' : obj_of_interest, 
+        'raw_join_obj' : obj_of_interest before preprocessing, 
         'title' : matchedPaper['title'], 
         'pubdate' : matchedPaper['pubdate'], 
         'link' : matchedPaper['link'], 
         'pmid' : matchedPaper['pmid'],
-        'pubtype_list' : ",".join(matchedPaper['pub_type_list']),
+        'pubtype_list' : list(matchedPaper['pub_type_list']),
         'all_authors_list' : ",".join([author_affil[0][2] + ', ' + author_affil[0][0] for author_affil in matchedPaper['author_list']]), 
         'mesh_keywords' : list(matchedPaper['mesh_keywords'].keys()),
-        'other_ids' : ",".join(matchedPaper['other_ids'].values())}
+        'other_ids' : ",".join(matchedPaper['other_ids'].values())
     }
     """
-    paper_top_author_dict = get_top_obj_papers(top_objs = top_authors, obj_key = 'author_string',
+    paper_top_author_df = get_top_obj_papers(top_objs = top_authors, obj_key = 'author_string',
                             authors_affils=paper_author_affil_mapping, papers_data=papers_data)
+    yield stage_record('papers_matched', timings, timeit_start)
 
     print(f"Matched papers found in {round(time.time() - timeit_start, 4)} seconds.")
 
-    paper_top_author_df = pd.DataFrame(paper_top_author_dict).T
-    affiliations_df = pd.DataFrame([{'author': author_affil_dict['author_string'], 
-                                    'pmid' : author_affil_dict['pmid'],
-                                    'location' : author_affil_dict['locations'],
-                                    'affiliation' : author_affil_dict['affiliations']} for \
-                                    author_affil_dict in paper_author_affil_mapping])
+    affiliations_df = paa_to_frame(paper_author_affil_mapping, {'author' : 'author_group', 
+                                                                'pmid' : 'pmid', 
+                                                                'location' : 'locations', 
+                                                                'affiliation' : 'affiliations'})
     
 
     big_df = pd.merge(paper_top_author_df, affiliations_df, left_on = ['join_obj', 'pmid'], right_on = ['author', 'pmid'])#.drop('join_obj', index=1)
+    yield stage_record('papers_merged', timings, timeit_start)
+    report_progress('building')
+    return papers_data, affiliations_by_author, big_df, timings
+
+
+def query_author_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key, min_date = "", stream = False):
+    """
+    Output dictionary of the top authors for `query`, or with `stream` a generator of `stream_records`.
+    """
+    stages = author_papers_stages(query, from_year, locations, affils, timeit_start, api_key, min_date)
+    if stream:
+        return stream_records('author_papers', query, stages, 'author', timeit_start)
+    output = run_stages(stages)
+    if isinstance(output, dict):
+        return output
+    papers_data, affiliations_by_author, big_df, timings = output
     out_dict = create_out_dict_obj_index(affiliations_by_author, big_df, 'author')    
+    print(f'Location cache stats : {location_cache.stats()}')
     return out_dict
 
 
-def query_affil_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key):
-
-    
+def affil_papers_stages(query, from_year, locations, affils, timeit_start, api_key, min_date = ""):
     """
-    `paper_author_affil_mapping` looks like:
+    Generator running the affiliation view's stages, yielding a `stage_record` as each one finishes.
+
+    Returns an error dictionary, or (papers_data, top affiliations, big_df, timings) for `create_out_dict_obj_index`.
+
+    `paper_author_affil_mapping` is a `PaperAuthorAffilIndex`, iterating over it yields:
     [
         {
         'author_list' : author[0], 
         'author_string' : author[0][2] + ", " + author[0][0],
+        'author_group' : disambiguated person label of `author_string`, 
         'affiliations' : author_affil, 
+        'proc_affiliation' : preprocess(author_affil), 
+        'affiliation_group' : institution cluster label of `proc_affiliation`, 
         'locations' : get_location(author_affil), 
         'title' : paper_dictionary['title'],
         'pmid' : paper_dictionary['pmid']
@@ -66,56 +138,187 @@ def query_affil_papers_data(query, from_year, locations, affils, n_authors, time
     ]
     """
     papers_data, paper_author_affil_mapping = query_to_paa_index(query = query, from_year = from_year, 
-                                                locations = locations, affils = affils,
+                                                locations = locations, affils = affils, min_date = min_date,
                                                 api_key = api_key, timeit_start=timeit_start)
     if papers_data[0].get('error'):
         return papers_data[0]
+    timings = {}
+    yield stage_record('papers_fetched', timings, timeit_start)
+    report_progress('grouping')
     """
-    `affil_authors` looks like :
-    {'affiliation' : affil, 
-       'total_papers' : count_papers(affil, authors_affils, 'affiliations'),
-       'authors' : count_author_affil_locations(
-                            matching_value=affil, 
-                            papers_data=authors_affils, 
-                            pmid_suffix='author_string', 
-                            n_affiliations=n_affiliations, 
-                            matching_key='affiliations')
-                           }
+    `affil_authors` (see `group_papers_by_top_obj`) is a list of :
+    {'proc_Affiliation' : affiliation group, 
+       'total_papers' : number of distinct PMIDs in the group,
+       'authors' : {pmid : {author group : count}},
+       'raw_affiliations' : {pmid : {raw affiliation : count}}
+    }
     """
     print(f"PAA Mapping made in {round(time.time() - timeit_start, 4)} seconds.")
     affil_authors, top_affil_list = group_papers_by_top_obj(
                                     paa_cross_mapping = paper_author_affil_mapping, 
                                     n_affiliations = 5, obj_key = 'affiliations')
+    yield stage_record('top_objects_found', timings, timeit_start)
+    report_progress('matching')
     print(f"Top affiliations found in {round(time.time() - timeit_start, 4)} seconds.")
     """
     Get papers for top 25 authors
-    Each element of contained in `paper_top_author_dict` looks like :
-    {author_of_interest : {
-        'author' : author_of_interest, 
+    Each row of the returned DataFrame looks like :
+    {
+        'join_obj' : obj_of_interest, 
+        'raw_join_obj' : obj_of_interest before preprocessing, 
         'title' : matchedPaper['title'], 
         'pubdate' : matchedPaper['pubdate'], 
         'link' : matchedPaper['link'], 
         'pmid' : matchedPaper['pmid'],
-        'pubtype_list' : ",".join(matchedPaper['pub_type_list']),
+        'pubtype_list' : list(matchedPaper['pub_type_list']),
         'all_authors_list' : ",".join([author_affil[0][2] + ', ' + author_affil[0][0] for author_affil in matchedPaper['author_list']]), 
         'mesh_keywords' : list(matchedPaper['mesh_keywords'].keys()),
-        'other_ids' : ",".join(matchedPaper['other_ids'].values())}
+        'other_ids' : ",".join(matchedPaper['other_ids'].values())
     }
     """
-    paper_top_obj_dict = get_top_obj_papers(top_objs = top_affil_list, obj_key = 'affiliations',
+    paper_top_obj_df = get_top_obj_papers(top_objs = top_affil_list, obj_key = 'affiliations',
                                     authors_affils=paper_author_affil_mapping, papers_data=papers_data)
+    yield stage_record('papers_matched', timings, timeit_start)
     print(f"Matched papers found in {round(time.time() - timeit_start, 4)} seconds.")
 
-    paper_top_obj_df = pd.DataFrame(paper_top_obj_dict).T
-    df_to_match = pd.DataFrame([{'affiliation' : author_affil_dict['affiliations'], 
-                                'proc_Affiliation' : preprocess(author_affil_dict['affiliations']),
-                                    'pmid' : author_affil_dict['pmid'],
-                                    'author': author_affil_dict['author_string']} for \
-                                    author_affil_dict in paper_author_affil_mapping])
+    df_to_match = paa_to_frame(paper_author_affil_mapping, {'affiliation' : 'affiliations', 
+                                                            'proc_Affiliation' : 'affiliation_group', 
+                                                            'pmid' : 'pmid', 
+                                                            'author' : 'author_group'})
     big_df = pd.merge(paper_top_obj_df, df_to_match, 
         left_on = ['join_obj', 'pmid'], right_on = ['proc_Affiliation', 'pmid']).drop(['join_obj'], axis=1)
-    
+    yield stage_record('papers_merged', timings, timeit_start)
+    report_progress('building')
+    return papers_data, affil_authors, big_df, timings
+
+
+def query_affil_papers_data(query, from_year, locations, affils, n_authors, timeit_start, api_key, min_date = "", stream = False):
+    """
+    Output dictionary of the top affiliations for `query`, or with `stream` a generator of `stream_records`.
+    """
+    stages = affil_papers_stages(query, from_year, locations, affils, timeit_start, api_key, min_date)
+    if stream:
+        return stream_records('affil_papers', query, stages, 'affiliations', timeit_start)
+    output = run_stages(stages)
+    if isinstance(output, dict):
+        return output
+    papers_data, affil_authors, big_df, timings = output
     out_dict = create_out_dict_obj_index(affil_authors, big_df, 'affiliations')
+    print(f'Location cache stats : {location_cache.stats()}')
     
+    return out_dict
+
+
+def query_records(query_type, query, papers_data, top_obj_dicts, big_df, obj_key, timeit_start, timings):
+    """
+    Records of a streamed query's output, once its stages have run (see `stream_records`) :
     
-    return out_dict
\ No newline at end of file
+    {'record' : 'summary', 'n_papers', 'n_objects', 'n_object_papers', 'timings' : {stage : seconds}}
+    {'record' : 'object', 'rank', 'key', **the object's `create_out_dict_obj_index` dictionary} for each top object
+    {'record' : 'footer', 'n_objects', 'seconds'}
+
+    Timings are seconds since `timeit_start`. Only the current object's output is held at a time.
+    """
+    yield {'record' : 'summary', 
+            'n_papers' : len(papers_data), 
+            'n_objects' : len(top_obj_dicts), 
+            'n_object_papers' : len(big_df), 
+            'timings' : {stage : round(seconds, 4) for stage, seconds in timings.items()}}
+
+    n_objects = 0
+    for rank, (obj, out_obj_dict) in enumerate(iter_out_obj_dicts(top_obj_dicts, big_df, obj_key)):
+        yield {'record' : 'object', 'rank' : rank, 'key' : obj, **out_obj_dict}
+        n_objects += 1
+
+    print(f'Streamed {n_objects} objects for `{query_type}` "{query}" in {round(time.time() - timeit_start, 4)} seconds.')
+    print(f'Location cache stats : {location_cache.stats()}')
+    yield {'record' : 'footer', 'n_objects' : n_objects, 'seconds' : round(time.time() - timeit_start, 4)}
+
+
+def merge_pmid_dicts(old_pmid_dict, new_pmid_dict, new_pmids):
+    """
+    Add the `{pmid : {value : count}}` entries for `new_pmids` to a copy of `old_pmid_dict`.
+    """
+    merged = dict(old_pmid_dict)
+    merged.update({pmid : counts for pmid, counts in new_pmid_dict.items() if pmid in new_pmids})
+    return merged
+
+
+def merge_counts(old_counts, new_items):
+    """
+    Add the items in `new_items` to a `[[item, count], ...]` list and re-sort it by count.
+    """
+    counts = Counter({item : count for item, count in old_counts})
+    counts.update(new_items)
+    return sorted(list(counts.items()), key=lambda x: x[1], reverse=True)
+
+
+def merge_out_dicts(old_out_dict, new_out_dict, query_type, full_out_dict=None):
+    """
+    Merge the output of a query restricted to recently added papers into a stored result.
+
+    Papers already counted for an entity are skipped, so overlapping date windows don't double count. 
+    Only the new papers' contributions are added to each entity's counts, `papers_dict`, 
+    `papers_links` and keyword/pubtype counts. 
+    
+    `new_out_dict` only has the papers from the refresh window, so an entity that wasn't in the stored 
+    result is taken from `full_out_dict` (the same query over its whole date range) with all its papers. 
+    If it isn't there either, its refresh window entry is added with `partial` set to True.
+
+    Args:
+        old_out_dict - Dict: stored output of the result
+        new_out_dict - Dict: output of `query_author_papers_data`/`query_affil_papers_data` for the new papers
+        query_type - Str: `author_papers` or `affil_papers`
+        full_out_dict - Dict: output of the same query without `min_date`, only needed when `new_out_dict` has new entities
+    Returns:
+        Dict: merged output, ordered by `total_count`
+    """
+    if new_out_dict.get('error'):
+        return old_out_dict
+    if old_out_dict.get('error'):
+        return new_out_dict
+    if not full_out_dict or full_out_dict.get('error'):
+        full_out_dict = {}
+
+    if query_type == 'author_papers':
+        pmid_keys = ['affiliations', 'locations']
+    elif query_type == 'affil_papers':
+        pmid_keys = ['authors', 'raw_affiliations']
+
+    merged_out_dict = dict(old_out_dict)
+    for obj_name, new_obj_dict in new_out_dict.items():
+        old_obj_dict = old_out_dict.get(obj_name)
+        if not old_obj_dict:
+            if obj_name in full_out_dict:
+                merged_out_dict[obj_name] = full_out_dict[obj_name]
+            else:
+                merged_out_dict[obj_name] = dict(new_obj_dict, partial=True)
+            continue
+
+        old_pmids = set([paper['pmid'] for paper in old_obj_dict['papers_dict']])
+        new_papers = [paper for paper in new_obj_dict['papers_dict'] if paper['pmid'] not in old_pmids]
+        new_pmids = set([paper['pmid'] for paper in new_papers])
+        if not new_pmids:
+            continue
+
+        obj_dict = dict(old_obj_dict)
+        obj_dict['total_count'] = old_obj_dict['total_count'] + len(new_pmids)
+        for pmid_key in pmid_keys:
+            obj_dict[pmid_key] = merge_pmid_dicts(old_obj_dict[pmid_key], new_obj_dict[pmid_key], new_pmids)
+        if query_type == 'affil_papers':
+            new_locations = Counter([get_location(affil) for pmid, affils_count_dict in new_obj_dict['raw_affiliations'].items() \
+                                    if pmid in new_pmids for affil in affils_count_dict.keys()])
+            obj_dict['locations'] = dict(Counter(old_obj_dict['locations']) + new_locations)
+
+        obj_dict['papers_dict'] = old_obj_dict['papers_dict'] + new_papers
+        obj_dict['papers_links'] = old_obj_dict['papers_links'] + \
+                                    [paper for paper in new_obj_dict['papers_links'] if paper['pmid'] in new_pmids]
+        obj_dict['papers_keywords'] = old_obj_dict['papers_keywords'] + [paper['mesh_keywords'] for paper in new_papers]
+        obj_dict['papers_keywords_counts'] = merge_counts(old_obj_dict['papers_keywords_counts'], 
+                                    [item for paper in new_papers for item in paper['mesh_keywords']])
+        obj_dict['papers_pubtypes'] = old_obj_dict['papers_pubtypes'] + [paper['pubtype_list'] for paper in new_papers]
+        obj_dict['papers_pubtype_counts'] = merge_counts(old_obj_dict['papers_pubtype_counts'], 
+                                    [item for paper in new_papers for item in paper['pubtype_list']])
+        merged_out_dict[obj_name] = obj_dict
+
+    return dict(sorted(merged_out_dict.items(), key=lambda item: item[1]['total_count'], reverse=True))
@@ -1,10 +1,12 @@
 from datetime import datetime
 from hashlib import md5
 from time import time
+import zlib
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import db, login
+from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import JSON
 
 
@@ -58,7 +60,134 @@ class Result(db.Model):
     user_querying = db.Column(db.String(250))
     redis_token = db.Column(db.String(400))
     length_of_results = db.Column(db.Integer)
-    result_all = db.Column(JSON)
+    ### Only error results keep their output here, the rest is in `ResultEntity` and its tables. 
+    ### Deferred so listing or paging results doesn't load it.
+    result_all = db.deferred(db.Column(JSON))
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    refreshed_at = db.Column(db.DateTime)
 
     def __repr__(self):
-        return '<id {}>'.format(self.id)
\ No newline at end of file
+        return '<id {}>'.format(self.id)
+
+class ResultEntity(db.Model):
+    """
+    One author/affiliation of a `Result`, `rank` 0 being the one with the most papers. 
+    `detail` holds its per-PMID affiliation/location/author counts and `papers_section` its 
+    `papers_dict` records, encoded by `app.result_codec`. The section is deferred so pages that 
+    only show the entity and its paper links never load or decompress it.
+    """
+    __tablename__ = 'result_entities'
+    __table_args__ = (db.Index('ix_result_entities_result_rank', 'result_id', 'rank', unique=True),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    result_id = db.Column(db.Integer, db.ForeignKey('result.id', ondelete='CASCADE'), nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    entity_key = db.Column(db.Text, nullable=False)
+    total_count = db.Column(db.Integer)
+    detail = db.Column(JSON)
+    papers_section = db.deferred(db.Column(db.LargeBinary))
+
+    def __repr__(self):
+        return '<ResultEntity {} #{} of result {}>'.format(self.entity_key, self.rank, self.result_id)
+
+
+class ResultEntityPaper(db.Model):
+    """
+    A paper of a `ResultEntity`, its full record is at `position` in the entity's `papers_section`.
+    """
+    __tablename__ = 'result_entity_papers'
+    __table_args__ = (db.Index('ix_result_entity_papers_entity_position', 'entity_id', 'position'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    result_id = db.Column(db.Integer, db.ForeignKey('result.id', ondelete='CASCADE'), nullable=False, index=True)
+    entity_id = db.Column(db.Integer, db.ForeignKey('result_entities.id', ondelete='CASCADE'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    pmid = db.Column(db.String(20))
+    title = db.Column(db.Text)
+    link = db.Column(db.String(200))
+    pubdate = db.Column(db.String(40))
+
+
+class ResultEntityCount(db.Model):
+    """
+    A keyword or publication type count of a `ResultEntity`, `rank` 0 being the most common.
+    """
+    __tablename__ = 'result_entity_counts'
+    __table_args__ = (db.Index('ix_result_entity_counts_entity_kind_rank', 'entity_id', 'kind', 'rank'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    result_id = db.Column(db.Integer, db.ForeignKey('result.id', ondelete='CASCADE'), nullable=False, index=True)
+    entity_id = db.Column(db.Integer, db.ForeignKey('result_entities.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    value = db.Column(db.Text)
+    count = db.Column(db.Integer)
+
+
+class AffiliationCluster(db.Model):
+    """
+    The institution cluster a preprocessed affiliation was assigned to, with its MinHash `signature`.
+    See `app.affiliation_clusters`.
+    """
+    __tablename__ = 'affiliation_clusters'
+
+    proc_affiliation = db.Column(db.Text, primary_key=True)
+    cluster_id = db.Column(db.Integer, nullable=False, index=True)
+    signature = db.Column(db.LargeBinary, nullable=False)
+
+
+class AffiliationClusterLabel(db.Model):
+    """
+    A cluster's label, the first affiliation assigned to it.
+    """
+    __tablename__ = 'affiliation_cluster_labels'
+
+    cluster_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    label = db.Column(db.Text, nullable=False)
+
+
+class AffiliationLshBucket(db.Model):
+    """
+    An affiliation in one LSH bucket, `bucket_key` packs (band, bucket hash) into one integer.
+    """
+    __tablename__ = 'affiliation_lsh'
+
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_key = db.Column(db.BigInteger, nullable=False, index=True)
+    proc_affiliation = db.Column(db.Text, nullable=False)
+
+
+class Author(db.Model):
+    """
+    A person in the author index, `profile` holds the counts mentions are scored against. 
+    See `app.author_index`.
+    """
+    __tablename__ = 'authors'
+
+    author_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    block_key = db.Column(db.Text, nullable=False, index=True)
+    label = db.Column(db.Text, nullable=False)
+    n_mentions = db.Column(db.Integer, nullable=False)
+    profile = db.Column(JSON, nullable=False)
+
+
+class AuthorMention(db.Model):
+    """
+    The `Author` an author of a paper is attached to. `author_name` is "Last, Forename", 
+    with " #2", " #3", ... for repeats of a name on one paper.
+    """
+    __tablename__ = 'author_mentions'
+
+    pmid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    author_name = db.Column(db.Text, primary_key=True)
+    author_id = db.Column(db.Integer, nullable=False)
+
+
+def lock_for_writing(connection, name):
+    """
+    Hold a lock named `name` until `connection`'s transaction ends, so web and worker processes 
+    add to the same index one at a time. It's a Postgres advisory lock, other databases rely on 
+    their own write locking.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), key=zlib.crc32(name.encode('utf-8')))
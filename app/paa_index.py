@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+
+class Vocabulary(object):
+    """
+    Interned strings (or any hashable values) and their integer codes.
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, codes):
+        """
+        Object array of the values for `codes`.
+        """
+        values = np.empty(len(self.values), dtype=object)
+        values[:] = self.values
+        return values[codes]
+
+
+class PaperAuthorAffilIndex(object):
+    """
+    Columnar paper-author-affiliation index, one row per author + affiliation + paper.
+
+    Each string column is an int32 array of codes into its own `Vocabulary`, so an author, affiliation
+    or location string is stored once however many rows it appears in. Paper attributes (an int64 PMID 
+    array, titles, the raw `author_list`) are stored once per paper and rows point at their paper.
+
+    Iterating over the index yields the row dicts `create_paper_author_affil_index` used to return, 
+    for code that hasn't been moved to the columns yet.
+    """
+    string_columns = ['author_string', 'author_group', 'affiliations', 'proc_affiliation', 'affiliation_group', 'locations']
+
+    def __init__(self):
+        self.vocabularies = {column : Vocabulary() for column in self.string_columns}
+        self.paper_pmids = np.zeros(0, dtype=np.int64)
+        self.paper_titles = []
+        self.paper_author_lists = []
+        self.codes = {column : np.zeros(0, dtype=np.int32) for column in self.string_columns}
+        self.paper_rows = np.zeros(0, dtype=np.int32)
+        self.author_positions = np.zeros(0, dtype=np.int32)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build from an iterable of row tuples:
+        (paper_pmid, paper_title, paper_author_list, author_position, {string column : value})
+        where rows of the same paper are consecutive.
+        """
+        index = cls()
+        codes = {column : [] for column in cls.string_columns}
+        paper_pmids = []
+        paper_rows = []
+        author_positions = []
+        encoders = {column : index.vocabularies[column].encode for column in cls.string_columns}
+        last_pmid = None
+        for pmid, title, author_list, position, values in rows:
+            if pmid != last_pmid or not paper_pmids:
+                paper_pmids.append(int(pmid))
+                index.paper_titles.append(title)
+                index.paper_author_lists.append(author_list)
+                last_pmid = pmid
+            paper_rows.append(len(paper_pmids) - 1)
+            author_positions.append(position)
+            for column in cls.string_columns:
+                codes[column].append(encoders[column](values[column]))
+        index.codes = {column : np.array(column_codes, dtype=np.int32) for column, column_codes in codes.items()}
+        index.paper_pmids = np.array(paper_pmids, dtype=np.int64)
+        index.paper_rows = np.array(paper_rows, dtype=np.int32)
+        index.author_positions = np.array(author_positions, dtype=np.int32)
+        return index
+
+    def __len__(self):
+        return len(self.paper_rows)
+
+    def column(self, name):
+        """
+        Object array of `name`'s value for every row. `pmid` and `title` come from the row's paper, 
+        PMIDs as strings like the parser reports them.
+        """
+        if name in ('pmid', 'title'):
+            paper_values = np.empty(len(self.paper_pmids), dtype=object)
+            paper_values[:] = [str(pmid) for pmid in self.paper_pmids] if name == 'pmid' else self.paper_titles
+            return paper_values[self.paper_rows]
+        return self.vocabularies[name].decode(self.codes[name])
+
+    def to_frame(self, columns):
+        """
+        DataFrame with {output column : index column}.
+        """
+        return pd.DataFrame({out_column : self.column(column) for out_column, column in columns.items()})
+
+    def row(self, i):
+        paper = self.paper_rows[i]
+        author = self.paper_author_lists[paper][self.author_positions[i]]
+        row = {'author_list' : author[0]}
+        for column in self.string_columns:
+            row[column] = self.vocabularies[column].values[self.codes[column][i]]
+        row['title'] = self.paper_titles[paper]
+        row['pmid'] = str(self.paper_pmids[paper])
+        return row
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def value_counts(self, name):
+        """
+        {value : number of rows} for string column `name`, in the order the values first appear.
+        """
+        vocabulary = self.vocabularies[name]
+        return dict(zip(vocabulary.values, np.bincount(self.codes[name], minlength=len(vocabulary)).tolist()))
+
+    def rows_by_value(self, name, values=None):
+        """
+        {value : array of row numbers} for string column `name` (or only for `values`), 
+        in the order the values first appear.
+        """
+        vocabulary = self.vocabularies[name]
+        codes = self.codes[name]
+        ### Stable sort keeps each value's rows in row order, codes were handed out in first-seen order
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(vocabulary))
+        ends = np.cumsum(counts)
+        if values is None:
+            wanted_codes = range(len(vocabulary))
+        else:
+            wanted_codes = [vocabulary.codes[value] for value in values]
+        return {vocabulary.values[code] : order[ends[code] - counts[code]:ends[code]] for code in wanted_codes if counts[code]}
+
+
+def paa_to_frame(paper_author_affil_mapping, columns):
+    """
+    DataFrame with {output column : mapping field} from either a `PaperAuthorAffilIndex` or a list of row dicts.
+    """
+    if isinstance(paper_author_affil_mapping, PaperAuthorAffilIndex):
+        return paper_author_affil_mapping.to_frame(columns)
+    return pd.DataFrame([{out_column : author_affil_dict[column] for out_column, column in columns.items()} \
+                            for author_affil_dict in paper_author_affil_mapping])
@@ -0,0 +1,78 @@
+import threading
+import time
+from rq import get_current_job
+
+### Stages a queued query goes through, in order
+STAGES = ['queued', 'searching', 'fetching', 'filtering', 'indexing', 'grouping', 'matching', 'building', 'storing', 'finished']
+
+lock = threading.Lock()
+
+
+def estimate_eta(progress, now):
+    """
+    Seconds left in the fetching stage from the rate chunks have been parsed at so far, or None.
+    """
+    parsed = progress.get('chunks_parsed', 0)
+    total = progress.get('chunks_total', 0)
+    if progress.get('stage') != 'fetching' or not parsed or not total:
+        return None
+    elapsed = now - progress['stage_started_at']
+    return round(elapsed / parsed * (total - parsed), 1)
+
+
+def update_progress(update, job=None):
+    """
+    Apply `update(progress)` to the `progress` dict in `job`'s meta and save it.
+
+    `job` defaults to the current RQ job. RQ tracks that per thread, so code running in other threads 
+    (the efetch downloads) has to be given the job. Does nothing outside a worker, so synchronous 
+    queries and the CLI skip it.
+    """
+    job = job or get_current_job()
+    if job is None:
+        return
+    with lock:
+        now = time.time()
+        progress = job.meta.setdefault('progress', {'stage' : 'queued', 'started_at' : now, 'stage_started_at' : now})
+        update(progress, now)
+        progress['updated_at'] = now
+        progress['elapsed'] = round(now - progress['started_at'], 1)
+        progress['eta'] = estimate_eta(progress, now)
+        try:
+            job.save_meta()
+        except Exception as err:
+            print(f'Progress for job {job.get_id()} not saved : {err}')
+
+
+def report_progress(stage=None, **fields):
+    """
+    Move the current job to `stage` (one of `STAGES`) and/or set progress `fields` such as
+    `count` (esearch results), `chunks_total`, `chunks_fetched`, `chunks_parsed` or `result_id`.
+    Only call it from the job's own thread, see `update_progress`.
+    """
+    def update(progress, now):
+        if stage and stage != progress.get('stage'):
+            progress['stage'] = stage
+            progress['stage_started_at'] = now
+        progress.update(fields)
+    update_progress(update)
+
+
+def advance_progress(field, n=1, job=None):
+    """
+    Add `n` to a progress counter. Safe to call from the download threads if they pass the `job`
+    captured on the job's thread with `get_current_job`.
+    """
+    def update(progress, now):
+        progress[field] = progress.get(field, 0) + n
+    update_progress(update, job)
+
+
+def job_progress(job):
+    """
+    What the progress endpoint sends for `job` : its RQ status and the progress `run_query` reported.
+    """
+    job.refresh()
+    progress = dict(job.meta.get('progress', {'stage' : 'queued'}))
+    progress['status'] = job.get_status(refresh=False)
+    return progress
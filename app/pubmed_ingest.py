@@ -0,0 +1,75 @@
+import gzip
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from app.article_store import ArticleStore
+from app.pubmed_scraper_parser import PAPERS_COLUMNS, pubmed_xml_iterparse_rows
+
+
+def parse_pubmed_file(path):
+    """
+    Stream one PubMed baseline/update `.xml.gz` file. Run in the ingest worker processes.
+
+    Uses `pubmed_xml_iterparse_rows`, without any filters.
+
+    Returns:
+        Tuple: (rows, deleted_pmids, seconds) where `rows` are in `PAPERS_COLUMNS` order and 
+            `deleted_pmids` are the PMIDs listed under the file's `DeleteCitation`
+    """
+    start = time.time()
+    deleted_pmids = []
+    with gzip.open(path, 'rb') as f:
+        rows = pubmed_xml_iterparse_rows(f, locations = [], affils = [], deleted_pmids = deleted_pmids)
+    return rows, deleted_pmids, time.time() - start
+
+
+def ingest_directory(directory, processes=None, store_path=None):
+    """
+    Load every PubMed baseline/update `.xml.gz` file in `directory` into the article store.
+
+    - Files are parsed in parallel but applied in file name order, which is PubMed's release order, 
+        so a later update's revision of an article overwrites the earlier version and its deletions 
+        remove articles added by earlier files.
+    - Each applied file is recorded in the store's `ingested_files` table and skipped on later runs, 
+        so an interrupted ingest picks up where it stopped.
+
+    Returns:
+        Dict: totals for the run, including articles/sec
+    """
+    processes = int(processes or Config.INGEST_PROCESSES)
+    file_names = sorted(file_name for file_name in os.listdir(directory) if file_name.endswith('.xml.gz'))
+
+    totals = {'files' : 0, 'articles' : 0, 'deleted' : 0, 'skipped_files' : 0}
+    start = time.time()
+    with ArticleStore(path=store_path) as store, ProcessPoolExecutor(max_workers=processes) as executor:
+        done = store.ingested_file_names()
+        to_ingest = [file_name for file_name in file_names if file_name not in done]
+        totals['skipped_files'] = len(file_names) - len(to_ingest)
+        print(f'Ingesting {len(to_ingest)} files from {directory} with {processes} processes, '
+              f'{totals["skipped_files"]} already ingested.')
+
+        ### Keep a bounded window of files in flight so parsed files don't pile up in memory
+        window = processes * 2
+        futures = []
+        for i, file_name in enumerate(to_ingest):
+            futures.append((file_name, executor.submit(parse_pubmed_file, os.path.join(directory, file_name))))
+            while futures and (len(futures) >= window or i == len(to_ingest) - 1):
+                applied_name, future = futures.pop(0)
+                rows, deleted_pmids, parse_seconds = future.result()
+
+                store.put_many([dict(zip(PAPERS_COLUMNS, row)) for row in rows], source='baseline')
+                store.delete_many(deleted_pmids)
+                store.mark_file_ingested(applied_name, len(rows), len(deleted_pmids))
+
+                totals['files'] += 1
+                totals['articles'] += len(rows)
+                totals['deleted'] += len(deleted_pmids)
+                elapsed = time.time() - start
+                print(f'{applied_name} : {len(rows)} articles, {len(deleted_pmids)} deleted, parsed in {round(parse_seconds, 2)}s. '
+                      f'{totals["files"]}/{len(to_ingest)} files, {round(totals["articles"] / elapsed)} articles/sec overall.')
+
+    totals['seconds'] = round(time.time() - start, 2)
+    totals['articles_per_sec'] = round(totals['articles'] / totals['seconds']) if totals['seconds'] else 0
+    print(f'Ingest finished : {totals}')
+    return totals
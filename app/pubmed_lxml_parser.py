@@ -0,0 +1,125 @@
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from app.pubmed_scraper_parser import passes_filters
+
+
+if etree is not None:
+    ### Compiled once at import instead of re-evaluating path strings for every article
+    XP_AUTHORS = etree.XPath('./MedlineCitation/Article/AuthorList/Author')
+    XP_COLLECTIVE_NAME = etree.XPath('./CollectiveName')
+    XP_FORE_NAME = etree.XPath('./ForeName')
+    XP_INITIALS = etree.XPath('./Initials')
+    XP_LAST_NAME = etree.XPath('./LastName')
+    XP_AFFILIATIONS = etree.XPath('./AffiliationInfo/Affiliation')
+    XP_PUBMED_PUB_DATES = etree.XPath('./PubmedData/History/PubMedPubDate')
+    XP_YEAR = etree.XPath('./Year')
+    XP_PMID = etree.XPath('./MedlineCitation/PMID')
+    XP_ARTICLE_TITLE = etree.XPath('./MedlineCitation/Article/ArticleTitle')
+    XP_PUB_TYPES = etree.XPath('./MedlineCitation/Article/PublicationTypeList/PublicationType')
+    XP_JOURNALS = etree.XPath('./MedlineCitation/Article/Journal')
+    XP_ABSTRACT_TEXTS = etree.XPath('./MedlineCitation/Article/Abstract/AbstractText')
+    XP_ARTICLE_IDS = etree.XPath('./PubmedData/ArticleIdList/ArticleId')
+    XP_MESH_HEADINGS = etree.XPath('./MedlineCitation/MeshHeadingList/MeshHeading')
+    XP_DESCRIPTOR_NAME = etree.XPath('./DescriptorName')
+    XP_QUALIFIER_NAMES = etree.XPath('./QualifierName')
+    XP_DELETED_PMIDS = etree.XPath('./PMID')
+
+
+def lxml_parse_article_authors(article):
+    """
+    lxml version of `parse_article_authors`. Keeps its behaviour exactly, including that a 
+    `CollectiveName` author is only used when the element has children (otherwise 'error').
+    """
+    author_list = []
+    filter_affils = []
+    for author in XP_AUTHORS(article):
+        collective_names = XP_COLLECTIVE_NAME(author)
+        if collective_names and len(collective_names[0]):
+            author_text = collective_names[0].text
+        else:
+            try:
+                fore_name = XP_FORE_NAME(author)[0].text
+                initials = XP_INITIALS(author)[0].text
+                last_name = XP_LAST_NAME(author)[0].text
+                author_text = [fore_name, initials, last_name]
+            except IndexError:
+                author_text = 'error'
+
+        aff_list = [affil.text for affil in XP_AFFILIATIONS(author)]
+        filter_affils += aff_list
+        author_list.append([author_text, aff_list])
+    return author_list, filter_affils
+
+
+def lxml_other_id_extract(article_ids, id_type):
+    for article_id in article_ids:
+        if article_id.get('IdType') == id_type:
+            return article_id.text
+    return ''
+
+
+def lxml_parse_pubmed_article(article, author_list):
+    """
+    lxml version of `parse_pubmed_article`. Columns are in `PAPERS_COLUMNS` order.
+    """
+    art_pubdate = ''
+    for pub_date in XP_PUBMED_PUB_DATES(article):
+        if pub_date.get('PubStatus') == 'pubmed':
+            art_pubdate = XP_YEAR(pub_date)[0].text
+
+    PMID = XP_PMID(article)[0].text
+    link_str = 'https://www.ncbi.nlm.nih.gov/pubmed/' + PMID
+
+    title_text = ' '.join(XP_ARTICLE_TITLE(article)[0].itertext())
+
+    pub_type_list = [pubtype.text for pubtype in XP_PUB_TYPES(article)]
+
+    journal_list = []
+    for journal in XP_JOURNALS(article):
+        try:
+            journal_title = journal.find('Title').text
+            journal_abbr = journal.find('ISOAbbreviation').text
+            journal_issn = journal.find('ISSN').text
+            journal_issn_type = journal.find('ISSN').get('IssnType')
+            journal_list = [journal_title, journal_issn, journal_issn_type, journal_abbr]
+        ### Sometimes there's no ISSN so just in case that's the case :
+        except AttributeError:
+            journal_list = [journal_title, None, None, journal_abbr]
+
+    abstract_list = {abstract.get('Label', 'Abstract') : abstract.text for abstract in XP_ABSTRACT_TEXTS(article)}
+
+    article_ids = XP_ARTICLE_IDS(article)
+    pmc_doi_ids = {'pmc' : lxml_other_id_extract(article_ids, 'pmc'), 'doi' : lxml_other_id_extract(article_ids, 'doi')}
+
+    uni_mesh_dict = {XP_DESCRIPTOR_NAME(mesh_heading)[0].text : [qual_name.text for qual_name in XP_QUALIFIER_NAMES(mesh_heading)] \
+                    for mesh_heading in XP_MESH_HEADINGS(article)}
+
+    return [title_text, PMID, uni_mesh_dict, pub_type_list, journal_list, author_list, art_pubdate, link_str, pmc_doi_ids, abstract_list]
+
+
+def lxml_iterparse_rows(source, locations, affils, deleted_pmids=None):
+    """
+    lxml engine for `pubmed_xml_iterparse_rows`. Returns identical rows to the `xml.etree` engine.
+    """
+    papers = []
+    ### `xml.etree` drops comments and processing instructions while parsing, so the text around 
+    ### them ends up in one `.text` / `itertext()` string. Dropping them here keeps the rows identical.
+    context = etree.iterparse(source, events=('end',), tag=('PubmedArticle', 'DeleteCitation'),
+                              resolve_entities=False, no_network=True, huge_tree=True,
+                              remove_comments=True, remove_pis=True)
+    for event, elem in context:
+        if elem.tag == 'PubmedArticle':
+            author_list, filter_affils = lxml_parse_article_authors(elem)
+            if passes_filters(filter_affils, locations, affils):
+                papers.append(lxml_parse_pubmed_article(elem, author_list))
+        elif deleted_pmids is not None:
+            deleted_pmids += [pmid.text for pmid in XP_DELETED_PMIDS(elem)]
+
+        ### Drop the handled article and its (already processed) siblings from the tree
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return papers
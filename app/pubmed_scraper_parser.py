@@ -1,17 +1,44 @@
 import os
+import io
 import pandas as pd
-from xml.etree.ElementTree import fromstring, ElementTree
+from xml.etree.ElementTree import fromstring, ElementTree, iterparse
 import requests
 import datetime
 import time
 import re
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
 from config import Config
 from app.util_functions import *
-
-def query_to_paa_index(query, from_year, locations, affils, api_key, timeit_start):
+from app.eutils_client import EutilsClient
+from app.article_store import ArticleStore
+from app.corpus_cache import corpus_key, load_corpus, save_corpus
+from app.local_search import use_local_index, search_local
+from app.progress import report_progress, advance_progress
+from rq import get_current_job
+
+### efetch returns at most this many PMIDs per `uilist` request
+PMID_CHUNK_SIZE = 10000
+
+def query_to_paa_index(query, from_year, locations, affils, api_key, timeit_start, min_date = ""):
+    """
+    Fetch and index a query's papers. 
+    
+    The result is cached as a corpus keyed by the normalized query parameters, 
+    so the author view, the affiliation view and any later view of the same query share one download.
+
+    `min_date` (YYYY/MM/DD) restricts the search to entries added to PubMed since that date.
+    """
+    key = corpus_key(query, from_year, locations, affils, min_date)
+    corpus = load_corpus(key)
+    if corpus:
+        print(f'Query for "{query}" from {from_year} loaded from corpus {key} in {round(time.time() - timeit_start, 4)} seconds.')
+        report_progress('grouping', count=len(corpus[0]), corpus_cached=True)
+        return corpus
     
     papers_data, count_results = get_article_ids(query, sort = 'relevance', from_year = from_year, 
-                    locations = locations, affils = affils,
+                    locations = locations, affils = affils, min_date = min_date,
                     time_start = timeit_start, api_key = api_key)
     if not papers_data:
         return [{'error' : 'No results returned from query. Trying adding more locations, removing locations entirely or broadening your search terms.'}], ''
@@ -19,7 +46,9 @@ def query_to_paa_index(query, from_year, locations, affils, api_key, timeit_star
     if papers_data[0].get('error'):
         return papers_data, ''
 
+    report_progress('indexing')
     paper_author_affil_mapping = create_paper_author_affil_index(papers_data=papers_data)
+    save_corpus(key, papers_data, paper_author_affil_mapping)
 
     return papers_data, paper_author_affil_mapping
 
@@ -32,159 +61,373 @@ def other_id_extract(article_id_list, id_type):
     return article_id
 
 
-def pubmed_xml_parse(xml_text, locations, affils):
-    now = datetime.datetime.now()
-    locations_regex = f'({"|".join(locations)})'
-    affils_regex = f'({"|".join(affils)})'
-    ### Parse XML File using an ElementTree
-    root_ab = ElementTree(fromstring(xml_text)).getroot()
+PAPERS_COLUMNS = ['title', 'pmid', 'mesh_keywords', 'pub_type_list', 'journal_info_list', 'author_list', 'pubdate', 'link', 'other_ids', 'abstract']
 
-    ### These lists will contain lists where each list has data for 1 article
-    ### Some will be for their own sheet
-    papers = []
 
-    ### For each article in the imported file
-    for article in root_ab.findall('./PubmedArticle'):
-
-        ### Author information
-        author_list = []
-        filter_affils = []
-        for author in article.findall('./MedlineCitation/Article/AuthorList/Author'):
-            if author.find('Forename'):
-                fore_name = author.find('Forename').text
-            else:
-                fore_name = ''
-            if author.find('./CollectiveName'):
-                author_text = author.find('./CollectiveName').text
-            else:
-                try:
-                    fore_name = author.findall('ForeName')[0].text
-                    initials = author.findall('./Initials')[0].text
-                    last_name = author.findall('LastName')[0].text
-                    author_text = [fore_name, initials, last_name]
-                except:
-                    author_text = 'error'
-
-            aff_list = [i.text for i in author.findall('./AffiliationInfo/Affiliation')]
-            filter_affils += aff_list
-            author_list.append([author_text, aff_list])
-
-        if affils:
-            if any([True if re.search(affils_regex, affil.lower()) else False for affil in filter_affils]):
-                pass
-            else:
-                continue
-
-        if locations:
-            if any([True if re.search(locations_regex, get_location(affil).lower()) else False for affil in filter_affils]):
-                pass
-            else:
-                continue
-
-
-        ### Iterate through different parts of the articles
-        ### Publication Date
-        art_pubdate = ''
-        for PubMedPubDate in article.findall('./PubmedData/History/PubMedPubDate'):
-            ### Grab data article was published on PubMed
-            if PubMedPubDate.get('PubStatus') == 'pubmed':
-                art_pubdate = PubMedPubDate.find('./Year').text
-
-        ### Link and PMID
-        PMID = article.find('./MedlineCitation/PMID').text
-        link_str = 'https://www.ncbi.nlm.nih.gov/pubmed/' + PMID
-
-        ### Article Title
-        title_text = ' '.join(article.find('./MedlineCitation/Article/ArticleTitle').itertext())
-
-        ### Publication Types
-        pub_type_list = []
-        for pubtype in article.findall('./MedlineCitation/Article/PublicationTypeList/PublicationType'):
-            pub_type_list.append(pubtype.text)
-
-        ### Journal Information
-        journal_list = []
-        for journal in article.findall('./MedlineCitation/Article/Journal'):
+def parse_article_authors(article):
+    """
+    Pull the author list out of a `PubmedArticle` element.
+
+    Returns:
+        Tuple: (author_list, filter_affils) where `author_list` elements are [author_text, aff_list] 
+            and `filter_affils` is every affiliation string on the paper
+    """
+    author_list = []
+    filter_affils = []
+    for author in article.findall('./MedlineCitation/Article/AuthorList/Author'):
+        if author.find('Forename'):
+            fore_name = author.find('Forename').text
+        else:
+            fore_name = ''
+        if author.find('./CollectiveName'):
+            author_text = author.find('./CollectiveName').text
+        else:
             try:
-                journal_title = journal.find('Title').text
-                journal_abbr = journal.find('ISOAbbreviation').text
-                journal_issn = journal.find('ISSN').text
-                journal_issn_type = journal.find('ISSN').get('IssnType')
-                journal_list = [journal_title, journal_issn, journal_issn_type, journal_abbr]
-            ### Sometimes there's no ISSN so just in case that's the case :
-            except AttributeError:
-                journal_list = [journal_title, None, None, journal_abbr]
-
-        ### Abstracts
-        abstract_list = {abstract.get('Label', 'Abstract') : abstract.text for abstract in article.findall('./MedlineCitation/Article/Abstract/AbstractText')}
-
-        ### Other keywords attached to the article
-        keyword_list = [keyword_elem.text for keyword_elem in article.findall('./MedlineCitation/KeywordList/Keyword')]
-
-        ### Article IDs and information
-        article_id_list = article.findall('./PubmedData/ArticleIdList/ArticleId')
-        article_doi = other_id_extract(article_id_list, 'doi')
-        article_pmc_id = other_id_extract(article_id_list, 'pmc')
-        pmc_doi_ids = {'pmc' : article_pmc_id, 'doi' : article_doi}
-        
-        ### MeSH Headings and Terms
-        uni_mesh_dict = {MeshHeading.findall('./DescriptorName')[0].text: \
-                        [QualName.text for QualName in MeshHeading.findall('./QualifierName')] \
-                        for MeshHeading in article.findall('./MedlineCitation/MeshHeadingList/MeshHeading')}
-
-        ### papers List
-        papers.append(
-            [title_text, PMID, uni_mesh_dict, pub_type_list, journal_list, author_list, art_pubdate, link_str, pmc_doi_ids, abstract_list])
+                fore_name = author.findall('ForeName')[0].text
+                initials = author.findall('./Initials')[0].text
+                last_name = author.findall('LastName')[0].text
+                author_text = [fore_name, initials, last_name]
+            except:
+                author_text = 'error'
+
+        aff_list = [i.text for i in author.findall('./AffiliationInfo/Affiliation')]
+        filter_affils += aff_list
+        author_list.append([author_text, aff_list])
+    return author_list, filter_affils
+
+
+def passes_filters(filter_affils, locations, affils):
+    """
+    Check a paper's affiliations against the user's `affils` and `locations` filters.
+    """
+    if affils:
+        affils_regex = f'({"|".join(affils)})'
+        if not any([True if re.search(affils_regex, affil.lower()) else False for affil in filter_affils]):
+            return False
+
+    if locations:
+        locations_regex = re.compile(f'({"|".join(locations)})')
+        if not any([True if locations_regex.search(location.lower()) else False for location in get_locations(filter_affils)]):
+            return False
+    return True
+
+
+def parse_pubmed_article(article, author_list):
+    """
+    Extract one paper's row from a `PubmedArticle` element. Columns are in `PAPERS_COLUMNS` order.
+    """
+    ### Iterate through different parts of the articles
+    ### Publication Date
+    art_pubdate = ''
+    for PubMedPubDate in article.findall('./PubmedData/History/PubMedPubDate'):
+        ### Grab data article was published on PubMed
+        if PubMedPubDate.get('PubStatus') == 'pubmed':
+            art_pubdate = PubMedPubDate.find('./Year').text
+
+    ### Link and PMID
+    PMID = article.find('./MedlineCitation/PMID').text
+    link_str = 'https://www.ncbi.nlm.nih.gov/pubmed/' + PMID
+
+    ### Article Title
+    title_text = ' '.join(article.find('./MedlineCitation/Article/ArticleTitle').itertext())
+
+    ### Publication Types
+    pub_type_list = []
+    for pubtype in article.findall('./MedlineCitation/Article/PublicationTypeList/PublicationType'):
+        pub_type_list.append(pubtype.text)
+
+    ### Journal Information
+    journal_list = []
+    for journal in article.findall('./MedlineCitation/Article/Journal'):
+        try:
+            journal_title = journal.find('Title').text
+            journal_abbr = journal.find('ISOAbbreviation').text
+            journal_issn = journal.find('ISSN').text
+            journal_issn_type = journal.find('ISSN').get('IssnType')
+            journal_list = [journal_title, journal_issn, journal_issn_type, journal_abbr]
+        ### Sometimes there's no ISSN so just in case that's the case :
+        except AttributeError:
+            journal_list = [journal_title, None, None, journal_abbr]
+
+    ### Abstracts
+    abstract_list = {abstract.get('Label', 'Abstract') : abstract.text for abstract in article.findall('./MedlineCitation/Article/Abstract/AbstractText')}
+
+    ### Other keywords attached to the article
+    keyword_list = [keyword_elem.text for keyword_elem in article.findall('./MedlineCitation/KeywordList/Keyword')]
+
+    ### Article IDs and information
+    article_id_list = article.findall('./PubmedData/ArticleIdList/ArticleId')
+    article_doi = other_id_extract(article_id_list, 'doi')
+    article_pmc_id = other_id_extract(article_id_list, 'pmc')
+    pmc_doi_ids = {'pmc' : article_pmc_id, 'doi' : article_doi}
+    
+    ### MeSH Headings and Terms
+    uni_mesh_dict = {MeshHeading.findall('./DescriptorName')[0].text: \
+                    [QualName.text for QualName in MeshHeading.findall('./QualifierName')] \
+                    for MeshHeading in article.findall('./MedlineCitation/MeshHeadingList/MeshHeading')}
+
+    return [title_text, PMID, uni_mesh_dict, pub_type_list, journal_list, author_list, art_pubdate, link_str, pmc_doi_ids, abstract_list]
+
+
+def etree_iterparse_rows(source, locations, affils, deleted_pmids=None):
+    """
+    `xml.etree` engine for `pubmed_xml_iterparse_rows`.
+    """
+    papers = []
+    root = None
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end':
+            continue
+        if elem.tag == 'PubmedArticle':
+            author_list, filter_affils = parse_article_authors(elem)
+            if passes_filters(filter_affils, locations, affils):
+                papers.append(parse_pubmed_article(elem, author_list))
+        elif elem.tag == 'DeleteCitation' and deleted_pmids is not None:
+            deleted_pmids += [pmid.text for pmid in elem.findall('./PMID')]
+        else:
+            continue
+
+        ### Drop the handled article and its (already processed) siblings from the tree
+        elem.clear()
+        root.clear()
+    return papers
+
+
+def pubmed_xml_iterparse_rows(source, locations, affils, deleted_pmids=None, engine=None):
+    """
+    Parse `source` as it is read and return one row (in `PAPERS_COLUMNS` order) per article. 
+
+    `source` is a file-like object (eg. an efetch response's `raw` stream). 
+    Each `PubmedArticle` is handled as soon as its closing tag arrives and is then cleared 
+    so only one article is held in memory at a time.
+
+    Args:
+        deleted_pmids - List: if given, PMIDs under `DeleteCitation` (update files) are appended to it
+        engine - Str: 'lxml' or 'etree', defaults to `XML_PARSER`. Both return identical rows.
+    """
+    engine = engine or Config.XML_PARSER
+    if engine == 'lxml':
+        from app.pubmed_lxml_parser import lxml_iterparse_rows, etree as lxml_etree
+        if lxml_etree is not None:
+            return lxml_iterparse_rows(source, locations = locations, affils = affils, deleted_pmids = deleted_pmids)
+    return etree_iterparse_rows(source, locations = locations, affils = affils, deleted_pmids = deleted_pmids)
+
+
+def pubmed_xml_iterparse(source, locations, affils):
+    """
+    Streaming version of `pubmed_xml_parse`. See `pubmed_xml_iterparse_rows`.
+
+    Returns:
+        DataFrame: same columns as `pubmed_xml_parse`
+    """
+    papers = pubmed_xml_iterparse_rows(source, locations = locations, affils = affils)
 
     ### papers DF creation
-    papers_df = pd.DataFrame(papers,
-                             columns=['title', 'pmid', 'mesh_keywords', 'pub_type_list', 'journal_info_list', 'author_list', 'pubdate', 'link', 'other_ids', 'abstract'])
+    papers_df = pd.DataFrame(papers, columns=PAPERS_COLUMNS)
     return papers_df
 
-def get_article_ids(query, sort, locations, affils, from_year = "", 
-                    api_key="", chunk_size = 1000, time_start=time.time()):
-    now = datetime.datetime.now()
 
-    esearch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
+def pubmed_xml_parse(xml_text, locations, affils):
+    """
+    Parse an efetch body that has already been read into memory. 
+    
+    Use `pubmed_xml_iterparse` when the body can be streamed.
+    """
+    if isinstance(xml_text, str):
+        xml_text = xml_text.encode('utf-8')
+    return pubmed_xml_iterparse(io.BytesIO(xml_text), locations = locations, affils = affils)
+
 
-    ### More DB options here : https://www.ncbi.nlm.nih.gov/books/NBK3837/
-    if from_year:
-        reldate = '&reldate=' + str((2021 - int(from_year)) * 365)
+def parse_efetch_chunk(xml_bytes):
+    """
+    Parse one downloaded efetch chunk, unfiltered. 
+    
+    Run in the parse worker processes, so it returns plain rows rather than dicts or a DataFrame 
+    to keep what gets pickled back to the parent small.
+    """
+    return pubmed_xml_iterparse_rows(io.BytesIO(xml_bytes), locations = [], affils = [])
+
+
+def filter_mask_chunk(papers_affils, locations, affils):
+    """
+    `passes_filters` for a batch of papers' affiliation lists. Run in the parse worker processes.
+    """
+    return [passes_filters(filter_affils, locations, affils) for filter_affils in papers_affils]
+
+
+def filter_papers(papers, locations, affils, parse_pool=None, chunk_size=1000):
+    """
+    Keep the papers whose affiliations pass the `locations`/`affils` filters. 
+
+    When `parse_pool` is given the geocoding and regex work is spread over its processes; 
+    only the affiliation strings are sent and a True/False mask comes back.
+    """
+    if not locations and not affils:
+        return papers
+    papers_affils = [[affil for author in paper['author_list'] for affil in author[1]] for paper in papers]
+    if parse_pool is None:
+        mask = filter_mask_chunk(papers_affils, locations, affils)
     else:
-        reldate = ''
-    ### Get the webpage with the IDs for the articles you'll want to fetch
-    url_search = f"{esearch_base}?db=pubmed&term={query}&usehistory=y&datetype=edat{reldate}"
-    docsearch_resp = requests.get(url_search)
+        affils_chunks = [papers_affils[i:i + chunk_size] for i in range(0, len(papers_affils), chunk_size)]
+        mask = list(itertools.chain.from_iterable(
+                    parse_pool.map(filter_mask_chunk, affils_chunks, 
+                                    itertools.repeat(locations), itertools.repeat(affils))))
+    return [paper for paper, keep in zip(papers, mask) if keep]
+
+
+def parse_chunks_pipelined(download_chunk, chunks, executor, parse_pool=None):
+    """
+    Download `chunks` on `executor`'s threads and parse them as they arrive.
+
+    With a `parse_pool` (a `ProcessPoolExecutor`) a download thread hands its chunk's bytes to a worker 
+    process and moves straight on to the next download, so parsing chunk N runs on another core 
+    while the threads download chunk N+1. Without one, chunks are parsed in the download threads.
+
+    Args:
+        download_chunk - Function: takes an element of `chunks` and returns the efetch XML as bytes
+        chunks - List: whatever `download_chunk` needs to fetch each chunk
+        executor - ThreadPoolExecutor: the download threads, `get_article_ids` passes the one it fetched PMIDs with
+    Returns:
+        Generator: lists of parsed rows (`PAPERS_COLUMNS` order), one per chunk, in `chunks` order
+    """
+    def fetch_and_parse(chunk):
+        xml_bytes = download_chunk(chunk)
+        if parse_pool is None:
+            return parse_efetch_chunk(xml_bytes)
+        ### The parse's future, not its result, so the thread doesn't wait on the worker process
+        return parse_pool.submit(parse_efetch_chunk, xml_bytes)
+
+    for parsed in executor.map(fetch_and_parse, chunks):
+        yield parsed if parse_pool is None else parsed.result()
+
+
+def get_parse_pool():
+    """
+    Process pool for the parse stage, or a no-op context if `PARSE_PROCESSES` is 0.
+    """
+    if int(Config.PARSE_PROCESSES) > 0:
+        return ProcessPoolExecutor(max_workers=int(Config.PARSE_PROCESSES))
+    return nullcontext()
+
+
+def esearch_date_params(from_year="", min_date=""):
+    """
+    esearch's date range for `from_year` and `min_date`, both on the Entrez date (`edat`).
+
+    A paper's `pubdate` is the year of its `pubmed` history date, when it entered PubMed, and 
+    `ArticleStore.search` filters `from_year` on that. Searching the Entrez date from January 1st of 
+    `from_year` gets the same papers from esearch as from the local index.
+
+    `min_date` (YYYY/MM/DD) only keeps entries added since then, used to refresh an existing result.
+    """
+    mindates = []
+    if from_year:
+        mindates.append(f'{int(from_year)}/01/01')
+    if min_date:
+        mindates.append(min_date)
+    if not mindates:
+        return {}
+    return {'datetype' : 'edat', 'mindate' : max(mindates), 'maxdate' : '3000'}
+
 
-    ### Search the results
-    root_search = fromstring(docsearch_resp.content)
-    QK = "&query_key=" + root_search.find('./QueryKey').text
-    WE = "&WebEnv=" + root_search.find('./WebEnv').text
-    count_results = int(root_search.find('./Count').text)
-    retstarts = list(range(0, count_results, chunk_size))
+def get_article_ids(query, sort, locations, affils, from_year = "", 
+                    api_key="", chunk_size = 1000, time_start=time.time(), min_date = ""):
+    now = datetime.datetime.now()
 
-    response_list = []
+    client = EutilsClient(api_key=api_key)
+    ### RQ's current job is per thread, the download threads report against this one
+    job = get_current_job()
+    report_progress('searching')
+
+    ### Answer from the local full-text index when it covers the query, see `app.local_search`
+    pmids = None
+    with ArticleStore() as store:
+        if use_local_index(store, min_date):
+            pmids = search_local(store, query, from_year = from_year)
+
+    if pmids is not None:
+        count_results = len(pmids)
+    else:
+        ### More DB options here : https://www.ncbi.nlm.nih.gov/books/NBK3837/
+        search_params = {'term' : query, 'usehistory' : 'y'}
+        search_params.update(esearch_date_params(from_year, min_date))
+        ### Get the webpage with the IDs for the articles you'll want to fetch
+        docsearch_resp = client.esearch(**search_params)
+
+        ### Search the results
+        root_search = fromstring(docsearch_resp.content)
+        query_key = root_search.find('./QueryKey').text
+        web_env = root_search.find('./WebEnv').text
+        count_results = int(root_search.find('./Count').text)
 
     print(f'Query for "{query}" from {from_year} started {round(time.time() - time_start, 4)} seconds ago has {str(count_results)} results. Downloading now.')
-    parsed_papers = []
+    report_progress(count=count_results)
 
     if count_results > int(Config.MAX_RESULTS):
         papers_result = {'error' : f"Your query was too large. The results had {count_results} papers and the current max is set to {Config.MAX_RESULTS}. I apologize for this limit. Making websites is harder than you'd think."}
+        client.close()
         return [papers_result], 0
-    else:
+
+    with client, ArticleStore() as store, get_parse_pool() as parse_pool, \
+            ThreadPoolExecutor(max_workers=int(Config.EFETCH_WORKERS)) as executor:
+        ### Get the full PMID list for the query from the search history
+        if pmids is None:
+            def fetch_pmids(retstart):
+                resp_ids = client.efetch(query_key=query_key, WebEnv=web_env, rettype='uilist', retmode='text', 
+                                        retmax=PMID_CHUNK_SIZE, retstart=retstart)
+                return resp_ids.text.split()
+            pmids = list(itertools.chain.from_iterable(
+                            executor.map(fetch_pmids, range(0, count_results, PMID_CHUNK_SIZE))))
+
+        ### Only efetch what the article store doesn't already have
+        stored_papers = store.get_many(pmids)
+        missing_pmids = [pmid for pmid in pmids if pmid not in stored_papers]
+        print(f'Query for "{query}" : {len(stored_papers)} of {len(pmids)} articles loaded from the article store, fetching {len(missing_pmids)}.')
+
         ### Get Abstracts with efetch
-        efetch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
-        rettype_mode = "&rettype=abstract&retmode=xml"
-        retmax_string = "&retmax=" + str(chunk_size)
-        for retstart in retstarts:
-            url_ab = f"{efetch_base}?db=pubmed{QK}{WE}{rettype_mode}{retmax_string}&retstart={str(retstart)}"
-            parsed_papers.append(pubmed_xml_parse(requests.get(url_ab).text, 
-                                                locations = locations, affils = affils))
-
-        papers_result = pd.concat(parsed_papers, axis=0, ignore_index=True)
-    print(f'Query for "{query}" from {from_year} onward has downloaded and been parsed in {round(time.time() - time_start, 4)} seconds. It was filtered to {count_results} rows.')
-
-    return papers_result.to_dict('records'), count_results
+        missing_chunks = [missing_pmids[i:i + chunk_size] for i in range(0, len(missing_pmids), chunk_size)]
+        report_progress('fetching', articles_stored=len(stored_papers), chunks_total=len(missing_chunks), 
+                        chunks_fetched=0, chunks_parsed=0)
+        if parse_pool is None:
+            def fetch_chunk(chunk_pmids):
+                ### Parse straight off the socket instead of holding the whole body as a string, 
+                ### a chunk cut off mid-body is downloaded and parsed again.
+                ### Nothing is filtered here because the store keeps every article for later queries
+                try:
+                    return client.efetch_parsed(lambda raw : pubmed_xml_iterparse_rows(raw, locations = [], affils = []), 
+                                                id=','.join(chunk_pmids), rettype='abstract', retmode='xml', method='POST')
+                finally:
+                    advance_progress('chunks_fetched', job=job)
+
+            ### Keep several chunks in flight at once. Each worker parses its chunk while it downloads
+            fetched_chunks = executor.map(fetch_chunk, missing_chunks)
+        else:
+            def download_chunk(chunk_pmids):
+                xml_bytes = client.efetch(id=','.join(chunk_pmids), rettype='abstract', retmode='xml', 
+                                    method='POST').content
+                advance_progress('chunks_fetched', job=job)
+                return xml_bytes
+
+            ### Worker processes parse chunks while the threads download the next ones
+            fetched_chunks = parse_chunks_pipelined(download_chunk, missing_chunks, executor, parse_pool)
+
+        for fetched_rows in fetched_chunks:
+            fetched_papers = [dict(zip(PAPERS_COLUMNS, row)) for row in fetched_rows]
+            store.put_many(fetched_papers)
+            stored_papers.update({paper['pmid'] : paper for paper in fetched_papers})
+            advance_progress('chunks_parsed')
+
+        ### Put papers back in search order and apply this query's filters
+        report_progress('filtering')
+        papers_result = [stored_papers[pmid] for pmid in pmids if pmid in stored_papers]
+        papers_result = filter_papers(papers_result, locations, affils, parse_pool)
+
+    print(f'Query for "{query}" from {from_year} onward has downloaded and been parsed in {round(time.time() - time_start, 4)} seconds. It was filtered to {len(papers_result)} rows.')
+    print(f'E-utilities stats for "{query}" : {client.stats()}')
+
+    return papers_result, count_results
 
 
 if __name__ == "__main__":
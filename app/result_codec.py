@@ -0,0 +1,49 @@
+import json
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+### First byte of a section : how the rest of it was serialized and compressed
+MSGPACK_ZSTD = b'M'
+MSGPACK_ZLIB = b'm'
+JSON_ZLIB = b'j'
+
+ZSTD_LEVEL = 6
+
+
+def encode_section(obj):
+    """
+    Compact bytes for a JSON-like `obj` : msgpack compressed with zstd, or whichever of
+    msgpack/zlib/JSON is installed. `decode_section` reads any of them back.
+    """
+    if msgpack is None:
+        return JSON_ZLIB + zlib.compress(json.dumps(obj).encode('utf-8'), 6)
+    packed = msgpack.packb(obj, use_bin_type=True)
+    if zstandard is None:
+        return MSGPACK_ZLIB + zlib.compress(packed, 6)
+    return MSGPACK_ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(packed)
+
+
+def decode_section(blob):
+    if not blob:
+        return None
+    blob = bytes(blob)
+    section_format, data = blob[:1], blob[1:]
+    if section_format == MSGPACK_ZSTD:
+        if zstandard is None or msgpack is None:
+            raise RuntimeError('Result section was written with zstandard and msgpack, install both to read it.')
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data), raw=False)
+    if section_format == MSGPACK_ZLIB:
+        if msgpack is None:
+            raise RuntimeError('Result section was written with msgpack, install it to read it.')
+        return msgpack.unpackb(zlib.decompress(data), raw=False)
+    if section_format == JSON_ZLIB:
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+    raise ValueError(f'Unknown result section format {section_format!r}')
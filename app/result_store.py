@@ -0,0 +1,234 @@
+from sqlalchemy import select, func, and_
+from app.models import ResultEntity, ResultEntityPaper, ResultEntityCount
+from app.result_codec import encode_section, decode_section
+
+
+### Fields of an entity's output dictionary that are stored as rows rather than in `detail`
+PAPER_FIELDS = ['papers_dict', 'papers_links', 'papers_keywords', 'papers_keywords_counts', 'papers_pubtypes', 'papers_pubtype_counts']
+### `result_entity_counts.kind` : output field it is read from
+COUNT_KINDS = {'keyword' : 'papers_keywords_counts', 'pubtype' : 'papers_pubtype_counts'}
+
+entities_table = ResultEntity.__table__
+papers_table = ResultEntityPaper.__table__
+counts_table = ResultEntityCount.__table__
+
+
+def is_error_result(out_dict):
+    return not out_dict or bool(out_dict.get('error'))
+
+
+def write_result_entities(connection, result_id, out_dict):
+    """
+    Replace the `result_entities`, `result_entity_papers` and `result_entity_counts` rows of `result_id`
+    with the output dictionary of `query_author_papers`/`query_affil_papers`.
+
+    `connection` is anything with `execute`, the app passes `db.session` and migrations their bind.
+    """
+    delete_result_entities(connection, result_id)
+    if is_error_result(out_dict):
+        return
+
+    entity_rows = []
+    for rank, (entity_key, obj_dict) in enumerate(out_dict.items()):
+        entity_rows.append({'result_id' : result_id,
+                            'rank' : rank,
+                            'entity_key' : entity_key,
+                            'total_count' : obj_dict.get('total_count', 0),
+                            'detail' : {field : value for field, value in obj_dict.items() if field not in PAPER_FIELDS},
+                            'papers_section' : encode_section(obj_dict.get('papers_dict', []))})
+    connection.execute(entities_table.insert(), entity_rows)
+    entity_ids = dict(connection.execute(select([entities_table.c.rank, entities_table.c.id])\
+                                        .where(entities_table.c.result_id == result_id)).fetchall())
+
+    paper_rows = []
+    count_rows = []
+    for rank, obj_dict in enumerate(out_dict.values()):
+        entity_id = entity_ids[rank]
+        for position, paper in enumerate(obj_dict.get('papers_dict', [])):
+            paper_rows.append({'result_id' : result_id, 'entity_id' : entity_id, 'position' : position, 'pmid' : paper.get('pmid'), 
+                                'title' : paper.get('title'), 'link' : paper.get('link'), 'pubdate' : paper.get('pubdate')})
+        for kind, field in COUNT_KINDS.items():
+            for count_rank, (value, count) in enumerate(obj_dict.get(field, [])):
+                count_rows.append({'result_id' : result_id, 'entity_id' : entity_id, 'kind' : kind,
+                                    'rank' : count_rank, 'value' : value, 'count' : count})
+    if paper_rows:
+        connection.execute(papers_table.insert(), paper_rows)
+    if count_rows:
+        connection.execute(counts_table.insert(), count_rows)
+    print(f'Stored result {result_id} : {len(entity_rows)} entities, {len(paper_rows)} papers in '
+          f'{sum(len(row["papers_section"]) for row in entity_rows)} bytes of paper sections.')
+
+
+def delete_result_entities(connection, result_id):
+    for table in [counts_table, papers_table, entities_table]:
+        connection.execute(table.delete().where(table.c.result_id == result_id))
+
+
+def has_result_entities(connection, result_id):
+    return connection.execute(select([entities_table.c.id]).where(entities_table.c.result_id == result_id).limit(1)).first() is not None
+
+
+def result_totals(connection, result_id):
+    """
+    (number of entities, sum of their `total_count`) for `result_id`.
+    """
+    n_entities, n_results = connection.execute(select([func.count(entities_table.c.id), func.sum(entities_table.c.total_count)])\
+                                                .where(entities_table.c.result_id == result_id)).first()
+    return n_entities, n_results or 0
+
+
+def read_result_entities(connection, result_id, offset=0, limit=None, with_papers=True):
+    """
+    {entity_key : entity output dictionary} for the entities of `result_id` ranked `offset` to `offset + limit`,
+    rebuilt in the same shape `write_result_entities` was given. Only those entities' papers and counts are read.
+
+    With `with_papers=False` the `papers_section`s aren't read or decompressed and each entity only gets
+    `papers_links` and the keyword/pubtype counts, which is all the results tables show.
+    """
+    entity_columns = [entities_table.c.id, entities_table.c.entity_key, entities_table.c.detail]
+    if with_papers:
+        entity_columns.append(entities_table.c.papers_section)
+    entity_query = select(entity_columns).where(entities_table.c.result_id == result_id).order_by(entities_table.c.rank).offset(offset)
+    if limit is not None:
+        entity_query = entity_query.limit(limit)
+    entities = connection.execute(entity_query).fetchall()
+    if not entities:
+        return {}
+    entity_ids = [entity.id for entity in entities]
+
+    links = {entity_id : [] for entity_id in entity_ids}
+    link_query = select([papers_table.c.entity_id, papers_table.c.pmid, papers_table.c.title, papers_table.c.link])\
+                    .where(papers_table.c.entity_id.in_(entity_ids))\
+                    .order_by(papers_table.c.entity_id, papers_table.c.position)
+    for entity_id, pmid, title, link in connection.execute(link_query):
+        links[entity_id].append({'pmid' : pmid, 'title' : title, 'link' : link})
+
+    counts = {(entity_id, kind) : [] for entity_id in entity_ids for kind in COUNT_KINDS}
+    count_query = select([counts_table.c.entity_id, counts_table.c.kind, counts_table.c.value, counts_table.c.count])\
+                    .where(counts_table.c.entity_id.in_(entity_ids))\
+                    .order_by(counts_table.c.entity_id, counts_table.c.kind, counts_table.c.rank)
+    for entity_id, kind, value, count in connection.execute(count_query):
+        counts[(entity_id, kind)].append([value, count])
+
+    out_dict = {}
+    for entity in entities:
+        obj_dict = dict(entity.detail)
+        if with_papers:
+            entity_papers = decode_section(entity.papers_section) or []
+            obj_dict['papers_dict'] = entity_papers
+        obj_dict['papers_links'] = links[entity.id]
+        if with_papers:
+            obj_dict['papers_keywords'] = [paper['mesh_keywords'] for paper in entity_papers]
+        obj_dict['papers_keywords_counts'] = counts[(entity.id, 'keyword')]
+        if with_papers:
+            obj_dict['papers_pubtypes'] = [paper['pubtype_list'] for paper in entity_papers]
+        obj_dict['papers_pubtype_counts'] = counts[(entity.id, 'pubtype')]
+        out_dict[entity.entity_key] = obj_dict
+    return out_dict
+
+
+### Fields the entity and paper endpoints can sort on
+ENTITY_SORT_COLUMNS = {'rank' : entities_table.c.rank, 'key' : entities_table.c.entity_key, 'total_count' : entities_table.c.total_count}
+PAPER_SORT_COLUMNS = {'position' : papers_table.c.position, 'pmid' : papers_table.c.pmid, 'title' : papers_table.c.title, 
+                    'pubdate' : papers_table.c.pubdate}
+
+
+def contains_condition(column, text):
+    return func.lower(column).contains(text.lower(), autoescape=True)
+
+
+def read_entity_rows(connection, result_id, offset=0, limit=None, sort='rank', descending=False, key_filter=None, count_limit=None):
+    """
+    (number of matching entities, [entity rows]) for one page of `result_id`'s entities, sorted on `sort` 
+    (see `ENTITY_SORT_COLUMNS`) and optionally only those whose key contains `key_filter`.
+
+    Rows are the entity's `detail` plus `rank`, `key`, `n_papers` and the first `count_limit` 
+    keyword/pubtype counts. Papers aren't included, see `read_entity_papers`.
+    """
+    condition = entities_table.c.result_id == result_id
+    if key_filter:
+        condition = and_(condition, contains_condition(entities_table.c.entity_key, key_filter))
+    n_entities = connection.execute(select([func.count(entities_table.c.id)]).where(condition)).scalar()
+
+    sort_column = ENTITY_SORT_COLUMNS.get(sort, entities_table.c.rank)
+    entity_query = select([entities_table.c.id, entities_table.c.rank, entities_table.c.entity_key, entities_table.c.detail])\
+                    .where(condition).order_by(sort_column.desc() if descending else sort_column, entities_table.c.rank).offset(offset)
+    if limit is not None:
+        entity_query = entity_query.limit(limit)
+    entities = connection.execute(entity_query).fetchall()
+    if not entities:
+        return n_entities, []
+    entity_ids = [entity.id for entity in entities]
+
+    n_papers = dict(connection.execute(select([papers_table.c.entity_id, func.count(papers_table.c.id)])\
+                                        .where(papers_table.c.entity_id.in_(entity_ids)).group_by(papers_table.c.entity_id)).fetchall())
+    counts = {(entity_id, kind) : [] for entity_id in entity_ids for kind in COUNT_KINDS}
+    count_condition = counts_table.c.entity_id.in_(entity_ids)
+    if count_limit is not None:
+        count_condition = and_(count_condition, counts_table.c.rank < count_limit)
+    count_query = select([counts_table.c.entity_id, counts_table.c.kind, counts_table.c.value, counts_table.c.count])\
+                    .where(count_condition).order_by(counts_table.c.entity_id, counts_table.c.kind, counts_table.c.rank)
+    for entity_id, kind, value, count in connection.execute(count_query):
+        counts[(entity_id, kind)].append([value, count])
+
+    rows = []
+    for entity in entities:
+        row = {'rank' : entity.rank, 'key' : entity.entity_key, 'n_papers' : n_papers.get(entity.id, 0)}
+        row.update(entity.detail)
+        for kind, field in COUNT_KINDS.items():
+            row[field] = counts[(entity.id, kind)]
+        rows.append(row)
+    return n_entities, rows
+
+
+def find_entity_id(connection, result_id, entity_key):
+    return connection.execute(select([entities_table.c.id]).where(and_(entities_table.c.result_id == result_id, 
+                                                                        entities_table.c.entity_key == entity_key))).scalar()
+
+
+def read_entity_papers(connection, entity_id, offset=0, limit=None, sort='position', descending=False, title_filter=None):
+    """
+    (number of matching papers, [`papers_dict` records]) for one page of an entity's papers, sorted on `sort` 
+    (see `PAPER_SORT_COLUMNS`) and optionally only those whose title contains `title_filter`.
+
+    Paging, sorting and filtering run on `result_entity_papers`, then the entity's section is decompressed 
+    once to pick out the page's records.
+    """
+    condition = papers_table.c.entity_id == entity_id
+    if title_filter:
+        condition = and_(condition, contains_condition(papers_table.c.title, title_filter))
+    n_papers = connection.execute(select([func.count(papers_table.c.id)]).where(condition)).scalar()
+
+    sort_column = PAPER_SORT_COLUMNS.get(sort, papers_table.c.position)
+    position_query = select([papers_table.c.position]).where(condition)\
+                        .order_by(sort_column.desc() if descending else sort_column, papers_table.c.position).offset(offset)
+    if limit is not None:
+        position_query = position_query.limit(limit)
+    positions = [row[0] for row in connection.execute(position_query)]
+    if not positions:
+        return n_papers, []
+
+    papers = decode_section(connection.execute(select([entities_table.c.papers_section])\
+                                                .where(entities_table.c.id == entity_id)).scalar()) or []
+    return n_papers, [papers[position] for position in positions]
+
+
+def save_result_output(session, result, out_dict):
+    """
+    Store `out_dict` as `result`'s output. Error outputs go in `result_all`, everything else in the entity tables.
+    """
+    if result.id is None:
+        session.add(result)
+        session.flush()
+    result.length_of_results = len(out_dict.keys())
+    result.result_all = out_dict if is_error_result(out_dict) else None
+    write_result_entities(session, result.id, out_dict)
+
+
+def load_result_output(session, result):
+    """
+    `result`'s whole output dictionary.
+    """
+    if has_result_entities(session, result.id):
+        return read_result_entities(session, result.id)
+    return result.result_all or {}
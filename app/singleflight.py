@@ -0,0 +1,122 @@
+import hashlib
+import json
+import time
+import uuid
+from redis.exceptions import WatchError
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from config import Config
+from app.corpus_cache import normalize_query_params
+from worker import conn
+
+### Job statuses another submission of the same query can wait on
+IN_FLIGHT_STATUSES = ('queued', 'started', 'deferred', 'scheduled')
+STATS_KEY = 'singleflight:stats'
+### A claim's job can take this long to appear in Redis after the key is set
+CLAIM_GRACE_SECONDS = 5
+
+
+def flight_key(query_type, query, from_year, locations, affils):
+    """
+    Key shared by every submission of the same query, see `normalize_query_params`.
+    The API key and the user aren't part of it.
+    """
+    params = normalize_query_params(query, from_year, locations, affils)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+    return f'singleflight:v1:{query_type}:{digest}'
+
+
+def release_flight(key, job_id):
+    """
+    Delete `key` if `job_id` still holds it.
+    """
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            holder_id = pipe.get(key)
+            if holder_id is None or holder_id.decode() != job_id:
+                pipe.unwatch()
+                return
+            pipe.multi()
+            pipe.delete(key)
+            pipe.execute()
+        except WatchError:
+            ### Someone else replaced the claim, it isn't ours to delete anymore
+            pass
+
+
+def in_flight_holder(key, job_id):
+    """
+    The queued or running job holding `key`, or None once `job_id` has claimed it.
+
+    A key left by a finished, failed or expired job is released and claimed again.
+    """
+    deadline = time.time() + CLAIM_GRACE_SECONDS
+    while True:
+        if conn.set(key, job_id, nx=True, ex=int(Config.SINGLEFLIGHT_TTL)):
+            return None
+        holder_id = conn.get(key)
+        if holder_id is None:
+            continue
+        holder_id = holder_id.decode()
+        try:
+            holder = Job.fetch(holder_id, connection=conn)
+            if holder.get_status() in IN_FLIGHT_STATUSES:
+                return holder
+        except NoSuchJobError:
+            ### Claimed but maybe not enqueued yet, give the claimant a moment
+            if time.time() < deadline:
+                time.sleep(0.05)
+                continue
+        release_flight(key, holder_id)
+
+
+def enqueue_once(key, enqueue):
+    """
+    Enqueue a query's job unless an identical one is already queued or running.
+
+    Args:
+        key - String: `flight_key` of the query
+        enqueue - Function: takes a job id and enqueues the job under it
+
+    Returns:
+        (job, coalesced) : the new job, or the in-flight one with `coalesced` True
+    """
+    job_id = str(uuid.uuid4())
+    try:
+        holder = in_flight_holder(key, job_id)
+    except Exception as err:
+        print(f'Singleflight unavailable, enqueueing {job_id} without coalescing : {err}')
+        return enqueue(job_id), False
+
+    if holder is not None:
+        count_flight('coalesced')
+        print(f'Query {key} is already running as job {holder.get_id()}, attaching to it.')
+        return holder, True
+
+    try:
+        job = enqueue(job_id)
+    except Exception:
+        release_flight(key, job_id)
+        raise
+    count_flight('enqueued')
+    return job, False
+
+
+def count_flight(outcome):
+    try:
+        conn.hincrby(STATS_KEY, outcome, 1)
+    except Exception as err:
+        print(f'Singleflight stats not saved : {err}')
+
+
+def flight_stats():
+    """
+    Jobs enqueued and submissions coalesced into an in-flight job since the stats were last reset.
+    """
+    counts = {field.decode() : int(count) for field, count in conn.hgetall(STATS_KEY).items()}
+    enqueued, coalesced = counts.get('enqueued', 0), counts.get('coalesced', 0)
+    submissions = enqueued + coalesced
+    return {'enqueued' : enqueued,
+            'coalesced' : coalesced,
+            'coalesced_rate' : round(coalesced / submissions, 4) if submissions else 0.0}
@@ -0,0 +1,98 @@
+// Formatters for the query_results tables. Rows come a page at a time from /api/results/<id>/entities,
+// an entity's papers are only fetched from .../entities/<key>/papers once its papers cell is opened.
+
+function escapeHtml(text) {
+    return String(text === null || text === undefined ? "" : text)
+        .replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;")
+        .replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+}
+
+// [[value, count], ...] as "value (count)" lines
+function countsFormatter(cell) {
+    return (cell.getValue() || []).map(function(item) {
+        return "<br>" + escapeHtml(item[0]) + " (" + item[1] + ")";
+    }).join("");
+}
+
+// {value : count} as "value (count)" lines
+function valueCountsFormatter(cell) {
+    var counts = cell.getValue() || {};
+    return Object.keys(counts).map(function(value) {
+        return "<div>" + escapeHtml(value) + " <i>(" + counts[value] + ")</i></div>";
+    }).join("");
+}
+
+// {pmid : {value : count}} grouped under each PMID, values cut to `truncate` characters
+function pmidCountsFormatter(truncate) {
+    return function(cell) {
+        var pmidCounts = cell.getValue() || {};
+        return Object.keys(pmidCounts).map(function(pmid) {
+            var counts = pmidCounts[pmid];
+            return "<b>" + escapeHtml(pmid) + "</b><br>" + Object.keys(counts).map(function(value) {
+                var shown = truncate ? value.slice(0, truncate) : value;
+                return "<div title=\"" + escapeHtml(value) + "\">" + escapeHtml(shown) + " <i>(" + counts[value] + ")</i></div>";
+            }).join("") + "<br>";
+        }).join("");
+    };
+}
+
+function papersFormatter(cell) {
+    var data = cell.getRow().getData();
+    var html = "<a href=\"#\" class=\"toggle-papers\">" + (data._papers_open ? "Hide " : "Show ") + data.n_papers + " papers</a>";
+    if (data._papers_open) {
+        html += data._papers_html === undefined ? "<div>Loading...</div>" : data._papers_html;
+        if (data._papers_page < data._papers_last_page) {
+            html += "<br><a href=\"#\" class=\"more-papers\">More papers</a>";
+        }
+    }
+    return html;
+}
+
+function loadPapers(row, resultUrl, page) {
+    var url = resultUrl + "/" + encodeURIComponent(row.getData().key) + "/papers";
+    $.getJSON(url, {page : page, size : 100}, function(response) {
+        var html = response.data.map(function(paper) {
+            return "<div><a title=\"" + escapeHtml(paper.title) + "\" href=\"" + escapeHtml(paper.link) + "\">" +
+                escapeHtml(paper.title) + "</a> <i>" + escapeHtml(paper.pubdate) + "</i></div>";
+        }).join("");
+        row.update({_papers_html : (row.getData()._papers_html || "") + html,
+                    _papers_page : page, _papers_last_page : response.last_page});
+        row.normalizeHeight();
+    });
+}
+
+// cellClick for the papers column : opens/closes the list and fetches the next page of it
+function papersCellClick(resultUrl) {
+    return function(e, cell) {
+        var target = $(e.target);
+        if (!target.is("a.toggle-papers, a.more-papers")) {
+            return;
+        }
+        e.preventDefault();
+        var row = cell.getRow();
+        var data = row.getData();
+        if (target.is("a.more-papers")) {
+            loadPapers(row, resultUrl, data._papers_page + 1);
+            return;
+        }
+        row.update({_papers_open : !data._papers_open});
+        if (data._papers_html === undefined && !data._papers_loading) {
+            row.update({_papers_loading : true});
+            loadPapers(row, resultUrl, 1);
+        }
+        row.normalizeHeight();
+    };
+}
+
+function resultTable(element, resultUrl, pageSize, columns) {
+    return new Tabulator(element, {
+        height : "600px",
+        layout : "fitDataFill",
+        ajaxURL : resultUrl,
+        pagination : "remote",
+        paginationSize : pageSize,
+        ajaxSorting : true,
+        ajaxFiltering : true,
+        columns : columns
+    });
+}
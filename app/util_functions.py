@@ -11,16 +11,36 @@ import itertools
 from fuzzywuzzy import fuzz
 from nltk.corpus import stopwords
 from fuzzywuzzy import fuzz
+from app.location_cache import location_cache
+from app.gazetteer import gazetteer
+from app.fuzzy_match import AffiliationMatcher
+from app.affiliation_clusters import AffiliationClusters
+from app.author_index import AuthorIndex
+from app.paa_index import PaperAuthorAffilIndex, paa_to_frame
+from config import Config
 
 
 dir_ = os.path.dirname(os.path.realpath(__file__))
 
 stopwords_w2v = set(open(os.path.join(dir_, "..", "stopwords.txt"),'r').read().splitlines())
 
+### Characters `preprocess` drops, as a translate table. Non-ASCII digits are left to a regex.
+preprocess_table = str.maketrans('', '', '-;,.0123456789')
+
 def preprocess(text):
+    """
+    Normalized form of an affiliation used to group and match them: stopwords dropped, lowercased, 
+    punctuation and digits removed.
+
+    `create_paper_author_affil_index` stores this as each entry's `proc_affiliation` so later stages 
+    don't re-run it on every row.
+    """
     if text:
         text = re.sub(' +', ' ', text)
-        text = " ".join([re.sub('[\-;,\.\d]', '', word.lower()) for word in text.split(' ') if word not in stopwords_w2v]).strip()
+        text = " ".join([word.lower() for word in text.split(' ') if word not in stopwords_w2v]).translate(preprocess_table)
+        if not text.isascii():
+            text = re.sub('\d', '', text)
+        text = text.strip()
     return text
 
 def get_location(affiliation):
@@ -31,79 +51,120 @@ def get_location(affiliation):
 
     If no countries are found, leave it blank.
 
+    Results are memoized in `location_cache` (in-process LRU in front of a Redis hash) 
+    since the same institutions come up across papers and across queries.
+
     Args:
         affiliation - Str: 
     Returns:
         Str: geotext's attempt to extract `City, Country` from affiliation
 
     """
-    places = GeoText(affiliation)
-    if places:
-        city_str = ' '.join(set([city for city in places.cities if city != 'University'])).strip()
-        if len(places.countries) == 0:
-            country_str = ''
-        else:
-            country_str = places.countries[0]
-        locations = f"{city_str}, {country_str}"
-    else:
-        locations = ''
-    return locations
+    if not affiliation:
+        return gazetteer.locations([affiliation])[0]
+    return location_cache.get(affiliation, lambda affil: gazetteer.locations([affil])[0])
+
+
+def get_locations(affiliations):
+    """
+    Batch version of `get_location`. Cache misses are geocoded together in one pass of the gazetteer.
+
+    Args:
+        affiliations - List: affiliation strings
+    Returns:
+        List: `City, Country` string for each affiliation, in order
+    """
+    return location_cache.get_many(affiliations, gazetteer.locations)
 
 
 def create_paper_author_affil_index(papers_data):
     """
-    Create a list of dictionaries where each element represents an author + paper + affiliation combination. 
+    Create the index of author + paper + affiliation combinations. 
         - Multi-author papers and multiple affiliation authors will each generate 
-            multiple elements for an individual paper in the resulting list
+            multiple rows for an individual paper in the index
 
     If any errors, print the error and the author/affiliation to the console and skip. 
 
     Args:
         papers_data - List: Elements in list are dictionaries of data generated from XML parser
     Returns:
-        List: Elements are dictionaries of author-affiliation-paper data points containing individual author-affiliation-pmid combinations.
-    """
-    author_affils = []
-    ### Loop through papers from results
-    for paper_dictionary in papers_data:
-        ### Loop through paper's authors
-        for author in paper_dictionary['author_list']:
-            ### Loop through author's affiliations
-            for author_affil in author[1]:
-                try:
-                    author_affils.append({'author_list' : author[0], 
-                                    'author_string' : author[0][2] + ", " + author[0][0],
-                                    'affiliations' : author_affil, 
-                                    'locations' : get_location(author_affil), 
-                                    'title' : paper_dictionary['title'],
-                                    'pmid' : paper_dictionary['pmid']
-                                   })             
-                except Exception as err:
-                    print(f"Error making authors entry with {author} and {affil} // {get_location(affil)} \n{err}")
-                    pass
-    return author_affils
-
-
-def count_obj_occurance(matching_value, obj_key, paa_cross_mapping, pmid_suffix, n_affiliations):
+        PaperAuthorAffilIndex: Columnar index of author-affiliation-pmid combinations. Iterating over it yields 
+            one dictionary per combination with `author_list`, `author_string`, `author_group`, `affiliations`, 
+            `proc_affiliation`, `affiliation_group`, `locations`, `title` and `pmid`.
     """
-    
+    ### Geocode every distinct affiliation in one batch
+    unique_affils = list(set(author_affil for paper_dictionary in papers_data for author in paper_dictionary['author_list'] \
+                            for author_affil in author[1] if isinstance(author_affil, str)))
+    affil_locations = dict(zip(unique_affils, get_locations(unique_affils)))
+    ### Normalize every distinct affiliation once, later stages group and match on `proc_affiliation`
+    affil_procs = {affil : preprocess(affil) for affil in unique_affils}
+    affil_groups = group_affiliations(affil_procs.values())
+    author_groups = group_authors(papers_data, {affil : affil_groups[affil_procs[affil]] for affil in unique_affils})
+
+    def index_rows():
+        ### Loop through papers from results
+        for paper_dictionary in papers_data:
+            ### Loop through paper's authors
+            for position, author in enumerate(paper_dictionary['author_list']):
+                ### Loop through author's affiliations
+                for author_affil in author[1]:
+                    try:
+                        author_string = author[0][2] + ", " + author[0][0]
+                        values = {'author_string' : author_string, 
+                                'author_group' : author_groups.get((paper_dictionary['pmid'], position), author_string),
+                                'affiliations' : author_affil, 
+                                'proc_affiliation' : affil_procs[author_affil], 
+                                'affiliation_group' : affil_groups[affil_procs[author_affil]], 
+                                'locations' : affil_locations[author_affil]}
+                    except Exception as err:
+                        print(f"Error making authors entry with {author} and {author_affil} \n{err}")
+                        continue
+                    yield paper_dictionary['pmid'], paper_dictionary['title'], paper_dictionary['author_list'], position, values
+
+    return PaperAuthorAffilIndex.from_rows(index_rows())
+
+
+def group_affiliations(proc_affiliations):
+    """
+    Key the affiliation view groups each preprocessed affiliation under. 
+
+    With `AFFILIATION_GROUPING = 'cluster'` near-duplicates share their institution cluster's label 
+    (see `app.affiliation_clusters`), with 'exact' every preprocessed affiliation is its own group.
+
+    Returns:
+        Dict: {proc_affiliation : group label}
+    """
+    proc_affiliations = set(proc_affiliations)
+    if Config.AFFILIATION_GROUPING == 'cluster':
+        groups = AffiliationClusters().assign(proc_affiliations)
+        return {proc : groups.get(proc, proc) for proc in proc_affiliations}
+    return {proc : proc for proc in proc_affiliations}
+
+
+def group_authors(papers_data, affil_groups):
+    """
+    Key the author view groups each author of each paper under.
 
+    With `AUTHOR_GROUPING = 'disambiguated'` it is the label of the person the mention is attached to 
+    in the author index (see `app.author_index`), with 'name' it is the plain `author_string`.
 
     Args:
+        papers_data - List: Elements in list are dictionaries of data generated from XML parser
+        affil_groups - Dict: {raw affiliation : affiliation group}
+    Returns:
+        Dict: {(pmid, author position) : group label}, missing authors fall back to `author_string`
+    """
+    if Config.AUTHOR_GROUPING != 'disambiguated':
+        return {}
+    labels = AuthorIndex().assign(papers_data, affil_groups)
+    return {(str(pmid), position) : label for (pmid, position), label in labels.items()}
 
-        affil_loc - Str: 'affiliations' or 'locations' to determine which the function is looking at
+
+def reformat_pmid_counts(author_affil_counts, n_affiliations):
+    """
+    Turn a Counter of *PMID*__*Location/Affiliation* strings into {pmid : {location/affiliation : count}}
+    for the `n_affiliations * 3` most common.
     """
-    ### Create a list of *PMID*__*Location/Affiliation* strings from each author-paper-affiliation data point 
-    ### if the data point's author matches `author_name`
-    if obj_key == 'affiliations' and obj_key == 'affiliations':
-        author_affiliations = [paper_data.get('pmid') + '__' + paper_data.get(pmid_suffix, '') for paper_data in paa_cross_mapping \
-                                 if preprocess(paper_data.get(obj_key)) == matching_value]
-    else:
-        author_affiliations = [paper_data.get('pmid') + '__' + paper_data.get(pmid_suffix, '') for paper_data in paa_cross_mapping \
-                                 if paper_data.get(obj_key) == matching_value]
-    
-    ### Count up the number of *PMID*__*Location/Affiliation*
-    author_affil_counts = Counter(author_affiliations)
     ### Create a dictionary of *Location/Affiliation* : count
     reformatted_affiliations = {}
     for pmid_affil, affil_count in author_affil_counts.most_common(n_affiliations * 3):
@@ -121,137 +182,85 @@ def count_obj_occurance(matching_value, obj_key, paa_cross_mapping, pmid_suffix,
     
     return reformatted_affiliations
 
-def count_papers(matching_value, papers_data, matching_field):
-    if matching_field == 'author_string':
-        author_papers = list(set([paper_data.get('pmid') for paper_data in \
-            papers_data if paper_data.get('pmid') and paper_data.get(matching_field) == matching_value]))
+### How `group_papers_by_top_obj` builds an object's entry for each `obj_key` :
+### (field rows are grouped on, name the object is reported under, {output field : field counted per PMID})
+OBJ_GROUPINGS = {'affiliations' : ('affiliation_group', 'proc_Affiliation', 
+                                    {'authors' : 'author_group', 'raw_affiliations' : 'affiliations'}),
+                'author_string' : ('author_group', 'author', 
+                                    {'locations' : 'locations', 'affiliations' : 'affiliations'})}
+
 
-    elif matching_field == 'affiliations':
-        author_papers = list(set([paper_data.get('pmid') for paper_data in \
-            papers_data if paper_data.get('pmid') and preprocess(paper_data.get(matching_field)) == matching_value]))
-    return len(author_papers)
+def index_rows_by_obj(paa_cross_mapping, group_field):
+    """
+    Single pass over `paa_cross_mapping` mapping each value of `group_field` to its rows, 
+    in the order the values first appear.
+    """
+    obj_rows = {}
+    for paa_dict in paa_cross_mapping:
+        obj = paa_dict.get(group_field)
+        if obj in obj_rows:
+            obj_rows[obj].append(paa_dict)
+        else:
+            obj_rows[obj] = [paa_dict]
+    return obj_rows
 
 
-def map_author_to_affil(papers_data, n_affiliations=3):
+def group_papers_by_top_obj(paa_cross_mapping, obj_key, n_affiliations=3, n_top=200, count_fields=None):
     """
-    Get `n` most common authors, find their top 3 affiliations and their geographic locations. 
+    Get `n_top` most common authors/affiliations, count their papers and their top affiliations, locations or authors. 
     
-    Filter list of authors by whether one of their affiliation locations lands in a location_of_interest
+    Rows are indexed by object in one pass, then each top object's counts only look at its own rows.
+    A `PaperAuthorAffilIndex` is indexed on its code columns instead of row by row.
     
     Args:
-        author_affils - List: Looks like;
+        paa_cross_mapping - PaperAuthorAffilIndex or List of the dictionaries it yields. Looks like;
             [
                 {
                 'author_list' : author[0], 
                 'author_string' : author[0][2] + ", " + author[0][0],
+                'author_group' : disambiguated person label of `author_string`, 
                 'affiliations' : author_affil, 
+                'proc_affiliation' : preprocess(author_affil), 
+                'affiliation_group' : institution cluster label of `proc_affiliation`, 
                 'locations' : get_location(author_affil), 
                 'title' : paper_dictionary['title'],
                 'pmid' : paper_dictionary['pmid']
                 }
             ]
-    
+        obj_key - Str: `affiliations` (grouped on `affiliation_group`), `author_string` (grouped on `author_group`) or any other field 
+            of the mapping, see `OBJ_GROUPINGS`
+        count_fields - Dict: {output field : mapping field} counted per PMID for each object. 
+            Defaults to the `OBJ_GROUPINGS` entry, or authors and affiliations for other keys.
     Returns:
-        List - List elements are dictionaries containing data on an author's top 3 affiliations 
-            if they land in the supplied `locations_of_interest`. 
-    """
-
-    papers_df = pd.DataFrame(papers_data)
-    top_authors = dict(Counter(papers_df['author_string']).most_common(200))
-    #Get Affiliations for Top 200 Authors
-    author_locs_affils = []
-    ### Count up most common authors
-    author_list = list(top_authors.keys())
-
-    for author_name in author_list:
-
-        author_locs_affils.append({'author' : author_name, 
-                                   'total_papers' : count_papers(author_name, papers_data, 'author_string'),
-                                   'locations' : count_obj_occurance(
-                                                matching_value=author_name, 
-                                                paa_cross_mapping=papers_data, 
-                                                pmid_suffix='locations', 
-                                                n_affiliations=n_affiliations, 
-                                                obj_key='author_string'),
-                                   'affiliations' : count_obj_occurance(
-                                                matching_value=author_name, 
-                                                paa_cross_mapping=papers_data, 
-                                                pmid_suffix='affiliations', 
-                                                n_affiliations=n_affiliations, 
-                                                obj_key='author_string')
-                                   })
-
-    return author_locs_affils, top_authors 
-
-def group_papers_by_top_obj(paa_cross_mapping, obj_key, n_affiliations=3):
-    """
-    Get `n` most common authors, find their top 3 affiliations and their geographic locations. 
-    
-    Filter list of authors by whether one of their affiliation locations lands in a location_of_interest
-    
-    Args:
-        author_affils - List: Looks like;
-            [
-                {
-                'author_list' : author[0], 
-                'author_string' : author[0][2] + ", " + author[0][0],
-                'affiliations' : author_affil, 
-                'locations' : get_location(author_affil), 
-                'title' : paper_dictionary['title'],
-                'pmid' : paper_dictionary['pmid']
-                }
-            ]
-        Options for obj_key are: `affiliations` or ...
-    Returns:
-        List - List elements are dictionaries containing data on an author's top 3 affiliations 
-            if they land in the supplied `locations_of_interest`. 
+        List - List elements are dictionaries of each top object's total papers and per-PMID counts, most common first
+        List - The top objects
     """
-
-    obj_list = pd.DataFrame(paa_cross_mapping)[obj_key]
-    if obj_key == 'affiliations':
-        obj_list = [preprocess(affil) for affil in obj_list]
-    top_objs = dict(Counter(obj_list).most_common(200))
-    #Get Affiliations for Top 200 Authors
-    out_list = []
-    ### Count up most common authors
+    group_field, obj_name, default_count_fields = OBJ_GROUPINGS.get(obj_key, 
+                                            (obj_key, obj_key, {'authors' : 'author_group', 'affiliations' : 'affiliations'}))
+    count_fields = count_fields or default_count_fields
+
+    if isinstance(paa_cross_mapping, PaperAuthorAffilIndex):
+        ### Counts come straight from the code column, only the top objects' rows are looked up and 
+        ### counted fields are decoded once as whole columns
+        top_objs = dict(Counter(paa_cross_mapping.value_counts(group_field)).most_common(n_top))
+        obj_rows = paa_cross_mapping.rows_by_value(group_field, top_objs.keys())
+        columns = {field : paa_cross_mapping.column(field) for field in set(count_fields.values()) | {'pmid'}}
+        row_values = lambda rows, field : columns[field][rows]
+    else:
+        obj_rows = index_rows_by_obj(paa_cross_mapping, group_field)
+        top_objs = dict(Counter({obj : len(rows) for obj, rows in obj_rows.items()}).most_common(n_top))
+        row_values = lambda rows, field : [paa_dict.get(field, '') for paa_dict in rows]
     top_obj_list = list(top_objs.keys())
 
-
+    out_list = []
     for obj in top_obj_list:
-        obj_dict = {}
-        if obj_key == 'affiliations':
-            obj_dict = {'proc_Affiliation' : obj, 
-               'total_papers' : count_papers(obj, paa_cross_mapping, 'affiliations'),
-               'authors' : count_obj_occurance(
-                            matching_value=obj, 
-                            paa_cross_mapping=paa_cross_mapping, 
-                            pmid_suffix='author_string', 
-                            n_affiliations=n_affiliations, 
-                            obj_key='affiliations'),
-               'raw_affiliations' : count_obj_occurance(
-                            matching_value=obj, 
-                            paa_cross_mapping=paa_cross_mapping, 
-                            pmid_suffix='affiliations', 
-                            n_affiliations=n_affiliations, 
-                            obj_key='affiliations')}
-
-        elif obj_key == 'author_string':
-            obj_dict = {'author' : obj, 
-                        'total_papers' : count_papers(obj, paa_cross_mapping, 'author_string'),
-                        'locations' : count_obj_occurance(
-                            matching_value=obj, 
-                            paa_cross_mapping=paa_cross_mapping, 
-                            pmid_suffix='locations', 
-                            n_affiliations=n_affiliations, 
-                            obj_key='author_string'),
-                        'affiliations' : count_obj_occurance(
-                            matching_value=obj, 
-                            paa_cross_mapping=paa_cross_mapping, 
-                            pmid_suffix='affiliations', 
-                            n_affiliations=n_affiliations, 
-                            obj_key='author_string')
-                        }
-
+        rows = obj_rows[obj]
+        pmids = row_values(rows, 'pmid')
+        obj_dict = {obj_name : obj, 
+                    'total_papers' : len(set([pmid for pmid in pmids if pmid]))}
+        for out_field, count_field in count_fields.items():
+            obj_dict[out_field] = reformat_pmid_counts(Counter([pmid + '__' + value \
+                                                                for pmid, value in zip(pmids, row_values(rows, count_field))]), n_affiliations)
         out_list.append(obj_dict)
 
     return out_list, top_obj_list 
@@ -266,7 +275,7 @@ def author_affil_total_df(affiliations_by_author, n_authors=25):
 
     ### affiliations_by_author_df['totalPapers'] = affiliations_by_author_df['author'].map(top_authors)
     ### Removed because occasionally totalPapers was < sum of counts of topAffiliations which seems like a no-no
-    ### `total_papers` is calculated in the `map_author_to_affil()` function and is calculated before 
+    ### `total_papers` is calculated in `group_papers_by_top_obj()` and is calculated before 
     ### undesirable locations are filtered out
     affiliations_by_author_df['totalPapers'] = affiliations_by_author_df['total_papers']
 
@@ -286,96 +295,171 @@ def author_affil_total_df(affiliations_by_author, n_authors=25):
     return out_df.head(n_authors)
 
 
-def get_obj_papers(obj_of_interest, obj_key, authors_affils, papers_data):
+def index_obj_pmids(authors_affils, obj_key):
+    """
+    {affiliation group or author : [pmids]} from the paper-author-affiliation mapping.
+    """
     if obj_key == 'affiliations':
-        obj_pmids = [{obj_key: preprocess(author_affil_dict.get(obj_key)), \
-                    'pmid' : author_affil_dict['pmid']} for author_affil_dict in authors_affils]
-
+        index_key = 'affiliation_group'
+    elif obj_key == 'author_string':
+        index_key = 'author_group'
     else:
-        obj_pmids = [{obj_key: author_affil_dict.get(obj_key), \
-                    'pmid' : author_affil_dict['pmid']} for author_affil_dict in authors_affils]
-    matching_pmids = []
+        index_key = obj_key
+    if isinstance(authors_affils, PaperAuthorAffilIndex):
+        pmids = authors_affils.column('pmid')
+        return {obj : pmids[rows].tolist() for obj, rows in authors_affils.rows_by_value(index_key).items()}
+    obj_pmids = {}
+    for author_affil_dict in authors_affils:
+        obj_pmids.setdefault(author_affil_dict.get(index_key), []).append(author_affil_dict['pmid'])
+    return obj_pmids
+
+
+def match_obj_pmids(obj_of_interest, obj_key, obj_pmids, matcher=None):
+    """
+    Set of PMIDs for `obj_of_interest`. Authors and clustered affiliation groups match exactly. With 
+    `AFFILIATION_GROUPING = 'exact'`, affiliations match any preprocessed affiliation `matcher` 
+    scores above `AFFIL_MATCH_THRESHOLD`.
+    """
+    if obj_key == 'affiliations' and Config.AFFILIATION_GROUPING != 'cluster':
+        if matcher is None:
+            matcher = AffiliationMatcher(obj_pmids.keys())
+        return set(pmid for matched_obj in matcher.match(obj_of_interest) for pmid in obj_pmids[matched_obj])
+    return set(obj_pmids.get(obj_of_interest, []))
+
+
+def get_obj_papers(obj_of_interest, obj_key, authors_affils, papers_data, matcher=None, obj_pmids=None):
+    """
+    Papers for `obj_of_interest`, see `match_obj_pmids`.
+
+    `matcher` and `obj_pmids` ({affiliation group or author : [pmids]}) are built from 
+    `authors_affils` if not given, pass them in when looking up several objects.
+    """
+    if obj_pmids is None:
+        obj_pmids = index_obj_pmids(authors_affils, obj_key)
+
     ### Find an authors PMIDs
-    if obj_key == 'affiliations':
-        matching_pmids = [obj_pmid['pmid'] for obj_pmid in obj_pmids if fuzz.partial_ratio(obj_pmid[obj_key], obj_of_interest) > .9]
-    else:
-        matching_pmids = [obj_pmid['pmid'] for obj_pmid in obj_pmids if obj_pmid[obj_key] == obj_of_interest]
+    matching_pmids = match_obj_pmids(obj_of_interest, obj_key, obj_pmids, matcher)
     
     matching_papers = [paper for paper in papers_data if paper['pmid'] in matching_pmids]
         
     return matching_papers
 
 
+### Columns of `get_top_obj_papers`, the object's columns then the paper's
+TOP_OBJ_COLUMNS = ['join_obj', 'raw_join_obj']
+TOP_OBJ_PAPER_COLUMNS = ['title', 'pubdate', 'link', 'pmid', 'pubtype_list', 'all_authors_list', 'mesh_keywords', 'other_ids']
+
+
+def top_obj_paper_values(paper):
+    """
+    `TOP_OBJ_PAPER_COLUMNS` values for a paper from `papers_data`.
+    """
+    return [paper['title'], 
+            paper['pubdate'], 
+            paper['link'], 
+            paper['pmid'],
+            list(paper['pub_type_list']),
+            ",".join([author_affil[0][2] + ', ' + author_affil[0][0] for author_affil in paper['author_list']]), 
+            list(paper['mesh_keywords'].keys()),
+            ",".join(paper['other_ids'].values())]
+
+
 def get_top_obj_papers(top_objs, authors_affils, papers_data, obj_key):
-    top_obj_papers = {}
+    """
+    DataFrame with a row for each top object and each of its papers, objects in `top_objs` order 
+    and papers in `papers_data` order. Each object's rows are `join_obj` (the object, preprocessed 
+    for fuzzy affiliation matching), `raw_join_obj` and the paper's `TOP_OBJ_PAPER_COLUMNS`.
+
+    The paper columns are formatted once per matched paper however many objects share it.
+    """
+    ### Index the mapping once for every object's lookup
+    obj_pmids = index_obj_pmids(authors_affils, obj_key)
+    fuzzy_affiliations = obj_key == 'affiliations' and Config.AFFILIATION_GROUPING != 'cluster'
+    matcher = None
+    if fuzzy_affiliations:
+        matcher = AffiliationMatcher(obj_pmids.keys())
+    paper_positions = {paper['pmid'] : position for position, paper in enumerate(papers_data)}
+
+    paper_values = {}
+    rows = []
+    seen = set()
     for obj_of_interest in top_objs:
         raw_obj_of_interest = obj_of_interest
-        if obj_key == 'affiliations':
+        if fuzzy_affiliations:
             obj_of_interest = preprocess(obj_of_interest)
-        matchedPapers_dicts = get_obj_papers(obj_of_interest=obj_of_interest, obj_key = obj_key, 
-                                            authors_affils=authors_affils, papers_data=papers_data)
+        matching_pmids = match_obj_pmids(obj_of_interest, obj_key, obj_pmids, matcher)
+        for pmid in sorted((pmid for pmid in matching_pmids if pmid in paper_positions), key=paper_positions.get):
+            ### Two top objects can preprocess to the same `join_obj`, keep its first rows
+            if (obj_of_interest, pmid) in seen:
+                continue
+            seen.add((obj_of_interest, pmid))
+            if pmid not in paper_values:
+                paper_values[pmid] = top_obj_paper_values(papers_data[paper_positions[pmid]])
+            rows.append([obj_of_interest, raw_obj_of_interest] + paper_values[pmid])
 
-        top_obj_papers = {f"{obj_of_interest}_{matchedPaper['pmid']}" : {
-                        'join_obj' : obj_of_interest, 
-                        'raw_join_obj' : raw_obj_of_interest,
-                        'title' : matchedPaper['title'], 
-                        'pubdate' : matchedPaper['pubdate'], 
-                        'link' : matchedPaper['link'], 
-                        'pmid' : matchedPaper['pmid'],
-                        'pubtype_list' : list(matchedPaper['pub_type_list']),
-                        'all_authors_list' : ",".join([author_affil[0][2] + ', ' + author_affil[0][0] for author_affil in matchedPaper['author_list']]), 
-                        'mesh_keywords' : list(matchedPaper['mesh_keywords'].keys()),
-                        'other_ids' : ",".join(matchedPaper['other_ids'].values())
-                        } for matchedPaper in matchedPapers_dicts}
+    return pd.DataFrame(rows, columns=TOP_OBJ_COLUMNS + TOP_OBJ_PAPER_COLUMNS, dtype=object)
 
-            
-    return top_obj_papers
+
+def sorted_item_counts(item_lists):
+    """
+    (item, count) for every item in `item_lists`, most common first.
+    """
+    return sorted(list(Counter([item for sublist in item_lists for item in sublist]).items()), key=lambda x: x[1], reverse=True)
 
 
+def iter_out_obj_dicts(affil_authors, big_df, obj_key):
+    """
+    (object, output dictionary of its counts and papers) for each top object, built one object at a time.
+
+    `big_df` is partitioned by object in one pass : rows are deduplicated on (object, PMID) and their 
+    records bucketed by object, so each object's `papers_dict`, links, keywords and publication types 
+    come from its own bucket instead of a scan of `big_df`. The rest of an object's output is only 
+    computed when it's reached.
+    """
+    if obj_key == 'affiliations':
+        obj_key = 'proc_Affiliation'
+
+    ### One record per object and paper, in `big_df` order
+    obj_papers = {}
+    papers_df = big_df.drop_duplicates(subset=[obj_key, 'pmid']).drop(['raw_join_obj'], axis=1)
+    for paper in papers_df.to_dict('records'):
+        obj_papers.setdefault(paper[obj_key], []).append(paper)
+
+    for obj_dict in affil_authors:
+        if obj_key == 'proc_Affiliation':
+            locations = [[get_location(affil) for affil in affils_count_dict.keys()] for affils_count_dict in obj_dict['raw_affiliations'].values()]
+            locations = [item for sublist in locations for item in sublist]
+            location_counts = Counter(locations)
+            out_obj_dict = {'processed_affiliation' : obj_dict['proc_Affiliation'], 
+                            'total_count' : obj_dict['total_papers'],
+                            'authors' : obj_dict['authors'], 
+                            'raw_affiliations' : obj_dict['raw_affiliations'],
+                            'locations' : location_counts}
+        elif obj_key == 'author':
+            out_obj_dict = {'author' : obj_dict['author'], 
+                    'total_count' : obj_dict['total_papers'],
+                    'affiliations' : obj_dict['affiliations'],
+                    'locations' : obj_dict['locations']}
+
+        papers = obj_papers.get(obj_dict[obj_key], [])
+        out_obj_dict['papers_dict'] = papers
+        out_obj_dict['papers_links'] = [{'pmid' : paper['pmid'], 'title' : paper['title'], 'link' : paper['link']} for paper in papers]
+        out_obj_dict['papers_keywords'] = [paper['mesh_keywords'] for paper in papers]
+        out_obj_dict['papers_keywords_counts'] = sorted_item_counts(out_obj_dict['papers_keywords'])
+
+        out_obj_dict['papers_pubtypes'] = [paper['pubtype_list'] for paper in papers]
+        out_obj_dict['papers_pubtype_counts'] = sorted_item_counts(out_obj_dict['papers_pubtypes'])
+
+        yield obj_dict[obj_key], out_obj_dict
+
 
 def create_out_dict_obj_index(affil_authors, big_df, obj_key):
+    """
+    Output dictionary of each top object's counts and papers, keyed by object. See `iter_out_obj_dicts`.
+    """
     if affil_authors:
-        out_dict = {}
-        if obj_key == 'affiliations':
-            obj_key = 'proc_Affiliation'
-        for obj_dict in affil_authors:
-            
-            #affil_papers_df = big_df.loc[big_df[obj_key] == obj_dict[obj_key], :]
-            obj_papers_titles_links = big_df.loc[big_df[obj_key] == obj_dict[obj_key], ['pmid', 'title', 'link']].drop_duplicates()
-            obj_papers_pmids_keywords = big_df.loc[big_df[obj_key] == obj_dict[obj_key], ['pmid', 'mesh_keywords']].drop_duplicates(subset=['pmid'])
-            obj_papers_pmids_pubtypes = big_df.loc[big_df[obj_key] == obj_dict[obj_key], ['pmid', 'pubtype_list']].drop_duplicates(subset=['pmid'])
-            
-
-            if obj_key == 'proc_Affiliation':
-                locations = [[get_location(affil) for affil in affils_count_dict.keys()] for affils_count_dict in obj_dict['raw_affiliations'].values()]
-                locations = [item for sublist in locations for item in sublist]
-                location_counts = Counter(locations)
-                out_obj_dict = {'processed_affiliation' : obj_dict['proc_Affiliation'], 
-                                'total_count' : obj_dict['total_papers'],
-                                'authors' : obj_dict['authors'], 
-                                'raw_affiliations' : obj_dict['raw_affiliations'],
-                                'locations' : location_counts}
-            elif obj_key == 'author':
-                out_obj_dict = {'author' : obj_dict['author'], 
-                        'total_count' : obj_dict['total_papers'],
-                        'affiliations' : obj_dict['affiliations'],
-                        'locations' : obj_dict['locations']}
-
-
-            out_obj_dict['papers_dict'] = big_df.loc[big_df[obj_key] == obj_dict[obj_key], :].drop_duplicates(subset=['pmid']).drop(['raw_join_obj'], axis=1).to_dict('records')
-            out_obj_dict['papers_links'] = obj_papers_titles_links.to_dict('records')
-            out_obj_dict['papers_keywords'] = [paper['mesh_keywords'] for paper in obj_papers_pmids_keywords.to_dict('records')]
-            out_obj_dict['papers_keywords_counts'] = sorted(list(Counter([item for sublist in out_obj_dict['papers_keywords'] \
-                for item in sublist]).items()), key=lambda x: x[1], reverse=True)
-
-            out_obj_dict['papers_pubtypes'] = [paper['pubtype_list'] for paper in obj_papers_pmids_pubtypes.to_dict('records')]
-            out_obj_dict['papers_pubtype_counts'] = sorted(list(Counter([item for sublist in out_obj_dict['papers_pubtypes'] \
-                for item in sublist]).items()), key=lambda x: x[1], reverse=True)
-
-
-            out_dict[obj_dict[obj_key]] = out_obj_dict
-    
+        out_dict = dict(iter_out_obj_dicts(affil_authors, big_df, obj_key))
     else:
         out_dict = {'error' : 'no results for this query'}
 
-    return out_dict
\ No newline at end of file
+    return out_dict
@@ -0,0 +1,81 @@
+"""
+Compare per-affiliation `GeoText` geocoding with the batch `Gazetteer` on 100k affiliations.
+
+Affiliations come from recorded efetch payloads (see `bench_parse_pool.py --record`) when 
+`--payload-dir` is given, otherwise they are generated from the gazetteer's own city and country names.
+That both return identical `City, Country` strings is checked by `GazetteerCase` in tests.py.
+
+    python benchmarks/bench_gazetteer.py --payload-dir payloads
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from xml.etree.ElementTree import fromstring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from geotext import GeoText
+from app.gazetteer import gazetteer
+from bench_parse_pool import load_payloads
+
+
+def geotext_location(affiliation):
+    """
+    `get_location` as it was before the gazetteer, one `GeoText` per affiliation.
+    """
+    places = GeoText(affiliation)
+    if places:
+        city_str = ' '.join(set([city for city in places.cities if city != 'University'])).strip()
+        if len(places.countries) == 0:
+            country_str = ''
+        else:
+            country_str = places.countries[0]
+        locations = f"{city_str}, {country_str}"
+    else:
+        locations = ''
+    return locations
+
+
+def payload_affiliations(payload_dir):
+    affiliations = []
+    for payload in load_payloads(payload_dir):
+        affiliations += [affil.text for affil in fromstring(payload).iter('Affiliation') if affil.text]
+    return affiliations
+
+
+def synthetic_affiliations(n, seed=0):
+    rand = random.Random(seed)
+    cities = [city.title() for city in rand.sample(list(GeoText.index.cities), 2000)]
+    countries = [country.title() for country in GeoText.index.countries]
+    departments = ['Department of Neurology', 'Division of Cardiology', 'School of Medicine', 'Institute of Genetics']
+    institutions = ['University Hospital', 'Medical Center', 'Research Institute', 'University']
+    return [f'{rand.choice(departments)}, {rand.choice(cities)} {rand.choice(institutions)}, '
+            f'{rand.choice(cities)}, {rand.choice(countries)}.' for _ in range(n)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload-dir', help='Directory of recorded efetch XML chunks')
+    parser.add_argument('-n', type=int, default=100000, help='Number of affiliations')
+    args = parser.parse_args()
+
+    if args.payload_dir:
+        affiliations = payload_affiliations(args.payload_dir)
+        affiliations = (affiliations * (args.n // max(len(affiliations), 1) + 1))[:args.n]
+    else:
+        affiliations = synthetic_affiliations(args.n)
+
+    start = time.time()
+    geotext_locations = [geotext_location(affiliation) for affiliation in affiliations]
+    geotext_seconds = time.time() - start
+
+    start = time.time()
+    gazetteer_locations = gazetteer.locations(affiliations)
+    gazetteer_seconds = time.time() - start
+
+    print(f'GeoText   : {len(affiliations)} affiliations in {round(geotext_seconds, 3)}s '
+          f'({round(len(affiliations) / geotext_seconds)} / sec)')
+    print(f'Gazetteer : {len(affiliations)} affiliations in {round(gazetteer_seconds, 3)}s '
+          f'({round(len(affiliations) / gazetteer_seconds)} / sec)')
@@ -0,0 +1,109 @@
+"""
+Compare the paper-author-affiliation mapping as a list of row dicts with the columnar `PaperAuthorAffilIndex`
+on 100k synthetic papers : memory held by each and time spent in the grouping functions that read it.
+
+Both must give identical `group_papers_by_top_obj` and `index_obj_pmids` output. Affiliations and authors
+are grouped by their plain strings so the numbers don't include clustering or author disambiguation.
+
+    python benchmarks/bench_paa_index.py -n 100000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from config import Config
+Config.AFFILIATION_GROUPING = 'exact'
+Config.AUTHOR_GROUPING = 'name'
+
+from app.paa_index import paa_to_frame
+from app.util_functions import create_paper_author_affil_index, group_papers_by_top_obj, index_obj_pmids
+from bench_gazetteer import synthetic_affiliations
+
+
+def synthetic_papers(n, seed=0):
+    """
+    Parser-shaped paper dicts with 1-12 authors of 1-2 affiliations each, drawn from fixed pools
+    so authors and affiliations repeat across papers the way they do in real queries.
+    """
+    rand = random.Random(seed)
+    affiliations = synthetic_affiliations(max(n // 20, 100), seed)
+    first_names = [f'Fore{i}' for i in range(3000)]
+    last_names = [f'Last{i}' for i in range(20000)]
+    authors = [[rand.choice(first_names), '', rand.choice(last_names)] for _ in range(max(n // 2, 100))]
+    for author in authors:
+        author[1] = author[0][0]
+    papers_data = []
+    for i in range(n):
+        author_list = [(rand.choice(authors), rand.sample(affiliations, rand.randint(1, 2))) \
+                        for _ in range(rand.randint(1, 12))]
+        papers_data.append({'pmid' : str(30000000 + i),
+                            'title' : f'Synthetic paper {i} on ' + ' '.join(rand.sample(last_names, 12)),
+                            'author_list' : author_list})
+    return papers_data
+
+
+def list_of_dicts(index):
+    """
+    The mapping as `create_paper_author_affil_index` used to return it, one dict per row sharing
+    each paper's PMID, title and `author_list`.
+    """
+    pmids = [str(pmid) for pmid in index.paper_pmids]
+    rows = []
+    for i in range(len(index)):
+        row = index.row(i)
+        row['pmid'] = pmids[index.paper_rows[i]]
+        rows.append(row)
+    return rows
+
+
+def retained_memory(build):
+    """
+    (result of `build()`, bytes still allocated by it once it returns)
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def time_grouping(mapping):
+    start = time.time()
+    outputs = [group_papers_by_top_obj(paa_cross_mapping=mapping, n_affiliations=5, obj_key='author_string'),
+                group_papers_by_top_obj(paa_cross_mapping=mapping, n_affiliations=5, obj_key='affiliations'),
+                index_obj_pmids(mapping, 'author_string'),
+                index_obj_pmids(mapping, 'affiliations')]
+    grouping_seconds = time.time() - start
+    start = time.time()
+    frame = paa_to_frame(mapping, {'author' : 'author_group', 'pmid' : 'pmid',
+                                    'location' : 'locations', 'affiliation' : 'affiliations'})
+    frame_seconds = time.time() - start
+    return outputs, frame, grouping_seconds, frame_seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='Number of papers')
+    args = parser.parse_args()
+
+    papers_data = synthetic_papers(args.n)
+    index, index_bytes = retained_memory(lambda : create_paper_author_affil_index(papers_data))
+    rows, rows_bytes = retained_memory(lambda : list_of_dicts(index))
+    print(f'{args.n} papers, {len(index)} author-affiliation rows')
+    print(f'List of dicts : {round(rows_bytes / 1024 / 1024, 1)} MB')
+    print(f'Columnar      : {round(index_bytes / 1024 / 1024, 1)} MB (including its interned strings)')
+
+    rows_outputs, rows_frame, rows_grouping, rows_frame_seconds = time_grouping(rows)
+    index_outputs, index_frame, index_grouping, index_frame_seconds = time_grouping(index)
+    print(f'List of dicts : grouping {round(rows_grouping, 3)}s, DataFrame {round(rows_frame_seconds, 3)}s')
+    print(f'Columnar      : grouping {round(index_grouping, 3)}s, DataFrame {round(index_frame_seconds, 3)}s')
+    print(f'Identical grouping : {rows_outputs == index_outputs}')
+    print(f'Identical DataFrame : {rows_frame.equals(index_frame)}')
@@ -0,0 +1,87 @@
+"""
+Benchmark the efetch parse stage inline vs. in a process pool.
+
+Recorded efetch payloads are replayed as if they were being downloaded (each "download" sleeps
+`--latency` seconds) so the numbers show how much parsing overlaps with the network.
+
+Record payloads for a query once (needs network and an API key), eg. a ~50k article query:
+    python benchmarks/bench_parse_pool.py --record "epilepsy[MeSH] AND 2015:2020[dp]" --api-key KEY --payload-dir payloads
+
+Then compare inline parsing with 2, 4 and 8 worker processes:
+    python benchmarks/bench_parse_pool.py --payload-dir payloads --processes 0 2 4 8
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from xml.etree.ElementTree import fromstring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.eutils_client import EutilsClient
+from config import Config
+from app.pubmed_scraper_parser import parse_chunks_pipelined
+
+
+def record_payloads(query, api_key, payload_dir, chunk_size=1000):
+    if not os.path.exists(payload_dir):
+        os.makedirs(payload_dir)
+    with EutilsClient(api_key=api_key) as client:
+        root_search = fromstring(client.esearch(term=query, usehistory='y').content)
+        query_key = root_search.find('./QueryKey').text
+        web_env = root_search.find('./WebEnv').text
+        count_results = int(root_search.find('./Count').text)
+        for retstart in range(0, count_results, chunk_size):
+            resp = client.efetch(query_key=query_key, WebEnv=web_env, rettype='abstract', retmode='xml', 
+                                retmax=chunk_size, retstart=retstart)
+            with open(os.path.join(payload_dir, f'efetch_{retstart:07d}.xml'), 'wb') as f:
+                f.write(resp.content)
+        print(f'Recorded {count_results} articles for "{query}" into {payload_dir}. {client.stats()}')
+
+
+def load_payloads(payload_dir):
+    payloads = []
+    for file_name in sorted(os.listdir(payload_dir)):
+        if file_name.endswith('.xml'):
+            with open(os.path.join(payload_dir, file_name), 'rb') as f:
+                payloads.append(f.read())
+    return payloads
+
+
+def run(payloads, processes, latency):
+    def download_chunk(i):
+        time.sleep(latency)
+        return payloads[i]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=int(Config.EFETCH_WORKERS)) as executor:
+        if processes:
+            with ProcessPoolExecutor(max_workers=processes) as parse_pool:
+                n_articles = sum(len(rows) for rows in parse_chunks_pipelined(download_chunk, range(len(payloads)), executor, parse_pool))
+        else:
+            n_articles = sum(len(rows) for rows in parse_chunks_pipelined(download_chunk, range(len(payloads)), executor))
+    return n_articles, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload-dir', required=True, help='Directory of recorded efetch XML chunks')
+    parser.add_argument('--record', help='Record the efetch chunks for this query into --payload-dir and exit')
+    parser.add_argument('--api-key', default='')
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 2, 4], help='Parse pool sizes to compare; 0 is inline')
+    parser.add_argument('--latency', type=float, default=0.5, help='Simulated seconds to download each chunk')
+    args = parser.parse_args()
+
+    if args.record:
+        record_payloads(args.record, args.api_key, args.payload_dir)
+        sys.exit()
+
+    payloads = load_payloads(args.payload_dir)
+    print(f'{len(payloads)} chunks, {round(sum(len(p) for p in payloads) / 1024 / 1024, 1)} MB, {args.latency}s simulated latency per chunk')
+    baseline = None
+    for processes in args.processes:
+        n_articles, elapsed = run(payloads, processes, args.latency)
+        baseline = baseline or elapsed
+        print(f'processes={processes:<3} articles={n_articles:<8} seconds={round(elapsed, 2):<8} '
+              f'articles/sec={round(n_articles / elapsed):<8} speedup={round(baseline / elapsed, 2)}x')
@@ -0,0 +1,61 @@
+"""
+Compare the `etree` and `lxml` parsing engines on recorded efetch payloads.
+
+Each engine runs in a fresh process so peak memory isn't shared between them. Reports articles/sec,
+peak RSS growth (covers libxml2's C allocations) and tracemalloc's peak of Python allocations,
+and checks that both engines return identical rows.
+
+Record payloads first with `bench_parse_pool.py --record`, then:
+    python benchmarks/bench_parsers.py --payload-dir payloads
+"""
+import argparse
+import io
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.pubmed_scraper_parser import pubmed_xml_iterparse_rows
+from bench_parse_pool import load_payloads
+
+
+def run_engine(args):
+    payload_dir, engine = args
+    payloads = load_payloads(payload_dir)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.time()
+    rows = []
+    for payload in payloads:
+        rows += pubmed_xml_iterparse_rows(io.BytesIO(payload), locations = [], affils = [], engine = engine)
+    elapsed = time.time() - start
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    return {'engine' : engine, 'articles' : len(rows), 'seconds' : elapsed, 
+            'rss_growth_mb' : rss_growth / 1024, 'python_peak_mb' : python_peak / 1024 / 1024, 'rows' : rows}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload-dir', required=True, help='Directory of recorded efetch XML chunks')
+    parser.add_argument('--engines', nargs='+', default=['etree', 'lxml'])
+    args = parser.parse_args()
+
+    results = []
+    for engine in args.engines:
+        ### maxtasksperchild=1 so every engine starts from a clean process
+        with Pool(1, maxtasksperchild=1) as pool:
+            results.append(pool.apply(run_engine, ((args.payload_dir, engine),)))
+
+    for result in results:
+        print(f'{result["engine"]:<6} articles={result["articles"]:<8} seconds={round(result["seconds"], 2):<8} '
+              f'articles/sec={round(result["articles"] / result["seconds"]):<8} '
+              f'peak RSS growth={round(result["rss_growth_mb"], 1)} MB  '
+              f'python peak={round(result["python_peak_mb"], 1)} MB')
+    identical = all(result['rows'] == results[0]['rows'] for result in results[1:])
+    print(f'Identical rows across engines : {identical}')
@@ -0,0 +1,79 @@
+"""
+Time the first page of a stored result as results grow : reading the whole `result_all` JSON
+(how results were stored before the entity tables) against `/results/id/<id>`, which reads one page
+of `result_entities` and its papers and counts.
+
+Results are synthetic, `--entities` authors with `--papers` papers each, stored in a SQLite database.
+The first page's time should only depend on how much is on that page, not on the size of the result.
+
+    python benchmarks/bench_result_pages.py --entities 200 2000 --papers 10 100
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/bench_result_pages.db')
+
+from app import create_app, db
+from app.models import Result
+from app.result_store import save_result_output
+
+
+def synthetic_out_dict(n_entities, n_papers):
+    """
+    `query_author_papers` shaped output with `n_papers` papers per author.
+    """
+    out_dict = {}
+    for i in range(n_entities):
+        papers = [{'join_obj' : f'Author{i}, A', 'title' : f'Paper {j} of author {i} ' + 'word ' * 20,
+                    'pubdate' : '2020', 'link' : f'https://pubmed.ncbi.nlm.nih.gov/{i * n_papers + j}',
+                    'pmid' : str(i * n_papers + j), 'pubtype_list' : ['Journal Article'],
+                    'all_authors_list' : ','.join(f'Coauthor{k}, B' for k in range(8)),
+                    'mesh_keywords' : [f'Keyword{k}' for k in range(j % 10, j % 10 + 8)], 'other_ids' : '',
+                    'author' : f'Author{i}, A', 'location' : 'Boston, United States',
+                    'affiliation' : 'Department of Neurology, Boston University, Boston, MA, USA'} for j in range(n_papers)]
+        out_dict[f'Author{i}, A'] = {
+            'author' : f'Author{i}, A',
+            'total_count' : n_papers,
+            'affiliations' : {paper['pmid'] : {paper['affiliation'] : 1} for paper in papers[:15]},
+            'locations' : {paper['pmid'] : {paper['location'] : 1} for paper in papers[:15]},
+            'papers_dict' : papers,
+            'papers_links' : [{'pmid' : paper['pmid'], 'title' : paper['title'], 'link' : paper['link']} for paper in papers],
+            'papers_keywords' : [paper['mesh_keywords'] for paper in papers],
+            'papers_keywords_counts' : [[f'Keyword{k}', n_papers] for k in range(18)],
+            'papers_pubtypes' : [paper['pubtype_list'] for paper in papers],
+            'papers_pubtype_counts' : [['Journal Article', n_papers]]}
+    return out_dict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--papers', type=int, nargs='*', default=[10, 100], help='Papers per author')
+    parser.add_argument('--entities', type=int, nargs='*', default=[200, 2000], help='Authors per result')
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+    db.drop_all()
+    db.create_all()
+    client = app.test_client()
+
+    for n_entities, n_papers in [(n_entities, n_papers) for n_papers in args.papers for n_entities in args.entities]:
+        out_dict = synthetic_out_dict(n_entities, n_papers)
+        legacy_json = json.dumps(out_dict)
+        result = Result(query_type='author_papers', query_text='benchmark')
+        save_result_output(db.session, result, out_dict)
+        db.session.commit()
+
+        start = time.time()
+        json.loads(legacy_json)
+        legacy_seconds = time.time() - start
+
+        start = time.time()
+        response = client.get(f'/results/id/{result.id}')
+        page_seconds = time.time() - start
+        print(f'{n_entities} authors, {n_papers} papers each : result_all {round(len(legacy_json) / 1024 / 1024, 1)} MB decoded in {round(legacy_seconds, 3)}s, '
+              f'first page ({response.status_code}, {round(len(response.data) / 1024)} KB) served in {round(page_seconds, 3)}s')
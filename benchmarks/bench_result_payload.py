@@ -0,0 +1,56 @@
+"""
+Storage size and decode time of a result's paper records : as JSON (one `result_all` blob, or one
+`result_entity_papers.paper` JSON per row) against one `app.result_codec` section per entity.
+
+The summary of each entity (`result_entities.detail`) is JSON either way and isn't counted.
+
+    python benchmarks/bench_result_payload.py --entities 200 --papers 10 100
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.result_codec import encode_section, decode_section
+from bench_result_pages import synthetic_out_dict
+
+
+def timed(func, repeat=3):
+    """
+    (result of `func()`, best of `repeat` seconds)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--papers', type=int, nargs='*', default=[10, 100], help='Papers per author')
+    parser.add_argument('--entities', type=int, default=200, help='Authors per result')
+    args = parser.parse_args()
+
+    for n_papers in args.papers:
+        out_dict = synthetic_out_dict(args.entities, n_papers)
+        result_all = json.dumps(out_dict)
+        paper_rows = [json.dumps(paper) for obj_dict in out_dict.values() for paper in obj_dict['papers_dict']]
+        sections, encode_seconds = timed(lambda : [encode_section(obj_dict['papers_dict']) for obj_dict in out_dict.values()])
+
+        _, result_all_seconds = timed(lambda : json.loads(result_all))
+        _, rows_seconds = timed(lambda : [json.loads(paper) for paper in paper_rows])
+        decoded, sections_seconds = timed(lambda : [decode_section(section) for section in sections])
+        _, one_section_seconds = timed(lambda : decode_section(sections[0]))
+
+        print(f'{args.entities} authors, {n_papers} papers each')
+        print(f'  result_all JSON      : {round(len(result_all) / 1024)} KB, decoded in {round(result_all_seconds, 4)}s')
+        print(f'  per-paper JSON rows  : {round(sum(len(paper) for paper in paper_rows) / 1024)} KB, decoded in {round(rows_seconds, 4)}s')
+        print(f'  per-entity sections  : {round(sum(len(section) for section in sections) / 1024)} KB, decoded in {round(sections_seconds, 4)}s '
+              f'(encoded in {round(encode_seconds, 4)}s), one entity in {round(one_section_seconds * 1000, 2)}ms')
+        print(f'  identical : {decoded == [json.loads(json.dumps(obj_dict["papers_dict"])) for obj_dict in out_dict.values()]}')
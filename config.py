@@ -21,4 +21,36 @@ class Config(object):
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379' ### Redis URL
     RESULT_TTL = 5000 ### Seconds to save results on the page with the token
     ASYNC_FUNC = os.environ.get('ASYNC_FUNC') or False ### True == async ; False == sync
-    WORKER_TIMEOUT = os.environ.get('WORKER_TIMEOUT') or 1000
\ No newline at end of file
+    WORKER_TIMEOUT = os.environ.get('WORKER_TIMEOUT') or 1000
+    PROGRESS_POLL_SECONDS = os.environ.get('PROGRESS_POLL_SECONDS') or 2 ### Seconds between the processing page's requests for a queued query's progress
+    SINGLEFLIGHT_TTL = os.environ.get('SINGLEFLIGHT_TTL') or 7200 ### Longest seconds a submission can wait on an identical queued/running query
+    EFETCH_WORKERS = os.environ.get('EFETCH_WORKERS') or 4 ### Number of efetch chunks downloaded concurrently
+    NCBI_RATE_LIMIT_KEY = os.environ.get('NCBI_RATE_LIMIT_KEY') or 10 ### Requests per second allowed with an API key
+    NCBI_RATE_LIMIT_NO_KEY = os.environ.get('NCBI_RATE_LIMIT_NO_KEY') or 3 ### Requests per second allowed without one
+    NCBI_RATE_SHARED_RETRY_SECONDS = os.environ.get('NCBI_RATE_SHARED_RETRY_SECONDS') or 30 ### The limits are shared by every worker through Redis; seconds before trying Redis again after an error, limiting per process meanwhile
+    EUTILS_TOOL = os.environ.get('EUTILS_TOOL') or 'find-a-lab' ### `tool` sent to NCBI with every request
+    EUTILS_EMAIL = os.environ.get('EUTILS_EMAIL') or '' ### `email` sent to NCBI with every request
+    EUTILS_TIMEOUT = os.environ.get('EUTILS_TIMEOUT') or 60 ### Seconds before an E-utilities request is retried
+    EUTILS_MAX_RETRIES = os.environ.get('EUTILS_MAX_RETRIES') or 5 ### Retries on 429/5xx/timeouts before the job fails
+    EUTILS_BACKOFF = os.environ.get('EUTILS_BACKOFF') or 0.5 ### Base seconds for jittered exponential backoff
+    ARTICLE_STORE_PATH = os.environ.get('ARTICLE_STORE_PATH') or os.path.join(basedir, 'article_store.db') ### SQLite file of parsed articles keyed by PMID
+    ARTICLE_STORE_MAX_MB = os.environ.get('ARTICLE_STORE_MAX_MB') or 2048 ### Least recently used articles are evicted past this size
+    ARTICLE_STORE_MAX_AGE_DAYS = os.environ.get('ARTICLE_STORE_MAX_AGE_DAYS') or 30 ### Stored articles older than this are re-fetched
+    CORPUS_TTL = os.environ.get('CORPUS_TTL') or 86400 ### Seconds a query's parsed corpus is kept in Redis for other views
+    CORPUS_MAX_MB = os.environ.get('CORPUS_MAX_MB') or 5 ### Compressed corpora larger than this aren't cached in Redis
+    PARSE_PROCESSES = os.environ.get('PARSE_PROCESSES') or 0 ### Worker processes for XML parsing and filtering; 0 parses in the download threads. Only worth setting on dynos with spare cores
+    INGEST_PROCESSES = os.environ.get('INGEST_PROCESSES') or os.cpu_count() or 1 ### Files parsed in parallel by `flask ingest-pubmed`
+    QUERY_BACKEND = os.environ.get('QUERY_BACKEND') or 'remote' ### 'remote' (esearch), 'local' (article store index) or 'auto' (local once a baseline is ingested). The local index skips PubMed's term mapping so results can differ
+    XML_PARSER = os.environ.get('XML_PARSER') or 'lxml' ### 'lxml' or 'etree'; falls back to etree if lxml isn't installed
+    LOCATION_CACHE_SIZE = os.environ.get('LOCATION_CACHE_SIZE') or 100000 ### Affiliations kept in each process's geocoding LRU
+    LOCATION_SHARED_DAYS = os.environ.get('LOCATION_SHARED_DAYS') or 7 ### Days per generation of the shared geocoding hash, unused entries expire after two
+    LOCATION_SHARED_MAX = os.environ.get('LOCATION_SHARED_MAX') or 200000 ### Most affiliations written to one generation of the shared geocoding hash
+    LOCATION_SHARED_RETRY_SECONDS = os.environ.get('LOCATION_SHARED_RETRY_SECONDS') or 30 ### Seconds before trying Redis again after a shared cache error
+    AFFIL_MATCH_THRESHOLD = os.environ.get('AFFIL_MATCH_THRESHOLD') or 90 ### Minimum `partial_ratio` (0-100) for affiliations to fuzzy match
+    AFFILIATION_GROUPING = os.environ.get('AFFILIATION_GROUPING') or 'cluster' ### 'cluster' (MinHash LSH institutions) or 'exact' (preprocessed string). Clusters are stored in the app's database so every process labels them the same
+    AFFIL_CLUSTER_THRESHOLD = os.environ.get('AFFIL_CLUSTER_THRESHOLD') or 0.65 ### Minimum weighted word similarity (0-1) between an affiliation and a cluster's label for it to join the cluster, lower merges more variants
+    AUTHOR_GROUPING = os.environ.get('AUTHOR_GROUPING') or 'disambiguated' ### 'disambiguated' (author index) or 'name' (plain author_string). The author index is stored in the app's database so every process labels authors the same
+    AUTHOR_MATCH_THRESHOLD = os.environ.get('AUTHOR_MATCH_THRESHOLD') or 0.4 ### Minimum co-author/affiliation/MeSH score to attach a mention to a known author, above the 0.3 a shared affiliation gives
+    RESULTS_PER_PAGE = os.environ.get('RESULTS_PER_PAGE') or 25 ### Authors/affiliations per page of a stored result
+    RESULTS_MAX_PAGE_SIZE = os.environ.get('RESULTS_MAX_PAGE_SIZE') or 500 ### Largest page the results API will return
+    RESULTS_TOP_COUNTS = os.environ.get('RESULTS_TOP_COUNTS') or 25 ### Keyword/pubtype counts sent with each entity by the results API
@@ -0,0 +1,159 @@
+"""result entity tables
+
+Revision ID: 7c2e5a91d4b3
+Revises: 3b1f0c2d9a4e
+Create Date: 2026-10-18 14:02:47.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e5a91d4b3'
+down_revision = '3b1f0c2d9a4e'
+branch_labels = None
+depends_on = None
+
+
+result_table = sa.table('result',
+                    sa.column('id', sa.Integer),
+                    sa.column('result_all', postgresql.JSON))
+### A full `Table` so inserts report the new entity's id
+entities_table = sa.Table('result_entities', sa.MetaData(),
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('result_id', sa.Integer),
+                    sa.Column('rank', sa.Integer),
+                    sa.Column('entity_key', sa.Text),
+                    sa.Column('total_count', sa.Integer),
+                    sa.Column('detail', postgresql.JSON))
+papers_table = sa.table('result_entity_papers',
+                    sa.column('result_id', sa.Integer),
+                    sa.column('entity_id', sa.Integer),
+                    sa.column('position', sa.Integer),
+                    sa.column('pmid', sa.String),
+                    sa.column('paper', postgresql.JSON))
+counts_table = sa.table('result_entity_counts',
+                    sa.column('result_id', sa.Integer),
+                    sa.column('entity_id', sa.Integer),
+                    sa.column('kind', sa.String),
+                    sa.column('rank', sa.Integer),
+                    sa.column('value', sa.Text),
+                    sa.column('count', sa.Integer))
+
+### Written out here rather than imported from `app.result_store` so the migration keeps matching this revision's tables
+PAPER_FIELDS = ['papers_dict', 'papers_links', 'papers_keywords', 'papers_keywords_counts', 'papers_pubtypes', 'papers_pubtype_counts']
+COUNT_KINDS = {'keyword' : 'papers_keywords_counts', 'pubtype' : 'papers_pubtype_counts'}
+
+
+def write_result_entities(bind, result_id, out_dict):
+    for rank, (entity_key, obj_dict) in enumerate(out_dict.items()):
+        entity_id = bind.execute(entities_table.insert().values(result_id=result_id, rank=rank, entity_key=entity_key, 
+                                            total_count=obj_dict.get('total_count', 0),
+                                            detail={field : value for field, value in obj_dict.items() if field not in PAPER_FIELDS}))\
+                                            .inserted_primary_key[0]
+        paper_rows = [{'result_id' : result_id, 'entity_id' : entity_id, 'position' : position, 'pmid' : paper.get('pmid'), 'paper' : paper} \
+                        for position, paper in enumerate(obj_dict.get('papers_dict', []))]
+        count_rows = [{'result_id' : result_id, 'entity_id' : entity_id, 'kind' : kind, 'rank' : count_rank, 'value' : value, 'count' : count} \
+                        for kind, field in COUNT_KINDS.items() for count_rank, (value, count) in enumerate(obj_dict.get(field, []))]
+        if paper_rows:
+            bind.execute(papers_table.insert(), paper_rows)
+        if count_rows:
+            bind.execute(counts_table.insert(), count_rows)
+
+
+def read_result_entities(bind, result_id):
+    out_dict = {}
+    entities = bind.execute(sa.select([entities_table.c.id, entities_table.c.entity_key, entities_table.c.detail])\
+                            .where(entities_table.c.result_id == result_id).order_by(entities_table.c.rank)).fetchall()
+    for entity_id, entity_key, detail in entities:
+        papers = [row[0] for row in bind.execute(sa.select([papers_table.c.paper]).where(papers_table.c.entity_id == entity_id)\
+                                                .order_by(papers_table.c.position))]
+        counts = {kind : [[value, count] for value, count in bind.execute(sa.select([counts_table.c.value, counts_table.c.count])\
+                                .where(sa.and_(counts_table.c.entity_id == entity_id, counts_table.c.kind == kind))\
+                                .order_by(counts_table.c.rank))] for kind in COUNT_KINDS}
+        obj_dict = dict(detail)
+        obj_dict['papers_dict'] = papers
+        obj_dict['papers_links'] = [{'pmid' : paper['pmid'], 'title' : paper['title'], 'link' : paper['link']} for paper in papers]
+        obj_dict['papers_keywords'] = [paper['mesh_keywords'] for paper in papers]
+        obj_dict['papers_keywords_counts'] = counts['keyword']
+        obj_dict['papers_pubtypes'] = [paper['pubtype_list'] for paper in papers]
+        obj_dict['papers_pubtype_counts'] = counts['pubtype']
+        out_dict[entity_key] = obj_dict
+    return out_dict
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('result_entities',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('result_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('entity_key', sa.Text(), nullable=False),
+    sa.Column('total_count', sa.Integer(), nullable=True),
+    sa.Column('detail', postgresql.JSON(astext_type=sa.Text()), nullable=True),
+    sa.ForeignKeyConstraint(['result_id'], ['result.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_result_entities_result_rank', 'result_entities', ['result_id', 'rank'], unique=True)
+    op.create_table('result_entity_papers',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('result_id', sa.Integer(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('pmid', sa.String(length=20), nullable=True),
+    sa.Column('paper', postgresql.JSON(astext_type=sa.Text()), nullable=True),
+    sa.ForeignKeyConstraint(['entity_id'], ['result_entities.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['result_id'], ['result.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_result_entity_papers_entity_position', 'result_entity_papers', ['entity_id', 'position'], unique=False)
+    op.create_index(op.f('ix_result_entity_papers_result_id'), 'result_entity_papers', ['result_id'], unique=False)
+    op.create_table('result_entity_counts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('result_id', sa.Integer(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('value', sa.Text(), nullable=True),
+    sa.Column('count', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['entity_id'], ['result_entities.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['result_id'], ['result.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_result_entity_counts_entity_kind_rank', 'result_entity_counts', ['entity_id', 'kind', 'rank'], unique=False)
+    op.create_index(op.f('ix_result_entity_counts_result_id'), 'result_entity_counts', ['result_id'], unique=False)
+    # ### end Alembic commands ###
+
+    ### Backfill : move every stored result's output into the new tables, one result at a time.
+    ### Error results keep their `result_all`, the others are emptied once their rows are written.
+    bind = op.get_bind()
+    result_ids = [row[0] for row in bind.execute(sa.select([result_table.c.id]).order_by(result_table.c.id)).fetchall()]
+    for result_id in result_ids:
+        out_dict = bind.execute(sa.select([result_table.c.result_all]).where(result_table.c.id == result_id)).scalar()
+        if not out_dict or out_dict.get('error'):
+            continue
+        write_result_entities(bind, result_id, out_dict)
+        bind.execute(result_table.update().where(result_table.c.id == result_id).values(result_all=sa.null()))
+
+
+def downgrade():
+    ### Put every result's output back into `result_all` before dropping the tables
+    bind = op.get_bind()
+    result_ids = [row[0] for row in bind.execute(sa.select([sa.distinct(sa.column('result_id'))])\
+                                                .select_from(sa.table('result_entities'))).fetchall()]
+    for result_id in result_ids:
+        bind.execute(result_table.update().where(result_table.c.id == result_id)\
+                    .values(result_all=read_result_entities(bind, result_id)))
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index(op.f('ix_result_entity_counts_result_id'), table_name='result_entity_counts')
+    op.drop_index('ix_result_entity_counts_entity_kind_rank', table_name='result_entity_counts')
+    op.drop_table('result_entity_counts')
+    op.drop_index(op.f('ix_result_entity_papers_result_id'), table_name='result_entity_papers')
+    op.drop_index('ix_result_entity_papers_entity_position', table_name='result_entity_papers')
+    op.drop_table('result_entity_papers')
+    op.drop_index('ix_result_entities_result_rank', table_name='result_entities')
+    op.drop_table('result_entities')
+    # ### end Alembic commands ###
@@ -0,0 +1,118 @@
+"""result paper sections
+
+Revision ID: a4d8e0c6f215
+Revises: 7c2e5a91d4b3
+Create Date: 2026-10-18 15:21:09.604381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import json
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8e0c6f215'
+down_revision = '7c2e5a91d4b3'
+branch_labels = None
+depends_on = None
+
+
+entities_table = sa.table('result_entities',
+                    sa.column('id', sa.Integer),
+                    sa.column('papers_section', sa.LargeBinary))
+papers_table = sa.table('result_entity_papers',
+                    sa.column('id', sa.Integer),
+                    sa.column('entity_id', sa.Integer),
+                    sa.column('position', sa.Integer),
+                    sa.column('title', sa.Text),
+                    sa.column('link', sa.String),
+                    sa.column('pubdate', sa.String),
+                    sa.column('paper', postgresql.JSON))
+
+
+### Written out here rather than imported from `app.result_codec` so the migration keeps writing this 
+### revision's section format. The first byte says how the rest was serialized and compressed.
+MSGPACK_ZSTD = b'M'
+MSGPACK_ZLIB = b'm'
+JSON_ZLIB = b'j'
+
+
+def encode_section(obj):
+    if msgpack is None:
+        return JSON_ZLIB + zlib.compress(json.dumps(obj).encode('utf-8'), 6)
+    packed = msgpack.packb(obj, use_bin_type=True)
+    if zstandard is None:
+        return MSGPACK_ZLIB + zlib.compress(packed, 6)
+    return MSGPACK_ZSTD + zstandard.ZstdCompressor(level=6).compress(packed)
+
+
+def decode_section(blob):
+    if not blob:
+        return None
+    blob = bytes(blob)
+    section_format, data = blob[:1], blob[1:]
+    if section_format == MSGPACK_ZSTD:
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data), raw=False)
+    if section_format == MSGPACK_ZLIB:
+        return msgpack.unpackb(zlib.decompress(data), raw=False)
+    if section_format == JSON_ZLIB:
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+    raise ValueError(f'Unknown result section format {section_format!r}')
+
+
+def entity_ids(bind):
+    return [row[0] for row in bind.execute(sa.select([entities_table.c.id]).order_by(entities_table.c.id)).fetchall()]
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.add_column('result_entities', sa.Column('papers_section', sa.LargeBinary(), nullable=True))
+    op.add_column('result_entity_papers', sa.Column('title', sa.Text(), nullable=True))
+    op.add_column('result_entity_papers', sa.Column('link', sa.String(length=200), nullable=True))
+    op.add_column('result_entity_papers', sa.Column('pubdate', sa.String(length=40), nullable=True))
+    # ### end Alembic commands ###
+
+    ### Move each entity's paper records into one compressed section, keeping title/link/date on the rows
+    bind = op.get_bind()
+    for entity_id in entity_ids(bind):
+        rows = bind.execute(sa.select([papers_table.c.id, papers_table.c.paper]).where(papers_table.c.entity_id == entity_id)\
+                            .order_by(papers_table.c.position)).fetchall()
+        papers = [paper for row_id, paper in rows]
+        bind.execute(entities_table.update().where(entities_table.c.id == entity_id).values(papers_section=encode_section(papers)))
+        for row_id, paper in rows:
+            bind.execute(papers_table.update().where(papers_table.c.id == row_id)\
+                        .values(title=paper.get('title'), link=paper.get('link'), pubdate=paper.get('pubdate')))
+
+    with op.batch_alter_table('result_entity_papers') as batch_op:
+        batch_op.drop_column('paper')
+
+
+def downgrade():
+    op.add_column('result_entity_papers', sa.Column('paper', postgresql.JSON(astext_type=sa.Text()), nullable=True))
+
+    bind = op.get_bind()
+    for entity_id in entity_ids(bind):
+        papers = decode_section(bind.execute(sa.select([entities_table.c.papers_section])\
+                                            .where(entities_table.c.id == entity_id)).scalar()) or []
+        for position, paper in enumerate(papers):
+            bind.execute(papers_table.update().where(sa.and_(papers_table.c.entity_id == entity_id, papers_table.c.position == position))\
+                        .values(paper=paper))
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('result_entity_papers') as batch_op:
+        batch_op.drop_column('pubdate')
+        batch_op.drop_column('link')
+        batch_op.drop_column('title')
+    with op.batch_alter_table('result_entities') as batch_op:
+        batch_op.drop_column('papers_section')
+    # ### end Alembic commands ###
@@ -1,18 +1,51 @@
 #!/usr/bin/env python
-from datetime import datetime, timedelta
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+import io
+import json
+import random
+import time
 import unittest
-from app import app, db
-from app.models import User, Post
+from collections import Counter
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LOG_TO_STDOUT = True
+
+
+def test_redis():
+    """
+    The configured Redis if it's reachable, else a `fakeredis` one if that's installed, else None.
+    """
+    from worker import conn
+    try:
+        conn.ping()
+        return conn
+    except Exception:
+        pass
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    return fakeredis.FakeStrictRedis()
 
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
         db.create_all()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        self.app_context.pop()
 
     def test_password_hashing(self):
         u = User(username='susan')
@@ -20,12 +53,14 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    @unittest.skip('User has no avatar in this app')
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    @unittest.skip('User has no followers in this app')
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -49,7 +84,10 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    @unittest.skip('There are no posts in this app')
     def test_follow_posts(self):
+        from datetime import datetime, timedelta
+        from app.models import Post
         # create four users
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -88,5 +126,1599 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class RefreshResultCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        from app.models import Result
+        for username in ['alice', 'bob']:
+            db.session.add(User(username=username, email=f'{username}@example.com'))
+        self.old_result = Result(query_type='author_papers', query_text='epilepsy', user_querying='alice')
+        self.result = Result(query_type='author_papers', query_text='epilepsy', user_querying='alice')
+        db.session.add_all([self.old_result, self.result])
+        db.session.commit()
+        ### Stored before the timestamp column existed
+        self.old_result.timestamp = None
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username):
+        user = User.query.filter_by(username=username).first()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def test_owner_can_refresh(self):
+        self.login('alice')
+        response = self.client.get(f'/results/{self.result.id}/refresh')
+        self.assertEqual(response.status_code, 200)
+
+    def test_other_user_cant_refresh(self):
+        self.login('bob')
+        response = self.client.get(f'/results/{self.result.id}/refresh')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(f'/results/id/{self.result.id}'))
+
+    def test_result_without_timestamp_cant_refresh(self):
+        self.login('alice')
+        response = self.client.get(f'/results/{self.old_result.id}/refresh')
+        self.assertEqual(response.status_code, 302)
+
+
+class FlakyBody(io.BytesIO):
+    """
+    A response body whose connection drops after `fail_after` bytes.
+    """
+    def __init__(self, data, fail_after=None):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.fail_after is not None and self.tell() + (size if size and size > 0 else len(self.getvalue())) > self.fail_after:
+            import urllib3
+            raise urllib3.exceptions.ProtocolError('Connection broken: IncompleteRead')
+        return super().read(size)
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data, fail_after=None, content_error=None):
+        self.raw = FlakyBody(data, fail_after)
+        self.data = data
+        self.content_error = content_error
+
+    @property
+    def content(self):
+        if self.content_error is not None:
+            error, self.content_error = self.content_error, None
+            raise error
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class EutilsClientCase(unittest.TestCase):
+    xml = (b'<?xml version="1.0"?><PubmedArticleSet>' + b''.join(
+            b'<PubmedArticle><MedlineCitation><PMID>%d</PMID></MedlineCitation></PubmedArticle>' % pmid 
+            for pmid in range(50)) + b'</PubmedArticleSet>')
+
+    def client(self, responses):
+        from app.eutils_client import EutilsClient
+        client = EutilsClient(api_key='test', max_retries=3)
+        client.backoff = 0
+        client.rate_limiter.wait = lambda : None
+        responses = iter(responses)
+        client.session.post = client.session.get = lambda *args, **kwargs : next(responses)
+        return client
+
+    def count_pmids(self, raw):
+        from xml.etree.ElementTree import iterparse
+        return [element.text for event, element in iterparse(raw) if element.tag == 'PMID']
+
+    def test_streamed_body_retried(self):
+        client = self.client([FakeResponse(self.xml, fail_after=len(self.xml) // 2), FakeResponse(self.xml)])
+        pmids = client.efetch_parsed(self.count_pmids, id='1,2', method='POST')
+        self.assertEqual(pmids, [str(pmid) for pmid in range(50)])
+        self.assertEqual(client.stats()['requests'], 2)
+
+    def test_streamed_body_gives_up(self):
+        import urllib3
+        client = self.client([FakeResponse(self.xml, fail_after=10) for _ in range(4)])
+        with self.assertRaises(urllib3.exceptions.ProtocolError):
+            client.efetch_parsed(self.count_pmids, id='1,2', method='POST')
+
+    def test_buffered_body_retried(self):
+        import requests
+        client = self.client([FakeResponse(self.xml, content_error=requests.exceptions.ChunkedEncodingError('reset')),
+                            FakeResponse(self.xml)])
+        self.assertEqual(client.efetch(id='1,2', method='POST').content, self.xml)
+
+
+class RateLimiterCase(unittest.TestCase):
+    rate = 20
+
+    def setUp(self):
+        import app.eutils_client as eutils_client
+        self.eutils_client = eutils_client
+        self.saved_conn = eutils_client.conn
+        self.redis = test_redis()
+
+    def tearDown(self):
+        if self.redis is not None:
+            self.redis.delete('eutils:rate:test')
+        self.eutils_client.conn = self.saved_conn
+
+    def start_times(self, limiters, n_threads=8):
+        """
+        When each of `n_threads` threads got through `wait`, the threads taking turns over `limiters`.
+        """
+        import threading
+        starts = []
+        def call(limiter):
+            limiter.wait()
+            starts.append(time.time())
+        threads = [threading.Thread(target=call, args=(limiters[i % len(limiters)],)) for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(starts)
+
+    def assertSpaced(self, starts):
+        """
+        The i-th start is at least i intervals after the first. Compared to the first rather than pairwise 
+        because a thread waking late from `time.sleep` only shrinks the gap to the next one.
+        """
+        interval = 1.0 / self.rate
+        self.assertTrue(all(start - starts[0] >= i * interval - 0.005 for i, start in enumerate(starts)), starts)
+
+    def test_threads_spaced_within_a_process(self):
+        from app.eutils_client import RateLimiter
+        self.assertSpaced(self.start_times([RateLimiter(self.rate)]))
+
+    def test_processes_share_the_redis_slot(self):
+        if self.redis is None:
+            self.skipTest('needs Redis or fakeredis')
+        from app.eutils_client import RateLimiter
+        self.eutils_client.conn = self.redis
+        ### One limiter per worker process, all for the same key
+        limiters = [RateLimiter(self.rate, shared_key='eutils:rate:test') for _ in range(3)]
+        self.assertSpaced(self.start_times(limiters, n_threads=9))
+        self.assertIsNotNone(self.redis.get('eutils:rate:test'))
+
+    def test_falls_back_to_the_process_limit(self):
+        from app.eutils_client import RateLimiter
+        class DownRedis(object):
+            def pipeline(self):
+                raise ConnectionError('Redis is down')
+        self.eutils_client.conn = DownRedis()
+        limiter = RateLimiter(self.rate, shared_key='eutils:rate:test')
+        self.assertSpaced(self.start_times([limiter]))
+        self.assertGreater(limiter.shared_retry_at, time.time())
+
+    def test_limiter_per_key(self):
+        from app.eutils_client import get_rate_limiter
+        self.assertIs(get_rate_limiter('key-a'), get_rate_limiter('key-a'))
+        self.assertIsNot(get_rate_limiter('key-a'), get_rate_limiter('key-b'))
+        self.assertNotEqual(get_rate_limiter('key-a').shared_key, get_rate_limiter('key-b').shared_key)
+        self.assertNotIn('key-a', get_rate_limiter('key-a').shared_key)
+        self.assertEqual(get_rate_limiter('key-a').interval, 1.0 / int(Config.NCBI_RATE_LIMIT_KEY))
+        self.assertEqual(get_rate_limiter('').interval, 1.0 / int(Config.NCBI_RATE_LIMIT_NO_KEY))
+
+
+def article_set_xml(titles, deleted_pmids=()):
+    """
+    A `PubmedArticleSet` of bare articles ({pmid : title}) and a `DeleteCitation` of `deleted_pmids`.
+    """
+    articles = ''.join(f'<PubmedArticle><MedlineCitation><PMID Version="1">{pmid}</PMID><Article><ArticleTitle>{title}</ArticleTitle>'
+                        f'</Article></MedlineCitation></PubmedArticle>' for pmid, title in titles.items())
+    if deleted_pmids:
+        articles += '<DeleteCitation>' + ''.join(f'<PMID Version="1">{pmid}</PMID>' for pmid in deleted_pmids) + '</DeleteCitation>'
+    return f'<?xml version="1.0" encoding="utf-8"?><PubmedArticleSet>{articles}</PubmedArticleSet>'.encode()
+
+
+class FakeEutilsClient(object):
+    """
+    Answers `get_article_ids`' esearch/efetch calls for `pmids`, the later chunks downloading faster.
+    """
+    pmids = [str(pmid) for pmid in range(500, 530)]
+
+    def __init__(self, api_key=""):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+    def esearch(self, **params):
+        return FakeResponse(f'<eSearchResult><Count>{len(self.pmids)}</Count><QueryKey>1</QueryKey>'
+                            f'<WebEnv>web</WebEnv></eSearchResult>'.encode())
+
+    def efetch(self, **params):
+        response = FakeResponse(b'')
+        response.text = '\n'.join(self.pmids[params['retstart']:params['retstart'] + params['retmax']])
+        return response
+
+    def efetch_parsed(self, parse, id, **params):
+        chunk_pmids = id.split(',')
+        time.sleep(0.01 * (len(self.pmids) - self.pmids.index(chunk_pmids[0])))
+        return parse(io.BytesIO(article_set_xml({pmid : f'Paper {pmid}' for pmid in chunk_pmids})))
+
+
+class ArticleQueryCase(unittest.TestCase):
+    """
+    `get_article_ids` against `FakeEutilsClient` and an empty article store.
+    """
+    def setUp(self):
+        import tempfile
+        import app.pubmed_scraper_parser as pubmed_scraper_parser
+        self.pubmed_scraper_parser = pubmed_scraper_parser
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = pubmed_scraper_parser.EutilsClient, Config.ARTICLE_STORE_PATH, Config.QUERY_BACKEND, Config.EFETCH_WORKERS
+        pubmed_scraper_parser.EutilsClient = FakeEutilsClient
+        Config.ARTICLE_STORE_PATH = os.path.join(self.directory.name, 'articles.db')
+        Config.QUERY_BACKEND, Config.EFETCH_WORKERS = 'remote', 4
+
+    def tearDown(self):
+        self.pubmed_scraper_parser.EutilsClient, Config.ARTICLE_STORE_PATH, Config.QUERY_BACKEND, Config.EFETCH_WORKERS = self.saved
+        self.directory.cleanup()
+
+
+class GetArticleIdsCase(ArticleQueryCase):
+    def test_chunks_kept_in_pmid_order(self):
+        papers, count = self.pubmed_scraper_parser.get_article_ids('epilepsy', 'relevance', [], [], chunk_size=4)
+        self.assertEqual(count, len(FakeEutilsClient.pmids))
+        self.assertEqual([paper['pmid'] for paper in papers], FakeEutilsClient.pmids)
+
+
+class DatedEutilsClient(FakeEutilsClient):
+    """
+    `FakeEutilsClient` whose esearch applies an Entrez date range the way PubMed does.
+    """
+    entrez_dates = {'601' : '2014/12/31', '602' : '2015/01/01', '603' : '2015/06/30', '604' : '2016/03/01', '605' : '2020/10/10'}
+
+    def esearch(self, **params):
+        self.pmids = [pmid for pmid, entrez_date in self.entrez_dates.items() 
+                        if 'mindate' not in params or (params['datetype'] == 'edat' and params['mindate'] <= entrez_date <= params['maxdate'])]
+        return super().esearch(**params)
+
+
+class DateRangeCase(ArticleQueryCase):
+    """
+    `from_year` through esearch against the local index.
+    """
+    def setUp(self):
+        super().setUp()
+        from app.article_store import ArticleStore
+        self.pubmed_scraper_parser.EutilsClient = DatedEutilsClient
+        self.local_path = os.path.join(self.directory.name, 'local.db')
+        ### Stored papers' `pubdate` is the year they entered PubMed
+        with ArticleStore(path=self.local_path) as store:
+            store.put_many([dict(article_record(pmid), pubdate=entrez_date[:4]) for pmid, entrez_date in DatedEutilsClient.entrez_dates.items()])
+
+    def query(self, backend, from_year, min_date=""):
+        Config.QUERY_BACKEND = backend
+        Config.ARTICLE_STORE_PATH = self.local_path if backend == 'local' else os.path.join(self.directory.name, 'remote.db')
+        papers, count = self.pubmed_scraper_parser.get_article_ids('Seizures', 'relevance', [], [], from_year=from_year, min_date=min_date)
+        return sorted(paper['pmid'] for paper in papers)
+
+    def test_backends_agree(self):
+        for from_year in ['', '2014', '2015', 2016, '2017']:
+            self.assertEqual(self.query('local', from_year), self.query('remote', from_year), from_year)
+        self.assertEqual(self.query('remote', '2015'), ['602', '603', '604', '605'])
+
+    def test_refresh_keeps_from_year(self):
+        from app.pubmed_scraper_parser import esearch_date_params
+        self.assertEqual(esearch_date_params(), {})
+        self.assertEqual(esearch_date_params('2015', '2014/06/01')['mindate'], '2015/01/01')
+        self.assertEqual(esearch_date_params('2015', '2015/06/01'), {'datetype' : 'edat', 'mindate' : '2015/06/01', 'maxdate' : '3000'})
+        self.assertEqual(self.query('remote', '2016', min_date='2015/01/01'), ['604', '605'])
+
+
+def article_record(pmid, title='Seizures in kids', padding=0):
+    return {'pmid' : str(pmid), 'title' : title + ' ' * padding, 'abstract' : {'': 'An abstract.'},
+            'mesh_keywords' : {'Epilepsy' : []}, 'author_list' : [[['Elizabeth', 'EA', 'Thiele'], ['Boston']]],
+            'pubdate' : '2020'}
+
+
+class ArticleStoreCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from app.article_store import ArticleStore
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'articles.db')
+        self.store = ArticleStore(path=self.path, max_bytes=1, max_age_days=30)
+        self.store.max_bytes = 10 ** 9
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def summed_bytes(self):
+        return self.store.conn.execute("SELECT COALESCE(SUM(size), 0) FROM articles WHERE source = 'eutils'").fetchone()[0]
+
+    def test_running_total(self):
+        self.store.put_many([article_record(pmid) for pmid in range(20)])
+        self.store.put_many([article_record(pmid, padding=100) for pmid in range(10)])
+        self.store.put_many([article_record(pmid) for pmid in range(20, 30)], source='baseline')
+        self.store.delete_many(range(5))
+        self.store.refresh(range(20, 25))
+        self.assertEqual(self.store.evictable_bytes(), self.summed_bytes())
+
+        ### A store opened over existing rows starts from their sum
+        self.store.conn.execute("DELETE FROM store_meta")
+        self.store.conn.commit()
+        self.store.create_tables()
+        self.assertEqual(self.store.evictable_bytes(), self.summed_bytes())
+
+    def test_evicts_least_recently_read(self):
+        self.store.put_many([article_record(pmid) for pmid in range(20)])
+        self.store.put_many([article_record(pmid) for pmid in range(100, 110)], source='baseline')
+        self.store.get_many(range(10, 20))
+        self.store.max_bytes = self.summed_bytes() * 3 // 4
+        self.store.put_many([article_record(20)])
+        self.assertLessEqual(self.store.evictable_bytes(), self.store.max_bytes)
+        self.assertEqual(self.store.evictable_bytes(), self.summed_bytes())
+        stored = self.store.get_many(list(range(21)) + list(range(100, 110)))
+        self.assertTrue(all(str(pmid) in stored for pmid in range(10, 21)))
+        self.assertTrue(all(str(pmid) in stored for pmid in range(100, 110)))
+        self.assertFalse(any(str(pmid) in stored for pmid in range(5)))
+
+
+class IngestDirectoryCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'articles.db')
+        self.files = os.path.join(self.directory.name, 'pubmed')
+        os.makedirs(self.files)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, file_name, titles, deleted_pmids=()):
+        import gzip
+        with gzip.open(os.path.join(self.files, file_name), 'wb') as f:
+            f.write(article_set_xml(titles, deleted_pmids))
+
+    def ingest(self):
+        from app.pubmed_ingest import ingest_directory
+        return ingest_directory(self.files, processes=2, store_path=self.path)
+
+    def stored_titles(self, pmids):
+        from app.article_store import ArticleStore
+        with ArticleStore(path=self.path) as store:
+            return {pmid : paper['title'] for pmid, paper in store.get_many(pmids).items()}
+
+    def test_updates_applied_in_file_order(self):
+        ### Written newest first, so only the names give the release order
+        self.write('pubmed21n0010.xml.gz', {'2' : 'Version 3.'}, deleted_pmids=['4'])
+        self.write('pubmed21n0002.xml.gz', {'2' : 'Version 2.', '4' : 'Added by an update.'}, deleted_pmids=['3'])
+        self.write('pubmed21n0001.xml.gz', {'1' : 'Baseline 1.', '2' : 'Version 1.', '3' : 'Baseline 3.'})
+        totals = self.ingest()
+        self.assertEqual((totals['files'], totals['articles'], totals['deleted']), (3, 6, 2))
+        self.assertEqual(self.stored_titles(['1', '2', '3', '4']), {'1' : 'Baseline 1.', '2' : 'Version 3.'})
+
+    def test_resumes_after_ingested_files(self):
+        from app.article_store import ArticleStore
+        self.write('pubmed21n0001.xml.gz', {'1' : 'Baseline 1.', '2' : 'Baseline 2.'})
+        self.assertEqual(self.ingest()['files'], 1)
+        ### Rewritten after being ingested, a rerun mustn't read it again
+        self.write('pubmed21n0001.xml.gz', {'9' : 'Not ingested.'})
+        self.write('pubmed21n0002.xml.gz', {'3' : 'Update 3.'}, deleted_pmids=['1'])
+        totals = self.ingest()
+        self.assertEqual((totals['skipped_files'], totals['files'], totals['articles']), (1, 1, 1))
+        self.assertEqual(self.stored_titles(['1', '2', '3', '9']), {'2' : 'Baseline 2.', '3' : 'Update 3.'})
+        with ArticleStore(path=self.path) as store:
+            self.assertEqual(store.ingested_file_names(), {'pubmed21n0001.xml.gz', 'pubmed21n0002.xml.gz'})
+            self.assertTrue(store.has_baseline())
+        self.assertEqual(self.ingest()['skipped_files'], 2)
+
+
+class CorpusCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = test_redis()
+        if self.redis is None:
+            self.skipTest('needs Redis or fakeredis')
+        import app.corpus_cache as corpus_cache
+        self.corpus_cache = corpus_cache
+        self.saved = corpus_cache.conn, corpus_cache.Config.CORPUS_MAX_MB
+        corpus_cache.conn = self.redis
+        self.key = corpus_cache.corpus_key('corpus cache test', '', '', '')
+        self.redis.delete(self.key)
+
+    def tearDown(self):
+        if self.redis is None:
+            return
+        self.redis.delete(self.key)
+        self.corpus_cache.conn, self.corpus_cache.Config.CORPUS_MAX_MB = self.saved
+
+    def test_round_trip(self):
+        papers = [article_record(pmid) for pmid in range(10)]
+        self.corpus_cache.save_corpus(self.key, papers, {'mapping' : 1})
+        self.assertEqual(self.corpus_cache.load_corpus(self.key), (papers, {'mapping' : 1}))
+
+    def test_large_corpus_not_cached(self):
+        rng = random.Random(0)
+        ### Random titles so the corpus doesn't compress under the cap
+        papers = [article_record(pmid, title=''.join(rng.choice('abcdefghij') for _ in range(2000))) for pmid in range(100)]
+        self.corpus_cache.Config.CORPUS_MAX_MB = 0.05
+        self.corpus_cache.save_corpus(self.key, papers, {})
+        self.assertIsNone(self.corpus_cache.load_corpus(self.key))
+
+
+class LocationCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = test_redis()
+        if self.redis is None:
+            self.skipTest('needs Redis or fakeredis')
+        import app.location_cache as location_cache
+        self.location_cache = location_cache
+        self.saved_conn = location_cache.conn
+        location_cache.conn = self.redis
+        self.cache = location_cache.LocationCache(max_size=10)
+        self.cache.redis_key = 'geo:test'
+        self.redis.delete(*self.cache.generation_keys())
+
+    def tearDown(self):
+        if self.redis is None:
+            return
+        self.redis.delete(*self.cache.generation_keys())
+        self.location_cache.conn = self.saved_conn
+
+    def test_shared_hit_expires(self):
+        self.cache.get('Harvard Medical School, Boston', lambda affil : 'boston')
+        other = self.location_cache.LocationCache(max_size=10)
+        other.redis_key = self.cache.redis_key
+        self.assertEqual(other.get('Harvard Medical School, Boston', lambda affil : 'miss'), 'boston')
+        self.assertEqual(other.stats()['shared_hits'], 1)
+        current_key, _ = self.cache.generation_keys()
+        self.assertGreater(self.redis.ttl(current_key), 0)
+
+    def test_previous_generation_carried_forward(self):
+        current_key, previous_key = self.cache.generation_keys()
+        key = self.cache.affiliation_key('University of Toronto')
+        self.redis.hset(previous_key, key, 'toronto')
+        self.assertEqual(self.cache.get_many(['University of Toronto'], lambda affils : ['miss']), ['toronto'])
+        self.assertEqual(self.redis.hget(current_key, key), b'toronto')
+
+    def test_full_generation_not_written(self):
+        self.cache.shared_max = 2
+        self.cache.get_many([f'Institute {i}' for i in range(5)], lambda affils : ['somewhere'] * len(affils))
+        self.cache.get('Institute 5', lambda affil : 'somewhere')
+        current_key, _ = self.cache.generation_keys()
+        self.assertEqual(self.redis.hlen(current_key), 5)
+
+    def test_retries_after_error(self):
+        def broken(*args):
+            raise ConnectionError('down')
+        self.assertIsNone(self.cache.shared_call(broken))
+        self.assertIsNone(self.cache.shared_call(lambda : 'up'))
+        self.cache.shared_retry_at = 0
+        self.assertEqual(self.cache.shared_call(lambda : 'up'), 'up')
+
+
+class PubmedQueryToFtsCase(unittest.TestCase):
+    def setUp(self):
+        from app.local_search import pubmed_query_to_fts, UnsupportedQuery
+        self.translate = pubmed_query_to_fts
+        self.UnsupportedQuery = UnsupportedQuery
+
+    def test_translations(self):
+        cases = {
+            'epilepsy' : '"epilepsy"',
+            'tuberous sclerosis' : '("tuberous" AND "sclerosis")',
+            '"tuberous sclerosis"' : '"tuberous sclerosis"',
+            'epilep*' : '"epilep" *',
+            'seizure[ti] OR seizures[ab]' : '{title} : ("seizure") OR {abstract} : ("seizures")',
+            '(ketogenic diet) NOT mice' : '(("ketogenic" AND "diet")) NOT "mice"',
+            '"boston children\'s"[ad]' : '{affiliations} : ("boston children\'s")',
+        }
+        for query, fts_query in cases.items():
+            self.assertEqual(self.translate(query), fts_query, query)
+
+    def test_falls_back_where_pubmed_differs(self):
+        for query in ['Thiele E[au]', 'epilepsy[mh]', 'seizures[majr]', 'epilepsy and children', 
+                      'seizures or epilepsy', 'epilepsy[pt]', 'seizures 2019[dp]', '[ti]', '""']:
+            with self.assertRaises(self.UnsupportedQuery, msg=query):
+                self.translate(query)
+
+
+PUBMED_XML_FIXTURE = b'''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE PubmedArticleSet>
+<PubmedArticleSet>
+<!-- generated for tests -->
+<PubmedArticle>
+  <MedlineCitation Status="MEDLINE" Owner="NLM">
+    <PMID Version="1">111</PMID>
+    <Article PubModel="Print">
+      <Journal>
+        <ISSN IssnType="Electronic">1528-1167</ISSN>
+        <Title>Epilepsia</Title>
+        <ISOAbbreviation>Epilepsia</ISOAbbreviation>
+      </Journal>
+      <ArticleTitle>Seizures <!-- reviewed --> in <i>kids</i> with TSC<sup>2</sup><?pi note?>.</ArticleTitle>
+      <Abstract>
+        <AbstractText Label="BACKGROUND">Infantile <!-- x -->spasms are <b>common</b>.</AbstractText>
+        <AbstractText>Unlabelled<?pi y?> text.</AbstractText>
+      </Abstract>
+      <AuthorList CompleteYN="Y">
+        <Author ValidYN="Y">
+          <LastName>Thiele</LastName><ForeName>Elizabeth A</ForeName><Initials>EA</Initials>
+          <AffiliationInfo><Affiliation>Massachusetts General <!-- sic -->Hospital, Boston, MA, USA.</Affiliation></AffiliationInfo>
+        </Author>
+        <Author ValidYN="Y">
+          <CollectiveName>TSC <i>Study</i> Group</CollectiveName>
+        </Author>
+        <Author ValidYN="Y">
+          <LastName>Doe</LastName><ForeName>Jane</ForeName>
+        </Author>
+      </AuthorList>
+      <PublicationTypeList><PublicationType UI="D016428">Journal Article</PublicationType></PublicationTypeList>
+    </Article>
+    <MeshHeadingList>
+      <MeshHeading><DescriptorName UI="D004827">Epilepsy</DescriptorName><QualifierName UI="Q000188">drug therapy</QualifierName></MeshHeading>
+    </MeshHeadingList>
+  </MedlineCitation>
+  <PubmedData>
+    <History><PubMedPubDate PubStatus="pubmed"><Year>2019</Year><Month>1</Month><Day>2</Day></PubMedPubDate></History>
+    <ArticleIdList><ArticleId IdType="pubmed">111</ArticleId><ArticleId IdType="doi">10.1/x</ArticleId></ArticleIdList>
+  </PubmedData>
+</PubmedArticle>
+<DeleteCitation><PMID Version="1">222</PMID><!-- gone --><PMID Version="1">333</PMID></DeleteCitation>
+<PubmedArticle>
+  <MedlineCitation Status="MEDLINE" Owner="NLM">
+    <PMID Version="1">444</PMID>
+    <Article PubModel="Print">
+      <Journal><Title>Neurology</Title><ISOAbbreviation>Neurology</ISOAbbreviation></Journal>
+      <ArticleTitle>Plain title.</ArticleTitle>
+      <AuthorList><Author><LastName>Roe</LastName><ForeName>Rick</ForeName><Initials>R</Initials>
+        <AffiliationInfo><Affiliation>University of Toronto, Toronto, Canada.</Affiliation></AffiliationInfo></Author></AuthorList>
+    </Article>
+  </MedlineCitation>
+  <PubmedData><History/><ArticleIdList/></PubmedData>
+</PubmedArticle>
+</PubmedArticleSet>
+'''
+
+
+class XmlParserParityCase(unittest.TestCase):
+    def parse(self, engine, **filters):
+        from app.pubmed_scraper_parser import pubmed_xml_iterparse_rows
+        deleted_pmids = []
+        rows = pubmed_xml_iterparse_rows(io.BytesIO(PUBMED_XML_FIXTURE), locations = filters.get('locations', []), 
+                                         affils = filters.get('affils', []), deleted_pmids = deleted_pmids, engine = engine)
+        return rows, deleted_pmids
+
+    def test_engines_match(self):
+        try:
+            import lxml
+        except ImportError:
+            self.skipTest('needs lxml')
+        etree_rows, etree_deleted = self.parse('etree')
+        self.assertEqual(self.parse('lxml'), (etree_rows, etree_deleted))
+        self.assertEqual(etree_deleted, ['222', '333'])
+        self.assertEqual(etree_rows[0][0], 'Seizures  in  kids  with TSC 2 .')
+        self.assertEqual(etree_rows[0][5][0][1], ['Massachusetts General Hospital, Boston, MA, USA.'])
+
+    def test_engines_match_filtered(self):
+        try:
+            import lxml
+        except ImportError:
+            self.skipTest('needs lxml')
+        for filters in [{'locations' : ['Toronto']}, {'affils' : ['massachusetts general']}]:
+            self.assertEqual(self.parse('lxml', **filters), self.parse('etree', **filters), filters)
+
+
+def efetch_chunk(pmid):
+    return PUBMED_XML_FIXTURE.replace(b'<PMID Version="1">111</PMID>', f'<PMID Version="1">{pmid}</PMID>'.encode())
+
+
+class GatedPool(object):
+    """
+    Stands in for the parse pool : `submit` returns at once and the parse only runs once `gate` is set.
+    """
+    def __init__(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        self.gate = threading.Event()
+        self.threads = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, fn, *args):
+        def gated():
+            self.gate.wait(5)
+            return fn(*args)
+        return self.threads.submit(gated)
+
+
+class ParseChunksPipelinedCase(unittest.TestCase):
+    pmids = ['901', '902', '903', '904', '905', '906']
+
+    def chunk_pmids(self, parsed_chunks):
+        from app.pubmed_scraper_parser import PAPERS_COLUMNS
+        return [dict(zip(PAPERS_COLUMNS, rows[0]))['pmid'] for rows in parsed_chunks]
+
+    def test_chunk_order_kept_with_a_pool(self):
+        import time
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        from app.pubmed_scraper_parser import parse_chunks_pipelined
+        def download_chunk(i):
+            ### Later chunks finish downloading first
+            time.sleep(0.02 * (len(self.pmids) - i))
+            return efetch_chunk(self.pmids[i])
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            with ProcessPoolExecutor(max_workers=2) as parse_pool:
+                pooled = list(parse_chunks_pipelined(download_chunk, range(len(self.pmids)), executor, parse_pool))
+            inline = list(parse_chunks_pipelined(download_chunk, range(len(self.pmids)), executor))
+        self.assertEqual(self.chunk_pmids(pooled), self.pmids)
+        self.assertEqual(pooled, inline)
+
+    def test_downloads_dont_wait_on_parsing(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from app.pubmed_scraper_parser import parse_chunks_pipelined
+        downloaded = []
+        all_downloaded = threading.Event()
+        def download_chunk(i):
+            downloaded.append(i)
+            if len(downloaded) == len(self.pmids):
+                all_downloaded.set()
+            return efetch_chunk(self.pmids[i])
+        parse_pool = GatedPool()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            parsed = parse_chunks_pipelined(download_chunk, range(len(self.pmids)), executor, parse_pool)
+            first = threading.Thread(target=lambda : next(parsed))
+            first.start()
+            ### Two threads get through every download while no parse has finished
+            self.assertTrue(all_downloaded.wait(5))
+            parse_pool.gate.set()
+            first.join()
+            self.assertEqual(len(list(parsed)), len(self.pmids) - 1)
+        parse_pool.threads.shutdown()
+
+
+class QueryStreamCase(unittest.TestCase):
+    def setUp(self):
+        import app.main_api_functions as main_api_functions
+        from app.pubmed_scraper_parser import pubmed_xml_iterparse
+        from app.util_functions import create_paper_author_affil_index
+        self.main_api_functions = main_api_functions
+        self.saved = (main_api_functions.query_to_paa_index, Config.AFFILIATION_GROUPING, Config.AUTHOR_GROUPING)
+        Config.AFFILIATION_GROUPING, Config.AUTHOR_GROUPING = 'exact', 'name'
+        papers = pubmed_xml_iterparse(io.BytesIO(PUBMED_XML_FIXTURE), [], []).to_dict('records')
+        paa = create_paper_author_affil_index(papers)
+        self.calls = []
+        def query_to_paa_index(**kwargs):
+            self.calls.append(kwargs)
+            return papers, paa
+        main_api_functions.query_to_paa_index = query_to_paa_index
+
+    def tearDown(self):
+        self.main_api_functions.query_to_paa_index, Config.AFFILIATION_GROUPING, Config.AUTHOR_GROUPING = self.saved
+
+    def test_header_before_any_work(self):
+        import time
+        for data_func in [self.main_api_functions.query_author_papers_data, self.main_api_functions.query_affil_papers_data]:
+            records = data_func('epilepsy', '', [], [], 25, time.time(), 'key', stream = True)
+            self.assertEqual(next(records)['record'], 'header')
+            self.assertEqual(self.calls, [])
+            records = list(records)
+            self.assertEqual([record['stage'] for record in records if record['record'] == 'stage'], 
+                            ['papers_fetched', 'top_objects_found', 'papers_matched', 'papers_merged'])
+            self.assertEqual(records[4]['record'], 'summary')
+            self.assertEqual(records[-1], dict(records[-1], record = 'footer', n_objects = len(records) - 6))
+            self.calls.clear()
+
+    def test_stream_matches_json(self):
+        import time
+        for data_func in [self.main_api_functions.query_author_papers_data, self.main_api_functions.query_affil_papers_data]:
+            out_dict = data_func('epilepsy', '', [], [], 25, time.time(), 'key')
+            objects = {record['key'] : {field : value for field, value in record.items() if field not in ('record', 'rank', 'key')}
+                        for record in data_func('epilepsy', '', [], [], 25, time.time(), 'key', stream = True) if record['record'] == 'object'}
+            self.assertEqual(list(objects), list(out_dict))
+            self.assertEqual(json.loads(json.dumps(objects)), json.loads(json.dumps(out_dict)))
+
+
+FIXTURE_AFFILIATIONS = ['Department of Neurology, Massachusetts General Hospital, Boston, MA, USA.',
+                        'Dept. of Neurology, Massachusetts General Hospital, Boston, MA 02114, USA',
+                        'Department of Pediatrics, University of Toronto, Toronto, Ontario, Canada.',
+                        'The Hospital for Sick Children, Toronto, ON, Canada',
+                        'Département de Neurologie, Hôpital Necker, Paris, France.',
+                        'Department of Genetics, Stanford University, Stanford, CA, USA.',
+                        'KU Leuven, Leuven, Belgium']
+
+
+def synthetic_papers(n, seed=0):
+    """
+    Parser-shaped papers with 1-6 authors of 1-2 affiliations each, drawn from small pools so authors, 
+    affiliations and (author, affiliation) pairs repeat across papers and within them.
+    """
+    rand = random.Random(seed)
+    authors = [[fore_name, fore_name[0], last_name] for fore_name in ['John', 'Ann', 'Raj'] for last_name in ['Smith', 'Lee', 'Patel', 'Roe']]
+    papers_data = []
+    for i in range(n):
+        author_list = [[rand.choice(authors), rand.sample(FIXTURE_AFFILIATIONS, rand.randint(1, 2))] for _ in range(rand.randint(1, 6))]
+        papers_data.append({'pmid' : str(1000 + i), 'title' : f'Paper {i}', 'author_list' : author_list})
+    return papers_data
+
+
+def paa_rows(papers_data):
+    """
+    The paper-author-affiliation mapping the way `create_paper_author_affil_index` built it before it 
+    became a `PaperAuthorAffilIndex` : one dict per author + affiliation + paper.
+    """
+    from app.util_functions import get_locations, preprocess, group_affiliations, group_authors
+    unique_affils = list(set(affil for paper in papers_data for author in paper['author_list'] for affil in author[1]))
+    affil_locations = dict(zip(unique_affils, get_locations(unique_affils)))
+    affil_procs = {affil : preprocess(affil) for affil in unique_affils}
+    affil_groups = group_affiliations(affil_procs.values())
+    author_groups = group_authors(papers_data, {affil : affil_groups[affil_procs[affil]] for affil in unique_affils})
+    return [{'author_list' : author[0],
+             'author_string' : author[0][2] + ", " + author[0][0],
+             'author_group' : author_groups.get((paper['pmid'], position), author[0][2] + ", " + author[0][0]),
+             'affiliations' : affil,
+             'proc_affiliation' : affil_procs[affil],
+             'affiliation_group' : affil_groups[affil_procs[affil]],
+             'locations' : affil_locations[affil],
+             'title' : paper['title'],
+             'pmid' : paper['pmid']} 
+            for paper in papers_data for position, author in enumerate(paper['author_list']) for affil in author[1]]
+
+
+class PlainGroupingCase(unittest.TestCase):
+    """
+    Affiliations and authors grouped by their plain strings, so no database is needed.
+    """
+    def setUp(self):
+        self.saved_grouping = Config.AFFILIATION_GROUPING, Config.AUTHOR_GROUPING
+        Config.AFFILIATION_GROUPING, Config.AUTHOR_GROUPING = 'exact', 'name'
+        self.papers_data = synthetic_papers(60)
+        self.rows = paa_rows(self.papers_data)
+
+    def tearDown(self):
+        Config.AFFILIATION_GROUPING, Config.AUTHOR_GROUPING = self.saved_grouping
+
+
+def old_count_obj_occurance(matching_value, obj_key, paa_cross_mapping, pmid_suffix, n_affiliations):
+    """
+    `count_obj_occurance` as `group_papers_by_top_obj` called it before it indexed rows by object.
+    """
+    match_field = 'proc_affiliation' if obj_key == 'affiliations' else obj_key
+    author_affil_counts = Counter([paper_data.get('pmid') + '__' + paper_data.get(pmid_suffix, '') for paper_data in paa_cross_mapping \
+                                    if paper_data.get(match_field) == matching_value])
+    reformatted_affiliations = {}
+    for pmid_affil, affil_count in author_affil_counts.most_common(n_affiliations * 3):
+        loop_pmid, loop_affil = pmid_affil.split('__')
+        reformatted_affiliations.setdefault(loop_pmid, {})
+        reformatted_affiliations[loop_pmid][loop_affil] = reformatted_affiliations[loop_pmid].get(loop_affil, 0) + affil_count
+    return reformatted_affiliations
+
+
+def old_count_papers(matching_value, papers_data, matching_field):
+    match_field = 'proc_affiliation' if matching_field == 'affiliations' else matching_field
+    return len(set([paper_data.get('pmid') for paper_data in papers_data \
+                    if paper_data.get('pmid') and paper_data.get(match_field) == matching_value]))
+
+
+def old_group_papers_by_top_obj(paa_cross_mapping, obj_key, n_affiliations=3):
+    """
+    `group_papers_by_top_obj` before it indexed rows by object : every count scans the whole mapping.
+    """
+    if obj_key == 'affiliations':
+        obj_list = [paa_dict.get('proc_affiliation') for paa_dict in paa_cross_mapping]
+        obj_name, count_fields = 'proc_Affiliation', {'authors' : 'author_string', 'raw_affiliations' : 'affiliations'}
+    else:
+        obj_list = [paa_dict.get(obj_key) for paa_dict in paa_cross_mapping]
+        obj_name, count_fields = 'author', {'locations' : 'locations', 'affiliations' : 'affiliations'}
+    top_obj_list = list(dict(Counter(obj_list).most_common(200)).keys())
+    out_list = []
+    for obj in top_obj_list:
+        obj_dict = {obj_name : obj, 'total_papers' : old_count_papers(obj, paa_cross_mapping, obj_key)}
+        for out_field, count_field in count_fields.items():
+            obj_dict[out_field] = old_count_obj_occurance(obj, obj_key, paa_cross_mapping, count_field, n_affiliations)
+        out_list.append(obj_dict)
+    return out_list, top_obj_list
+
+
+class GroupPapersByTopObjCase(PlainGroupingCase):
+    def test_matches_old_counts(self):
+        from app.util_functions import group_papers_by_top_obj, create_paper_author_affil_index
+        index = create_paper_author_affil_index(self.papers_data)
+        for obj_key in ['author_string', 'affiliations']:
+            for n_affiliations in [1, 5]:
+                expected = old_group_papers_by_top_obj(self.rows, obj_key, n_affiliations)
+                self.assertEqual(group_papers_by_top_obj(self.rows, obj_key, n_affiliations), expected, (obj_key, n_affiliations))
+                self.assertEqual(group_papers_by_top_obj(index, obj_key, n_affiliations), expected, (obj_key, n_affiliations))
+
+
+class PaperAuthorAffilIndexCase(PlainGroupingCase):
+    """
+    The columnar index against the row dicts the mapping used to be.
+    """
+    fields = ['author_string', 'author_group', 'affiliations', 'proc_affiliation', 'affiliation_group', 'locations', 'title', 'pmid']
+
+    def setUp(self):
+        super().setUp()
+        from app.util_functions import create_paper_author_affil_index
+        self.index = create_paper_author_affil_index(self.papers_data)
+
+    def test_rows(self):
+        self.assertEqual(len(self.index), len(self.rows))
+        self.assertEqual(list(self.index), self.rows)
+
+    def test_columns(self):
+        for field in self.fields:
+            self.assertEqual(self.index.column(field).tolist(), [row[field] for row in self.rows], field)
+
+    def test_value_counts_and_rows_by_value(self):
+        from app.paa_index import PaperAuthorAffilIndex
+        for field in PaperAuthorAffilIndex.string_columns:
+            values = [row[field] for row in self.rows]
+            self.assertEqual(list(self.index.value_counts(field).items()), list(Counter(values).items()), field)
+            expected_rows = {}
+            for i, value in enumerate(values):
+                expected_rows.setdefault(value, []).append(i)
+            self.assertEqual({value : rows.tolist() for value, rows in self.index.rows_by_value(field).items()}, expected_rows, field)
+            some_values = list(expected_rows)[::2]
+            self.assertEqual({value : rows.tolist() for value, rows in self.index.rows_by_value(field, some_values).items()},
+                            {value : expected_rows[value] for value in some_values}, field)
+
+    def test_from_rows(self):
+        from app.paa_index import PaperAuthorAffilIndex
+        rows = iter(self.rows)
+        def index_rows():
+            for paper in self.papers_data:
+                for position, author in enumerate(paper['author_list']):
+                    for _ in author[1]:
+                        row = next(rows)
+                        yield paper['pmid'], paper['title'], paper['author_list'], position, \
+                            {column : row[column] for column in PaperAuthorAffilIndex.string_columns}
+        self.assertEqual(list(PaperAuthorAffilIndex.from_rows(index_rows())), self.rows)
+
+    def test_frame(self):
+        from app.paa_index import paa_to_frame
+        columns = {'author' : 'author_group', 'pmid' : 'pmid', 'location' : 'locations', 'affiliation' : 'affiliations'}
+        frame = paa_to_frame(self.index, columns)
+        self.assertTrue(frame.equals(paa_to_frame(self.rows, columns)))
+        self.assertEqual(frame.to_dict('records'), [{out : row[field] for out, field in columns.items()} for row in self.rows])
+
+
+def old_create_out_dict_obj_index(affil_authors, big_df, obj_key):
+    """
+    `create_out_dict_obj_index` before it partitioned `big_df` : every object's papers are selected with `big_df.loc`.
+    """
+    from app.util_functions import get_location
+    sorted_item_counts = lambda item_lists : sorted(list(Counter([item for sublist in item_lists for item in sublist]).items()), key=lambda x: x[1], reverse=True)
+    obj_key = 'proc_Affiliation' if obj_key == 'affiliations' else obj_key
+    out_dict = {}
+    for obj_dict in affil_authors:
+        obj_rows = big_df.loc[big_df[obj_key] == obj_dict[obj_key], :]
+        if obj_key == 'proc_Affiliation':
+            locations = [get_location(affil) for affils_count_dict in obj_dict['raw_affiliations'].values() for affil in affils_count_dict.keys()]
+            out_obj_dict = {'processed_affiliation' : obj_dict['proc_Affiliation'], 'total_count' : obj_dict['total_papers'],
+                            'authors' : obj_dict['authors'], 'raw_affiliations' : obj_dict['raw_affiliations'], 'locations' : Counter(locations)}
+        else:
+            out_obj_dict = {'author' : obj_dict['author'], 'total_count' : obj_dict['total_papers'],
+                            'affiliations' : obj_dict['affiliations'], 'locations' : obj_dict['locations']}
+        out_obj_dict['papers_dict'] = obj_rows.drop_duplicates(subset=['pmid']).drop(['raw_join_obj'], axis=1).to_dict('records')
+        out_obj_dict['papers_links'] = obj_rows[['pmid', 'title', 'link']].drop_duplicates().to_dict('records')
+        out_obj_dict['papers_keywords'] = [paper['mesh_keywords'] for paper in obj_rows[['pmid', 'mesh_keywords']].drop_duplicates(subset=['pmid']).to_dict('records')]
+        out_obj_dict['papers_keywords_counts'] = sorted_item_counts(out_obj_dict['papers_keywords'])
+        out_obj_dict['papers_pubtypes'] = [paper['pubtype_list'] for paper in obj_rows[['pmid', 'pubtype_list']].drop_duplicates(subset=['pmid']).to_dict('records')]
+        out_obj_dict['papers_pubtype_counts'] = sorted_item_counts(out_obj_dict['papers_pubtypes'])
+        out_dict[obj_dict[obj_key]] = out_obj_dict
+    return out_dict
+
+
+class OutDictObjIndexCase(PlainGroupingCase):
+    """
+    The single partition of `big_df` against selecting each object's rows from it. Top objects share 
+    papers, and an object has several `big_df` rows for a paper when it has several affiliations on it.
+    """
+    def setUp(self):
+        super().setUp()
+        import app.main_api_functions as main_api_functions
+        from app.util_functions import create_paper_author_affil_index
+        self.main_api_functions = main_api_functions
+        self.saved_query = main_api_functions.query_to_paa_index
+        rand = random.Random(1)
+        for paper in self.papers_data:
+            paper.update({'pubdate' : str(rand.randint(2000, 2020)), 'link' : f"https://pubmed.ncbi.nlm.nih.gov/{paper['pmid']}",
+                        'pub_type_list' : rand.sample(['Journal Article', 'Review', 'Case Reports'], rand.randint(1, 2)),
+                        'mesh_keywords' : {term : [] for term in rand.sample(['Epilepsy', 'Child', 'Seizures', 'Humans'], rand.randint(0, 3))},
+                        'other_ids' : {'doi' : f"10.1000/{paper['pmid']}"}})
+        paa = create_paper_author_affil_index(self.papers_data)
+        main_api_functions.query_to_paa_index = lambda **kwargs : (self.papers_data, paa)
+
+    def tearDown(self):
+        self.main_api_functions.query_to_paa_index = self.saved_query
+        super().tearDown()
+
+    def test_matches_per_object_selection(self):
+        import time
+        from app.util_functions import create_out_dict_obj_index
+        for stages, obj_key in [(self.main_api_functions.author_papers_stages, 'author'), 
+                                (self.main_api_functions.affil_papers_stages, 'affiliations')]:
+            _, top_objs, big_df, _ = self.main_api_functions.run_stages(stages('epilepsy', '', [], [], time.time(), 'key'))
+            self.assertGreater(big_df.duplicated(subset=['pmid']).sum(), 0)
+            out_dict = create_out_dict_obj_index(top_objs, big_df, obj_key)
+            expected = old_create_out_dict_obj_index(top_objs, big_df, obj_key)
+            self.assertEqual(list(out_dict), list(expected))
+            self.assertEqual(out_dict, expected, obj_key)
+
+
+def geotext_location(affiliation):
+    """
+    `get_location` before the gazetteer, one `GeoText` per affiliation.
+    """
+    from geotext import GeoText
+    places = GeoText(affiliation)
+    if places:
+        city_str = ' '.join(set([city for city in places.cities if city != 'University'])).strip()
+        if len(places.countries) == 0:
+            country_str = ''
+        else:
+            country_str = places.countries[0]
+        locations = f"{city_str}, {country_str}"
+    else:
+        locations = ''
+    return locations
+
+
+class GazetteerCase(unittest.TestCase):
+    """
+    The batch gazetteer against `GeoText` one affiliation at a time.
+    """
+    affiliations = FIXTURE_AFFILIATIONS + [
+                    'Department of Neurology, Massachusetts General Hospital, Boston, MA, USA.',
+                    ### City and country names that are both, or a country's name inside a city's
+                    'National University of Singapore, Singapore',
+                    'Universidad Nacional Autónoma de México, Mexico City, Mexico',
+                    'Kuwait University, Kuwait City, Kuwait',
+                    'University of Luxembourg, Luxembourg, Luxembourg',
+                    'Tbilisi State University, Tbilisi, Georgia',
+                    'Emory University, Atlanta, Georgia, USA',
+                    'Lebanon Valley College, Annville, PA',
+                    'Hospital Santo Tomás, Panama City, Panama',
+                    'Centre Hospitalier Princesse Grace, Monaco',
+                    'University of Sydney, Sydney, New South Wales, Australia',
+                    'Fundação Oswaldo Cruz, Rio de Janeiro, Brazil',
+                    'Università di Roma, Rome Italy Rome',
+                    'Hôpital Necker, Paris, France; Paris, Texas',
+                    'University Hospital, University, University',
+                    ### Candidates that would join up across the separator if it didn't end them
+                    'Department of Medicine, University of New',
+                    'York, NY, USA',
+                    'Instituto Nacional de Cardiologia, Rio de',
+                    'Janeiro',
+                    'Boston',
+                    'Sao Paulo, Brazil',
+                    'Hong',
+                    'Kong University',
+                    '',
+                    'no capital letters at all',
+                    'Toronto-Ontario-Canada',
+                    ]
+
+    def test_matches_geotext(self):
+        from app.gazetteer import gazetteer
+        expected = [geotext_location(affiliation) for affiliation in self.affiliations]
+        self.assertEqual(gazetteer.locations(self.affiliations), expected)
+        self.assertEqual([gazetteer.locations([affiliation])[0] for affiliation in self.affiliations], expected)
+
+    def test_separator_in_an_affiliation(self):
+        from app.gazetteer import gazetteer
+        ### A NUL can't come from PubMed XML, but shouldn't shift every later location if it does
+        affiliations = ['Boston\n\x00\nCanada', 'Toronto, Canada'] + self.affiliations
+        self.assertEqual(gazetteer.locations(affiliations), [geotext_location(affiliation) for affiliation in affiliations])
+
+    def test_location_filter_selects_the_same(self):
+        import re
+        from app.gazetteer import gazetteer
+        locations_regex = re.compile('(boston|canada|georgia|rio)')
+        self.assertEqual([bool(locations_regex.search(location.lower())) for location in gazetteer.locations(self.affiliations)],
+                        [bool(locations_regex.search(geotext_location(affiliation).lower())) for affiliation in self.affiliations])
+
+
+def old_preprocess(text):
+    """
+    `preprocess` before it used a translate table.
+    """
+    import re
+    from app.util_functions import stopwords_w2v
+    if text:
+        text = re.sub(' +', ' ', text)
+        text = " ".join([re.sub(r'[\-;,\.\d]', '', word.lower()) for word in text.split(' ') if word not in stopwords_w2v]).strip()
+    return text
+
+
+class PreprocessCase(unittest.TestCase):
+    affiliations = ['Department of Neurology, Massachusetts General Hospital, Boston, MA 02114, USA.',
+                    'Dept. of Pediatrics; The Hospital for Sick Children -- Toronto, ON M5G 1X8, Canada',
+                    '  Institut   für  Neurologie,  Universität   zu Köln,   50937 Köln, Germany.  ',
+                    'Hôpital Necker-Enfants Malades, Université Paris Descartes, 75015 Paris, France',
+                    'جامعة القاهرة ٢٠٢٠, Cairo, Egypt',
+                    '東京大学 医学部, Tokyo １１３-８６５５, Japan',
+                    'Department of Neurology,\tUniversity of Michigan,\nAnn Arbor, MI 48109',
+                    'İstanbul Üniversitesi, İstanbul, Turkey',
+                    'Room 3.14; Bldg. 7-B, 1st floor, NIH, Bethesda, MD',
+                    'THE UNIVERSITY OF THE WEST INDIES, Kingston 7, Jamaica',
+                    'of and the', '...;;;---', ' ', '', None] + FIXTURE_AFFILIATIONS
+
+    def test_matches_regex_version(self):
+        from app.util_functions import preprocess
+        for affiliation in self.affiliations:
+            self.assertEqual(preprocess(affiliation), old_preprocess(affiliation), affiliation)
+
+
+class AffiliationMatcherCase(unittest.TestCase):
+    """
+    The trigram-blocked matcher against scoring every choice with `partial_ratio`, as `get_obj_papers` used to.
+    """
+    def setUp(self):
+        rng = random.Random(0)
+        departments = ['neurology', 'cardiology', 'pediatrics', 'psychiatry', 'chemistry', 'physics', 'genetics']
+        universities = ['university toronto', 'harvard medical school', 'mcgill university', 'columbia university',
+                        'university calgary', 'stanford university', 'ku leuven']
+        self.choices = []
+        for _ in range(400):
+            words = ['department', rng.choice(departments), rng.choice(universities)]
+            if rng.random() < 0.3:
+                words.append(rng.choice(['usa', 'canada', 'belgium']))
+            text = ' '.join(words)
+            ### Typos so scores land on both sides of the threshold
+            if rng.random() < 0.3:
+                i = rng.randrange(len(text))
+                text = text[:i] + text[i + 1:]
+            self.choices.append(text)
+        self.choices += ['ucl', 'mit', '']
+
+    def test_matches_brute_force(self):
+        from app.fuzzy_match import AffiliationMatcher, fuzz
+        for threshold in [80, 90, 95]:
+            matcher = AffiliationMatcher(self.choices, threshold=threshold)
+            distinct = list(dict.fromkeys(choice for choice in self.choices if choice))
+            for query in self.choices[:60] + ['department neurology university toronto', 'mit', 'x']:
+                expected = [choice for choice in distinct if query and fuzz.partial_ratio(query, choice) >= threshold]
+                self.assertEqual(matcher.match(query), expected, (threshold, query))
+
+
+### Labelled variants `AFFIL_CLUSTER_THRESHOLD` is set from
+SAME_INSTITUTION = [
+    ('Department of Neurology, Harvard Medical School, Boston, MA, USA.', 'Department of Neurology, Harvard Medical School, Boston, Massachusetts.'),
+    ('Dept. of Neurology, University of Toronto, Toronto, ON, Canada', 'Department of Neurology, University of Toronto, Toronto, Ontario, Canada.'),
+    ('Department of Pediatrics, Columbia University, New York, NY 10032, USA.', 'Department of Pediatrics, Columbia University Medical Center, New York, NY, USA'),
+    ('Department of Neurology, Massachusetts General Hospital, Boston, MA 02114, USA.', 
+     'Dept. of Neurology, Massachusetts General Hospital, Boston, Massachusetts 02114'),
+    ('Department of Neurology, University of Calgary, Calgary, Alberta, Canada.', 'Dept of Neurology, University of Calgary, Calgary, AB, Canada'),
+    ('Department of Clinical Neurosciences, University of Calgary, Calgary, Alberta, Canada.', 
+     'Department of Clinical Neurosciences, University of Calgary, Calgary, AB T2N 4N1, Canada.'),
+    ('Division of Cardiology, Department of Medicine, Stanford University, Stanford, CA, USA.', 
+     'Division of Cardiology, Stanford University School of Medicine, Stanford, CA 94305, USA.'),
+    ('Department of Neurology, The Ottawa Hospital, Ottawa, Ontario, Canada.', 'Department of Neurology, Ottawa Hospital, Ottawa, ON, Canada'),
+]
+DIFFERENT_INSTITUTIONS = [
+    ('Department of Neurology, University of Toronto, Toronto, ON, Canada.', 'Department of Neurology, University of Calgary, Calgary, AB, Canada.'),
+    ('Department of Neurology, University of Toronto, Toronto, ON, Canada.', 'Department of Neurology, University of Ottawa, Ottawa, ON, Canada.'),
+    ('Department of Neurology, University of Toronto, Toronto, ON, Canada.', 'Department of Psychiatry, University of Toronto, Toronto, ON, Canada.'),
+    ('Department of Psychiatry, University of Toronto, Toronto, ON, Canada.', 'Department of Psychiatry, University of Ottawa, Ottawa, ON, Canada.'),
+    ('Department of Neurology, Harvard Medical School, Boston, MA, USA.', 'Department of Cardiology, Harvard Medical School, Boston, MA, USA.'),
+    ('Department of Neurology, Columbia University, New York, NY, USA.', 'Department of Pediatrics, Columbia University, New York, NY, USA.'),
+    ('Department of Neurology, Massachusetts General Hospital, Boston, MA, USA.', "Department of Neurology, Boston Children's Hospital, Boston, MA, USA."),
+    ('Department of Neurology, Boston University School of Medicine, Boston, MA, USA.', 'Department of Neurology, Harvard Medical School, Boston, MA, USA.'),
+]
+
+
+class SharedDatabaseCase(unittest.TestCase):
+    """
+    An app on a SQLite file, so `other_engine` can stand in for another web or worker process.
+    """
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmp_dir.name, 'app.db')
+        self.app = create_app(FileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp_dir.cleanup()
+
+    def other_engine(self):
+        from sqlalchemy import create_engine
+        return create_engine(self.app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+class AffiliationClustersCase(SharedDatabaseCase):
+    def setUp(self):
+        super().setUp()
+        from app.affiliation_clusters import AffiliationClusters
+        from app.util_functions import preprocess
+        self.AffiliationClusters = AffiliationClusters
+        self.preprocess = preprocess
+
+    def pair_similarity(self, affiliation, other):
+        weights = self.AffiliationClusters.word_weights
+        return self.AffiliationClusters.similarity(weights(self.preprocess(affiliation)), weights(self.preprocess(other)))
+
+    def test_threshold_separates_labelled_pairs(self):
+        threshold = float(Config.AFFIL_CLUSTER_THRESHOLD)
+        for affiliation, other in SAME_INSTITUTION:
+            self.assertGreaterEqual(self.pair_similarity(affiliation, other), threshold, (affiliation, other))
+        for affiliation, other in DIFFERENT_INSTITUTIONS:
+            self.assertLess(self.pair_similarity(affiliation, other), threshold, (affiliation, other))
+
+    def test_assign(self):
+        affiliations = set(affiliation for pair in SAME_INSTITUTION + DIFFERENT_INSTITUTIONS for affiliation in pair)
+        procs = {affiliation : self.preprocess(affiliation) for affiliation in affiliations}
+        ### Once in one batch and once an affiliation at a time, so stored clusters are matched against too
+        batch_labels = self.AffiliationClusters().assign(procs.values())
+        db.drop_all()
+        db.create_all()
+        clusters = self.AffiliationClusters()
+        single_labels = {}
+        for proc in sorted(procs.values()):
+            single_labels.update(clusters.assign([proc]))
+
+        for labels in [batch_labels, single_labels]:
+            for affiliation, other in SAME_INSTITUTION:
+                self.assertEqual(labels[procs[affiliation]], labels[procs[other]], (affiliation, other))
+            for affiliation, other in DIFFERENT_INSTITUTIONS:
+                self.assertNotEqual(labels[procs[affiliation]], labels[procs[other]], (affiliation, other))
+
+    def test_labels_shared_between_processes(self):
+        procs = [self.preprocess(affiliation) for pair in SAME_INSTITUTION for affiliation in pair]
+        labels = self.AffiliationClusters().assign(procs[:6])
+        other_labels = self.AffiliationClusters(engine=self.other_engine()).assign(procs)
+        self.assertEqual({proc : label for proc, label in other_labels.items() if proc in labels}, labels)
+        self.assertEqual(self.AffiliationClusters().assign(procs), other_labels)
+
+
+def author_paper(pmid, authors, mesh=()):
+    """
+    `papers_data` entry with `authors` as (fore name, last name, affiliation) tuples.
+    """
+    return {'pmid' : str(pmid), 'mesh_keywords' : {term : [] for term in mesh},
+            'author_list' : [[[fore_name, fore_name[0], last_name], [affiliation]] for fore_name, last_name, affiliation in authors]}
+
+
+class AuthorIndexCase(SharedDatabaseCase):
+    def setUp(self):
+        super().setUp()
+        from app.author_index import AuthorIndex
+        self.AuthorIndex = AuthorIndex
+        self.author_index = AuthorIndex()
+        self.affil_groups = {'mgh' : 'mgh', 'toronto' : 'toronto'}
+
+    def labels(self, papers):
+        """
+        {(pmid, last name) : author label}
+        """
+        last_names = {(int(paper['pmid']), position) : author[0][2] for paper in papers for position, author in enumerate(paper['author_list'])}
+        return {(key[0], last_names[key]) : label for key, label in self.author_index.assign(papers, self.affil_groups).items()}
+
+    def test_shared_affiliation_alone_doesnt_attach(self):
+        labels = self.labels([author_paper(1, [('John', 'Smith', 'mgh'), ('Ann', 'Lee', 'mgh')], mesh=['Epilepsy']),
+                              author_paper(2, [('J', 'Smith', 'mgh'), ('Raj', 'Patel', 'mgh')], mesh=['Heart Failure'])])
+        self.assertNotEqual(labels[(1, 'Smith')], labels[(2, 'Smith')])
+
+    def test_coauthor_and_affiliation_attach(self):
+        labels = self.labels([author_paper(1, [('John', 'Smith', 'mgh'), ('Ann', 'Lee', 'mgh')], mesh=['Epilepsy']),
+                              author_paper(2, [('J', 'Smith', 'mgh'), ('Ann', 'Lee', 'mgh'), ('Raj', 'Patel', 'mgh')])])
+        self.assertEqual(labels[(1, 'Smith')], labels[(2, 'Smith')])
+        self.assertEqual(labels[(1, 'Smith')], 'Smith, John')
+
+    def test_incompatible_names_dont_attach(self):
+        labels = self.labels([author_paper(1, [('John', 'Smith', 'mgh'), ('Ann', 'Lee', 'mgh')]),
+                              author_paper(2, [('Jane', 'Smith', 'mgh'), ('Ann', 'Lee', 'mgh')])])
+        self.assertNotEqual(labels[(1, 'Smith')], labels[(2, 'Smith')])
+
+    def test_reordered_authors_keep_their_labels(self):
+        paper = author_paper(1, [('John', 'Smith', 'mgh'), ('Ann', 'Lee', 'toronto')])
+        labels = self.labels([paper])
+        revised = author_paper(1, [('Ann', 'Lee', 'toronto'), ('John', 'Smith', 'mgh')])
+        self.assertEqual(self.labels([revised]), labels)
+
+    def test_labels_shared_between_processes(self):
+        papers = [author_paper(1, [('John', 'Smith', 'mgh'), ('Ann', 'Lee', 'mgh')], mesh=['Epilepsy']),
+                  author_paper(2, [('J', 'Smith', 'toronto'), ('Raj', 'Patel', 'toronto')], mesh=['Heart Failure'])]
+        labels = self.labels(papers[:1])
+        ### The second Smith is someone else, and the other process labels them from the stored authors
+        self.author_index = self.AuthorIndex(engine=self.other_engine())
+        other_labels = self.labels(papers)
+        self.assertEqual(other_labels[(1, 'Smith')], labels[(1, 'Smith')])
+        self.assertEqual(other_labels[(2, 'Smith')], 'Smith, J')
+        self.author_index = self.AuthorIndex()
+        self.assertEqual(self.labels(papers), other_labels)
+
+
+def out_obj_dict(name_key, name, papers, pmid_values):
+    """
+    An author_papers output entry for `papers` ([(pmid, [keywords], [pubtypes])]).
+    """
+    papers_dict = [{'pmid' : pmid, 'title' : f'paper {pmid}', 'link' : f'link {pmid}',
+                    'mesh_keywords' : keywords, 'pubtype_list' : pubtypes} for pmid, keywords, pubtypes in papers]
+    from app.util_functions import sorted_item_counts
+    return {name_key : name,
+            'total_count' : len(papers),
+            'affiliations' : {pmid : {pmid_values : 1} for pmid, _, _ in papers},
+            'locations' : {pmid : {'toronto' : 1} for pmid, _, _ in papers},
+            'papers_dict' : papers_dict,
+            'papers_links' : [{'pmid' : paper['pmid'], 'title' : paper['title'], 'link' : paper['link']} for paper in papers_dict],
+            'papers_keywords' : [keywords for _, keywords, _ in papers],
+            'papers_keywords_counts' : sorted_item_counts([keywords for _, keywords, _ in papers]),
+            'papers_pubtypes' : [pubtypes for _, _, pubtypes in papers],
+            'papers_pubtype_counts' : sorted_item_counts([pubtypes for _, _, pubtypes in papers])}
+
+
+class MergeOutDictsCase(unittest.TestCase):
+    """
+    Merging a refresh into a stored result against building the result from every paper at once.
+    """
+    papers = {'1' : (['epilepsy', 'child'], ['Journal Article']),
+              '2' : (['epilepsy'], ['Review']),
+              '3' : (['seizures'], ['Journal Article']),
+              '4' : (['epilepsy', 'seizures'], ['Journal Article'])}
+
+    def author(self, name, pmids):
+        return out_obj_dict('author', name, [(pmid, *self.papers[pmid]) for pmid in pmids], 'sickkids toronto')
+
+    def test_merge_matches_full_result(self):
+        from app.main_api_functions import merge_out_dicts
+        old = {'Smith, J' : self.author('Smith, J', ['1', '2']), 'Doe, A' : self.author('Doe, A', ['3'])}
+        ### The refresh window overlaps the stored result on PMID 2
+        new = {'Smith, J' : self.author('Smith, J', ['2', '4']), 'Roe, B' : self.author('Roe, B', ['4'])}
+        ### Roe, B is new to the result but has a paper from before the refresh window
+        full = {'Smith, J' : self.author('Smith, J', ['1', '2', '4']), 'Roe, B' : self.author('Roe, B', ['3', '4']),
+                'Doe, A' : self.author('Doe, A', ['3'])}
+
+        merged = merge_out_dicts(old, new, 'author_papers', full)
+        self.assertEqual(list(merged), ['Smith, J', 'Roe, B', 'Doe, A'])
+        self.assertNotIn('partial', merged['Roe, B'])
+        for name, obj_dict in full.items():
+            self.assertEqual(merged[name]['total_count'], obj_dict['total_count'])
+            for field in ['affiliations', 'locations', 'papers_dict', 'papers_links', 'papers_keywords', 'papers_pubtypes']:
+                self.assertEqual(merged[name][field], obj_dict[field], (name, field))
+            for field in ['papers_keywords_counts', 'papers_pubtype_counts']:
+                self.assertEqual(sorted(map(tuple, merged[name][field])), sorted(map(tuple, obj_dict[field])), (name, field))
+
+    def test_new_entity_without_full_result_is_partial(self):
+        from app.main_api_functions import merge_out_dicts
+        old = {'Smith, J' : self.author('Smith, J', ['1'])}
+        new = {'Smith, J' : self.author('Smith, J', ['2']), 'Roe, B' : self.author('Roe, B', ['4'])}
+        for full in [None, {'error' : 'no results for this query'}, {'Smith, J' : self.author('Smith, J', ['1', '2'])}]:
+            merged = merge_out_dicts(old, new, 'author_papers', full)
+            self.assertTrue(merged['Roe, B']['partial'])
+            self.assertEqual(merged['Roe, B']['papers_dict'], new['Roe, B']['papers_dict'])
+            self.assertNotIn('partial', merged['Smith, J'])
+        self.assertNotIn('partial', new['Roe, B'])
+
+    def test_errors(self):
+        from app.main_api_functions import merge_out_dicts
+        old = {'Smith, J' : self.author('Smith, J', ['1'])}
+        self.assertEqual(merge_out_dicts(old, {'error' : 'no results for this query'}, 'author_papers'), old)
+        self.assertEqual(merge_out_dicts({'error' : 'no results for this query'}, old, 'author_papers'), old)
+
+
+class ExportTestConfig(TestConfig):
+    RESULTS_MAX_PAGE_SIZE = 2
+
+
+class ResultExportCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(ExportTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        from app.models import Result
+        from app.result_store import save_result_output
+        result = Result(query_type='author_papers', query_text='epilepsy', user_querying='alice')
+        db.session.add(result)
+        db.session.commit()
+        self.out_dict = {f'Author {i}' : out_obj_dict('author', f'Author {i}', [(str(i), ['epilepsy'], ['Review'])], 'sickkids') for i in range(5)}
+        save_result_output(db.session, result, self.out_dict)
+        db.session.commit()
+        self.result_id = result.id
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_json_has_every_entity(self):
+        response = self.client.get(f'/api/results/{self.result_id}/export.json')
+        self.assertEqual(response.status_code, 200)
+        rows = json.loads(response.get_data(as_text=True))
+        self.assertEqual([row['key'] for row in rows], list(self.out_dict))
+        self.assertEqual(rows[3]['papers_links'], self.out_dict['Author 3']['papers_links'])
+        self.assertEqual(rows[3]['affiliations'], self.out_dict['Author 3']['affiliations'])
+
+    def test_csv_has_every_entity(self):
+        import csv
+        response = self.client.get(f'/api/results/{self.result_id}/export.csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([row['key'] for row in rows], list(self.out_dict))
+        self.assertEqual(json.loads(rows[4]['papers_links']), self.out_dict['Author 4']['papers_links'])
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get(f'/api/results/{self.result_id}/export.xlsx').status_code, 400)
+
+
+class ResultEntitiesCase(unittest.TestCase):
+    """
+    A result written to the entity tables against the output dictionary `result_all` used to hold,
+    and the paged `/api/results/<id>/entities` endpoints over them.
+    """
+    authors = {'Smith, J' : ['11', '12', '13', '14'], 'Doe, A' : ['21'], 'Smithers, K' : ['31', '32', '33'],
+                'Roe, B' : ['41', '42'], 'Lee, C' : ['51', '52', '53', '54', '55']}
+
+    def setUp(self):
+        self.app = create_app(ExportTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        from app.models import Result
+        from app.result_store import save_result_output
+        self.result = Result(query_type='author_papers', query_text='epilepsy', user_querying='alice')
+        keywords = ['epilepsy', 'child', 'seizures']
+        self.out_dict = {name : out_obj_dict('author', name, [(pmid, keywords[:int(pmid[-1]) % 3 + 1], ['Review'])
+                                                                for pmid in pmids], 'sickkids') for name, pmids in self.authors.items()}
+        save_result_output(db.session, self.result, self.out_dict)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.get_data(as_text=True))
+
+    def test_round_trip(self):
+        from app.models import Result
+        from app.result_store import load_result_output, read_result_entities, save_result_output
+        result = Result.query.get(self.result.id)
+        self.assertIsNone(result.result_all)
+        self.assertEqual(result.length_of_results, len(self.authors))
+        ### Counts come back as JSON-style lists
+        expected = json.loads(json.dumps(self.out_dict))
+        self.assertEqual(load_result_output(db.session, result), expected)
+        self.assertEqual(list(read_result_entities(db.session, result.id, offset=1, limit=2).items()), list(expected.items())[1:3])
+
+        save_result_output(db.session, result, {'error' : 'no results for this query'})
+        db.session.commit()
+        self.assertEqual(result.result_all, {'error' : 'no results for this query'})
+        self.assertEqual(load_result_output(db.session, result), {'error' : 'no results for this query'})
+
+    def test_entity_rows(self):
+        from app.result_store import read_entity_rows
+        n_entities, rows = read_entity_rows(db.session, self.result.id, count_limit=1)
+        self.assertEqual(n_entities, len(self.authors))
+        self.assertEqual([row['key'] for row in rows], list(self.authors))
+        self.assertEqual([row['n_papers'] for row in rows], [len(pmids) for pmids in self.authors.values()])
+        self.assertEqual(rows[0]['affiliations'], self.out_dict['Smith, J']['affiliations'])
+        self.assertEqual(rows[0]['papers_keywords_counts'], [list(self.out_dict['Smith, J']['papers_keywords_counts'][0])])
+        self.assertNotIn('papers_dict', rows[0])
+
+    def test_entities_paging(self):
+        url = f'/api/results/{self.result.id}/entities'
+        page = self.get(f'{url}?page=1&size=2')
+        self.assertEqual((page['total'], page['last_page']), (5, 3))
+        self.assertEqual([row['key'] for row in page['data']], ['Smith, J', 'Doe, A'])
+        self.assertEqual([row['key'] for row in self.get(f'{url}?page=3&size=2')['data']], ['Lee, C'])
+        self.assertEqual(self.get(f'{url}?page=4&size=2')['data'], [])
+        ### `size` is capped at RESULTS_MAX_PAGE_SIZE
+        self.assertEqual(len(self.get(f'{url}?page=1&size=50')['data']), 2)
+
+    def test_entities_sort_and_filter(self):
+        url = f'/api/results/{self.result.id}/entities'
+        page = self.get(f'{url}?size=2&sort=total_count&dir=desc')
+        self.assertEqual([row['key'] for row in page['data']], ['Lee, C', 'Smith, J'])
+        page = self.get(f'{url}?size=2&sorters[0][field]=key&sorters[0][dir]=asc')
+        self.assertEqual([row['key'] for row in page['data']], ['Doe, A', 'Lee, C'])
+
+        page = self.get(f'{url}?size=2&filter=SMITH')
+        self.assertEqual((page['total'], page['last_page']), (2, 1))
+        self.assertEqual([row['key'] for row in page['data']], ['Smith, J', 'Smithers, K'])
+        page = self.get(f'{url}?size=2&filters[0][field]=key&filters[0][value]=oe&sort=key')
+        self.assertEqual([row['key'] for row in page['data']], ['Doe, A', 'Roe, B'])
+        self.assertEqual(self.get(f'{url}?filter=nobody'), {'last_page' : 1, 'total' : 0, 'data' : []})
+
+    def test_entity_papers(self):
+        url = f'/api/results/{self.result.id}/entities/Lee, C/papers'
+        papers = self.out_dict['Lee, C']['papers_dict']
+        page = self.get(f'{url}?page=2&size=2')
+        self.assertEqual((page['total'], page['last_page']), (5, 3))
+        self.assertEqual(page['data'], papers[2:4])
+        page = self.get(f'{url}?size=2&sort=pmid&dir=desc')
+        self.assertEqual(page['data'], papers[::-1][:2])
+        page = self.get(f'{url}?filters[0][field]=title&filters[0][value]=PAPER 53')
+        self.assertEqual((page['total'], page['data']), (1, papers[2:3]))
+        self.assertEqual(self.client.get(f'/api/results/{self.result.id}/entities/Nobody, X/papers').status_code, 404)
+
+
+class ResultCodecCase(unittest.TestCase):
+    papers = [{'pmid' : '123', 'title' : 'Séizures in kids', 'mesh_keywords' : ['Epilepsy', 'Child'],
+                'pubdate' : '2020', 'other_ids' : '', 'count' : 3, 'score' : 0.5, 'missing' : None}]
+
+    def test_round_trip(self):
+        import json
+        from app.result_codec import encode_section, decode_section
+        section = encode_section(self.papers)
+        self.assertEqual(decode_section(section), json.loads(json.dumps(self.papers)))
+        self.assertEqual(decode_section(memoryview(section)), self.papers)
+        self.assertIsNone(decode_section(None))
+
+    def test_reads_every_format(self):
+        """
+        Sections written without msgpack/zstandard installed read back the same.
+        """
+        import app.result_codec as result_codec
+        saved = result_codec.msgpack, result_codec.zstandard
+        for msgpack, zstandard in [(None, None), (saved[0], None), saved]:
+            result_codec.msgpack, result_codec.zstandard = msgpack, zstandard
+            try:
+                section = result_codec.encode_section(self.papers)
+            finally:
+                result_codec.msgpack, result_codec.zstandard = saved
+            self.assertEqual(result_codec.decode_section(section), self.papers)
+
+    def test_unknown_format(self):
+        from app.result_codec import decode_section
+        with self.assertRaises(ValueError):
+            decode_section(b'?abc')
+
+
+class SingleflightCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = test_redis()
+        if self.redis is None:
+            self.skipTest('needs Redis or fakeredis')
+        import app.singleflight as singleflight
+        from rq import Queue
+        self.singleflight = singleflight
+        self.saved_conn = singleflight.conn
+        singleflight.conn = self.redis
+        self.queue = Queue('singleflight-test', connection=self.redis)
+        self.keys = []
+
+    def tearDown(self):
+        if self.redis is None:
+            return
+        for key in self.keys:
+            self.redis.delete(key)
+        for job_id in self.queue.job_ids:
+            self.redis.delete(f'rq:job:{job_id}')
+        self.redis.delete(self.queue.key)
+        self.singleflight.conn = self.saved_conn
+
+    def key(self, *params):
+        key = self.singleflight.flight_key(*params)
+        self.keys.append(key)
+        self.redis.delete(key)
+        return key
+
+    def enqueue(self, job_id):
+        return self.queue.enqueue_call(func='builtins.print', args=('x',), job_id=job_id)
+
+    def test_normalized_key(self):
+        flight_key = self.singleflight.flight_key
+        self.assertEqual(flight_key('author_papers', 'CRISPR  cas9', '2015', 'boston, Cambridge', []),
+                        flight_key('author_papers', 'crispr cas9', '2015', ['cambridge', 'Boston '], ''))
+        self.assertNotEqual(flight_key('author_papers', 'crispr', '', '', ''), flight_key('affil_papers', 'crispr', '', '', ''))
+
+    def test_claim_attach_release(self):
+        key = self.key('author_papers', 'epilepsy', '2015', '', '')
+        job, coalesced = self.singleflight.enqueue_once(key, self.enqueue)
+        self.assertFalse(coalesced)
+        same_job, coalesced = self.singleflight.enqueue_once(key, self.enqueue)
+        self.assertTrue(coalesced)
+        self.assertEqual(same_job.get_id(), job.get_id())
+        self.assertEqual(len(self.queue), 1)
+
+        ### Only the holder releases the claim
+        self.singleflight.release_flight(key, 'someone-else')
+        self.assertEqual(self.redis.get(key).decode(), job.get_id())
+        self.singleflight.release_flight(key, job.get_id())
+        self.assertIsNone(self.redis.get(key))
+
+    def test_stale_claim_replaced(self):
+        key = self.key('affil_papers', 'epilepsy', '', '', '')
+        job, _ = self.singleflight.enqueue_once(key, self.enqueue)
+        job.set_status('finished')
+        new_job, coalesced = self.singleflight.enqueue_once(key, self.enqueue)
+        self.assertFalse(coalesced)
+        self.assertNotEqual(new_job.get_id(), job.get_id())
+        self.assertEqual(self.redis.get(key).decode(), new_job.get_id())
+
+    def test_failed_enqueue_releases_claim(self):
+        key = self.key('affil_papers', 'seizures', '', '', '')
+        def enqueue(job_id):
+            raise RuntimeError('queue down')
+        with self.assertRaises(RuntimeError):
+            self.singleflight.enqueue_once(key, enqueue)
+        self.assertIsNone(self.redis.get(key))
+
+
+
+class JobProgressCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = test_redis()
+        if self.redis is None:
+            self.skipTest('needs Redis or fakeredis')
+        from rq import Queue
+        self.app = create_app(TestConfig)
+        self.app.redis = self.redis
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.queue = Queue('progress-test', connection=self.redis)
+        self.job = self.queue.enqueue_call(func='builtins.print', args=('x',))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        if self.redis is None:
+            return
+        for job_id in self.queue.job_ids:
+            self.redis.delete(f'rq:job:{job_id}')
+        self.redis.delete(self.queue.key)
+        self.app_context.pop()
+
+    def test_threads_count_against_passed_job(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from app.progress import advance_progress, job_progress
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda _ : advance_progress('chunks_fetched', job=self.job), range(8)))
+        ### Without a job there's no current one off the worker's thread, nothing is counted
+        advance_progress('chunks_fetched')
+        self.assertEqual(job_progress(self.job)['chunks_fetched'], 8)
+
+    def test_snapshot(self):
+        from app.progress import advance_progress
+        advance_progress('chunks_fetched', job=self.job)
+        progress = self.client.get(f'/results/{self.job.get_id()}/progress').get_json()
+        self.assertEqual(progress['status'], 'queued')
+        self.assertEqual(progress['chunks_fetched'], 1)
+        self.assertNotIn('url', progress)
+
+        self.job.set_status('finished')
+        progress = self.client.get(f'/results/{self.job.get_id()}/progress').get_json()
+        self.assertEqual(progress['url'], f'/results/{self.job.get_id()}')
+
+        self.job.set_status('failed')
+        self.assertIn('error', self.client.get(f'/results/{self.job.get_id()}/progress').get_json())
+        self.assertEqual(self.client.get('/results/no-such-job/progress').status_code, 404)
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)